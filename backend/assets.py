@@ -0,0 +1,269 @@
+"""Сборка файлов контента: дедупликация, оптимизация и манифест.
+
+    python assets.py build
+
+Исходные файлы (ASSETS_SOURCE_DIRS) собираются в ASSETS_BUILD_DIR: фото
+перекодируются в JPEG под размеры Telegram, PDF линеаризуются и
+сжимаются (нужен pikepdf, без него копируются как есть), одинаковые по
+содержимому файлы собираются один раз. Манифест сопоставляет логическим
+именам (путям исходников, как они записаны в контенте) собранные файлы;
+бот читает его один раз при старте (load_manifest).
+"""
+import os
+import json
+import shutil
+import logging
+import argparse
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from media_cache import MEDIA_DOCUMENT, MEDIA_PHOTO, file_sha256
+
+logger = logging.getLogger(__name__)
+
+# Каталог, от которого считаются логические имена (относительные пути в контенте)
+ASSETS_ROOT = os.getenv(
+    "CONTENT_ASSETS_DIR", os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+# Каталоги исходных файлов (относительно ASSETS_ROOT), через запятую
+ASSETS_SOURCE_DIRS = os.getenv("ASSETS_SOURCE_DIRS", "telegram_bot_images,pdf_project,telegram_bot_pdfs")
+# Каталог собранных файлов и манифест
+ASSETS_BUILD_DIR = os.getenv("ASSETS_BUILD_DIR", os.path.join(ASSETS_ROOT, "assets_build"))
+ASSETS_MANIFEST = os.getenv("ASSETS_MANIFEST", os.path.join(ASSETS_BUILD_DIR, "manifest.json"))
+# Telegram хранит фото не больше 1280 пикселей по большей стороне - больше загружать незачем
+PHOTO_MAX_SIDE = int(os.getenv("ASSETS_PHOTO_MAX_SIDE", "1280"))
+PHOTO_QUALITY = int(os.getenv("ASSETS_PHOTO_QUALITY", "85"))
+
+MANIFEST_VERSION = 1
+# Меняется при изменении обработки, чтобы пересобрать все файлы
+PIPELINE_VERSION = 1
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+PDF_EXTENSIONS = (".pdf",)
+
+# Манифест, загруженный при старте; None - файлы берутся из исходных каталогов
+manifest: Optional["AssetManifest"] = None
+
+
+class AssetManifest:
+    """Логическое имя -> собранный файл и хэш его содержимого (без обращений к диску)"""
+
+    def __init__(self, build_dir: str, data: Dict[str, Any]):
+        self.build_dir = build_dir
+        self.built_at = data.get("built_at")
+        self._files = data["files"]
+        self._paths = {name: os.path.join(build_dir, file) for name, file in data["assets"].items()}
+        self._hashes = {os.path.join(build_dir, file): info["sha256"] for file, info in self._files.items()}
+
+    def resolve(self, name: str) -> Optional[str]:
+        """Путь к собранному файлу по логическому имени"""
+        return self._paths.get(os.path.normpath(name))
+
+    def content_hash(self, path: str) -> Optional[str]:
+        """SHA-256 собранного файла, посчитанный при сборке"""
+        return self._hashes.get(path)
+
+    def missing_files(self) -> List[str]:
+        return [path for path in self._hashes if not os.path.isfile(path)]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"built_at": self.built_at, "assets": len(self._paths), "files": len(self._files)}
+
+
+def load_manifest(path: str = ASSETS_MANIFEST) -> Optional[AssetManifest]:
+    """Чтение манифеста при старте; ValueError, если собранных файлов не хватает"""
+    global manifest
+    if not os.path.isfile(path):
+        logger.warning(f"Манифест файлов не найден ({path}), используются исходные файлы")
+        manifest = None
+        return None
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if data.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"Неподдерживаемая версия манифеста файлов: {data.get('version')}")
+    loaded = AssetManifest(os.path.dirname(os.path.abspath(path)), data)
+    missing = loaded.missing_files()
+    if missing:
+        raise ValueError(f"В сборке нет файлов из манифеста: {', '.join(missing)}")
+    manifest = loaded
+    logger.info(f"Загружен манифест файлов: {loaded.stats()}")
+    return loaded
+
+
+def resolve(name: str) -> Optional[str]:
+    """Собранный файл по логическому имени, если манифест загружен"""
+    return manifest.resolve(name) if manifest is not None else None
+
+
+def default_source_dirs() -> List[str]:
+    """Каталоги исходников из ASSETS_SOURCE_DIRS (относительно ASSETS_ROOT)"""
+    return [d.strip() for d in ASSETS_SOURCE_DIRS.split(",") if d.strip()]
+
+
+def content_hash(path: str) -> Optional[str]:
+    """Хэш собранного файла из манифеста (None - считать по файлу)"""
+    return manifest.content_hash(path) if manifest is not None else None
+
+
+def _optimize_photo(source: str, output: str) -> Dict[str, Any]:
+    # Pillow нужен только при сборке
+    from PIL import Image, ImageOps
+
+    with Image.open(source) as original:
+        source_format = original.format
+        image = ImageOps.exif_transpose(original)
+        image.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE), Image.LANCZOS)
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        # Метаданные (EXIF, превью) не сохраняются
+        image.save(output, "JPEG", quality=PHOTO_QUALITY, optimize=True, progressive=True)
+        width, height = image.size
+        resized = (width, height) != original.size
+
+    # Уже оптимальный JPEG не перекодируем в больший файл
+    if source_format == "JPEG" and not resized and os.path.getsize(output) >= os.path.getsize(source):
+        shutil.copyfile(source, output)
+    return {"media_type": MEDIA_PHOTO, "width": width, "height": height}
+
+
+def _optimize_pdf(source: str, output: str) -> Dict[str, Any]:
+    try:
+        import pikepdf
+    except ImportError:
+        logger.warning(f"pikepdf не установлен, {source} копируется без оптимизации")
+        shutil.copyfile(source, output)
+        return {"media_type": MEDIA_DOCUMENT, "linearized": False}
+
+    with pikepdf.open(source) as pdf:
+        pdf.remove_unreferenced_resources()
+        # Линеаризация: первая страница открывается до загрузки всего файла
+        pdf.save(
+            output, linearize=True, compress_streams=True,
+            object_stream_mode=pikepdf.ObjectStreamMode.generate
+        )
+    return {"media_type": MEDIA_DOCUMENT, "linearized": True}
+
+
+def _source_files(root: str, source_dirs: List[str]) -> List[str]:
+    """Логические имена исходных файлов по порядку"""
+    names = []
+    for source_dir in source_dirs:
+        for directory, _, files in os.walk(os.path.join(root, source_dir)):
+            for file in files:
+                if file.lower().endswith(IMAGE_EXTENSIONS + PDF_EXTENSIONS):
+                    names.append(os.path.relpath(os.path.join(directory, file), root))
+    return sorted(names)
+
+
+def _read_previous(path: str) -> Dict[str, Any]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if data.get("version") == MANIFEST_VERSION else {}
+
+
+def build(
+    root: str = ASSETS_ROOT,
+    source_dirs: Optional[List[str]] = None,
+    build_dir: str = ASSETS_BUILD_DIR,
+    manifest_path: str = ASSETS_MANIFEST,
+    force: bool = False
+) -> Dict[str, Any]:
+    """Сборка файлов и запись манифеста; возвращает манифест.
+
+    Файл собирается один раз на содержимое исходника; неизменившиеся
+    исходники берутся из прошлой сборки. Файлы сборки называются по хэшу
+    результата, лишние удаляются.
+    """
+    source_dirs = source_dirs or default_source_dirs()
+    os.makedirs(build_dir, exist_ok=True)
+    settings = {"pipeline": PIPELINE_VERSION, "photo_max_side": PHOTO_MAX_SIDE, "photo_quality": PHOTO_QUALITY}
+    previous = {} if force else _read_previous(manifest_path)
+    # Хэш исходника -> собранный файл прошлой сборки
+    reusable = {
+        info["source_sha256"]: file for file, info in previous.get("files", {}).items()
+        if info.get("settings") == settings and os.path.isfile(os.path.join(build_dir, file))
+    }
+
+    files: Dict[str, Dict[str, Any]] = {}
+    assets: Dict[str, str] = {}
+    built: Dict[str, str] = {}
+    for name in _source_files(root, source_dirs):
+        source = os.path.join(root, name)
+        source_hash = file_sha256(source)
+        if source_hash in built:
+            assets[name] = built[source_hash]
+            continue
+        if source_hash in reusable:
+            file = reusable[source_hash]
+            files[file] = previous["files"][file]
+        else:
+            is_pdf = name.lower().endswith(PDF_EXTENSIONS)
+            tmp_path = os.path.join(build_dir, f".{source_hash}.tmp")
+            info = (_optimize_pdf if is_pdf else _optimize_photo)(source, tmp_path)
+            output_hash = file_sha256(tmp_path)
+            file = f"{output_hash[:16]}{'.pdf' if is_pdf else '.jpg'}"
+            os.replace(tmp_path, os.path.join(build_dir, file))
+            files[file] = {
+                **info,
+                "sha256": output_hash,
+                "bytes": os.path.getsize(os.path.join(build_dir, file)),
+                "source_sha256": source_hash,
+                "source_bytes": os.path.getsize(source),
+                "settings": settings,
+            }
+        built[source_hash] = file
+        assets[name] = file
+
+    for file in os.listdir(build_dir):
+        path = os.path.join(build_dir, file)
+        if file not in files and os.path.isfile(path) and path != os.path.abspath(manifest_path):
+            os.remove(path)
+
+    data = {
+        "version": MANIFEST_VERSION,
+        "built_at": datetime.utcnow().isoformat(),
+        "files": files,
+        "assets": assets,
+    }
+    tmp_manifest = f"{manifest_path}.tmp"
+    with open(tmp_manifest, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp_manifest, manifest_path)
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сборка файлов контента и манифеста")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("--root", default=ASSETS_ROOT, help="Каталог, от которого считаются логические имена")
+    parser.add_argument("--source-dir", action="append", help="Каталог исходников (можно несколько)")
+    parser.add_argument("--output", default=ASSETS_BUILD_DIR, help="Каталог сборки")
+    parser.add_argument("--force", action="store_true", help="Пересобрать все файлы")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    manifest_path = os.path.join(args.output, "manifest.json")
+    data = build(args.root, args.source_dir, args.output, manifest_path, force=args.force)
+
+    print(f"{'asset':48} {'file':22} {'source KB':>10} {'built KB':>9}")
+    for name, file in sorted(data["assets"].items()):
+        info = data["files"][file]
+        print(f"{name:48} {file:22} {info['source_bytes'] / 1024:10.1f} {info['bytes'] / 1024:9.1f}")
+    source_total = sum(
+        data["files"][file]["source_bytes"] for file in data["assets"].values()
+    )
+    built_total = sum(info["bytes"] for info in data["files"].values())
+    print(f"assets={len(data['assets'])}  files={len(data['files'])}  "
+          f"source={source_total / 1024:.1f} KB  built={built_total / 1024:.1f} KB  manifest={manifest_path}")
+
+
+if __name__ == "__main__":
+    main()
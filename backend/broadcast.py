@@ -0,0 +1,339 @@
+import os
+import uuid
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from telegram.error import Forbidden
+
+import assets
+import database
+import metrics
+from database import run_sync
+from media_cache import MEDIA_DOCUMENT
+from rate_limiter import BULK
+
+logger = logging.getLogger(__name__)
+
+# Как часто воркер бота ищет рассылки для отправки (секунды)
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", "5"))
+# Сколько пользователей отправляется за одну пачку
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "100"))
+# Срок аренды рассылки воркером; продлевается после каждой пачки
+BROADCAST_LEASE_SECONDS = int(os.getenv("BROADCAST_LEASE_SECONDS", "60"))
+# Каталог файлов для рассылок; кроме них отправлять можно только файлы контента
+BROADCAST_FILES_DIR = os.getenv("BROADCAST_FILES_DIR", os.path.join(assets.ASSETS_ROOT, "broadcast_files"))
+
+# Статусы рассылки
+STATUS_RUNNING = "running"
+STATUS_PAUSED = "paused"
+STATUS_COMPLETED = "completed"
+
+# Статусы доставки одному пользователю
+DELIVERY_SENDING = "sending"
+DELIVERY_SENT = "sent"
+DELIVERY_BLOCKED = "blocked"
+DELIVERY_FAILED = "failed"
+DELIVERY_STATUSES = (DELIVERY_SENDING, DELIVERY_SENT, DELIVERY_BLOCKED, DELIVERY_FAILED)
+
+broadcasts_collection = database.db.broadcasts
+deliveries_collection = database.db.broadcast_deliveries
+
+
+def _object_id(broadcast_id: str) -> ObjectId:
+    try:
+        return ObjectId(broadcast_id)
+    except Exception:
+        raise ValueError("Некорректный идентификатор рассылки")
+
+
+async def ensure_indexes():
+    """Индексы рассылок: уникальная доставка на пользователя и подсчет прогресса"""
+    await run_sync(
+        deliveries_collection.create_index, [("broadcast_id", 1), ("user_id", 1)], unique=True
+    )
+    await run_sync(deliveries_collection.create_index, [("broadcast_id", 1), ("status", 1)])
+    await run_sync(broadcasts_collection.create_index, [("status", 1), ("lease_until", 1)])
+
+
+def _allowed_dirs() -> List[str]:
+    directories = [os.path.join(assets.ASSETS_ROOT, d) for d in assets.default_source_dirs()]
+    directories += [assets.ASSETS_BUILD_DIR, BROADCAST_FILES_DIR]
+    return [os.path.realpath(directory) for directory in directories]
+
+
+def is_allowed_document(path: str) -> bool:
+    """Файл лежит в каталоге контента, сборки или BROADCAST_FILES_DIR (с учетом ссылок)"""
+    real = os.path.realpath(path)
+    return os.path.isfile(real) and any(
+        os.path.commonpath([real, directory]) == directory for directory in _allowed_dirs()
+    )
+
+
+def resolve_document(name: str) -> str:
+    """Файл рассылки по логическому имени контента или пути в BROADCAST_FILES_DIR.
+
+    Произвольные пути на сервере (например, .env) не принимаются: API
+    рассылок не должен отправлять пользователям чужие файлы.
+    """
+    resolved = assets.resolve(name)
+    if resolved:
+        return resolved
+    for candidate in (os.path.join(assets.ASSETS_ROOT, name), os.path.join(BROADCAST_FILES_DIR, name)):
+        if is_allowed_document(candidate):
+            return os.path.realpath(candidate)
+    raise ValueError(f"Файл рассылки должен быть файлом контента или лежать в {BROADCAST_FILES_DIR}: {name}")
+
+
+async def create_broadcast(text: str, document_path: Optional[str] = None, start: bool = True) -> Dict[str, Any]:
+    """Создание рассылки по всем пользователям"""
+    if document_path:
+        document_path = resolve_document(document_path)
+    broadcast = {
+        "text": text,
+        "document_path": document_path,
+        "status": STATUS_RUNNING if start else STATUS_PAUSED,
+        # Оценка для прогресса: пользователи, пришедшие позже, тоже получат рассылку
+        "total_users": await database.count_users(),
+        "cursor": None,
+        "lease_owner": None,
+        "lease_until": datetime.min,
+        "created_at": datetime.utcnow(),
+        "completed_at": None,
+    }
+    result = await run_sync(broadcasts_collection.insert_one, broadcast)
+    return await get_broadcast(str(result.inserted_id))
+
+
+async def set_broadcast_status(broadcast_id: str, status: str) -> Optional[Dict[str, Any]]:
+    """Пауза или возобновление; None, если рассылки нет или переход невозможен"""
+    allowed_from = {STATUS_PAUSED: STATUS_RUNNING, STATUS_RUNNING: STATUS_PAUSED}[status]
+    result = await run_sync(
+        broadcasts_collection.update_one,
+        {"_id": _object_id(broadcast_id), "status": allowed_from},
+        # Аренду сбрасываем, чтобы возобновленную рассылку сразу подхватил любой воркер
+        {"$set": {"status": status, "lease_owner": None, "lease_until": datetime.min}}
+    )
+    if result.matched_count == 0:
+        return None
+    return await get_broadcast(broadcast_id)
+
+
+def _progress_sync(broadcast_id: ObjectId) -> Dict[str, int]:
+    return {
+        status: deliveries_collection.count_documents({"broadcast_id": broadcast_id, "status": status})
+        for status in DELIVERY_STATUSES
+    }
+
+
+async def get_broadcast(broadcast_id: str) -> Optional[Dict[str, Any]]:
+    """Рассылка с прогрессом доставки"""
+    oid = _object_id(broadcast_id)
+    broadcast = await run_sync(broadcasts_collection.find_one, {"_id": oid})
+    if broadcast is None:
+        return None
+    progress = await run_sync(_progress_sync, oid)
+    processed = sum(progress.values())
+    return {
+        "id": str(oid),
+        "status": broadcast["status"],
+        "text": broadcast["text"],
+        "document_path": broadcast.get("document_path"),
+        "total_users": broadcast["total_users"],
+        "processed": processed,
+        "progress": round(min(processed / broadcast["total_users"], 1.0), 4) if broadcast["total_users"] else 1.0,
+        "deliveries": progress,
+        "created_at": broadcast["created_at"],
+        "completed_at": broadcast.get("completed_at"),
+        "error": broadcast.get("error"),
+    }
+
+
+class BroadcastRunner:
+    """Фоновая отправка рассылок в event loop бота.
+
+    Рассылку берет в аренду один воркер (find_one_and_update по
+    lease_until), поэтому при нескольких процессах она не дублируется.
+    Пользователи обходятся по _id, курсор и аренда сохраняются после
+    каждой пачки. Перед отправкой в broadcast_deliveries вставляется
+    запись с уникальным ключом (broadcast_id, user_id): после сбоя
+    рассылка продолжается с курсора, а уже обработанные пользователи
+    пропускаются. Доставка "sending", прерванная сбоем, не повторяется -
+    лучше не дослать, чем прислать дважды.
+
+    Файл рассылки загружается в Telegram один раз: в служебный чат
+    cache_chat_id, если он задан, иначе первым получателям по одному,
+    пока не появится file_id; только после этого отправка идет пачкой.
+    """
+
+    def __init__(self, bot, media_cache, cache_chat_id: Optional[str] = None):
+        self.bot = bot
+        self.media_cache = media_cache
+        self.cache_chat_id = cache_chat_id
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Запуск цикла в текущем event loop"""
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        await ensure_indexes()
+        while True:
+            try:
+                broadcast = await self._claim()
+                if broadcast is not None:
+                    await self._process(broadcast)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка в обработке рассылок: {e}")
+            await asyncio.sleep(BROADCAST_POLL_INTERVAL)
+
+    def _lease_until(self) -> datetime:
+        return datetime.utcnow() + timedelta(seconds=BROADCAST_LEASE_SECONDS)
+
+    async def _claim(self) -> Optional[Dict[str, Any]]:
+        """Аренда активной рассылки, не занятой другим воркером"""
+        return await run_sync(
+            broadcasts_collection.find_one_and_update,
+            {"status": STATUS_RUNNING, "lease_until": {"$lt": datetime.utcnow()}},
+            {"$set": {"lease_owner": self.owner, "lease_until": self._lease_until()}},
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _process(self, broadcast: Dict[str, Any]):
+        broadcast_id = broadcast["_id"]
+        cursor = broadcast.get("cursor")
+        # Рассылки, созданные до проверки путей, тоже не отправляют чужие файлы
+        if broadcast.get("document_path") and not is_allowed_document(broadcast["document_path"]):
+            await run_sync(
+                broadcasts_collection.update_one,
+                {"_id": broadcast_id, "lease_owner": self.owner},
+                {"$set": {"status": STATUS_PAUSED, "lease_owner": None, "lease_until": datetime.min,
+                          "error": "Файл рассылки вне разрешенных каталогов"}}
+            )
+            logger.error(f"Рассылка {broadcast_id} остановлена: файл вне разрешенных каталогов")
+            return
+        logger.info(f"Рассылка {broadcast_id}: отправка с курсора {cursor}")
+        await self._upload_document(broadcast)
+
+        while True:
+            users = await run_sync(self._next_users, cursor)
+            if not users:
+                await run_sync(
+                    broadcasts_collection.update_one,
+                    {"_id": broadcast_id, "lease_owner": self.owner},
+                    {"$set": {"status": STATUS_COMPLETED, "completed_at": datetime.utcnow(),
+                              "lease_owner": None}}
+                )
+                logger.info(f"Рассылка {broadcast_id} завершена")
+                return
+
+            # Пока у файла нет file_id, каждая параллельная отправка загружала бы его заново
+            pending = users
+            while pending and not await self._document_ready(broadcast):
+                await self._deliver(broadcast, pending[0])
+                pending = pending[1:]
+            await asyncio.gather(*(self._deliver(broadcast, user) for user in pending))
+            cursor = users[-1]["_id"]
+
+            # Курсор сохраняется, аренда продлевается, заодно проверяется пауза.
+            # После паузы аренда сброшена, но курсор все равно нужен.
+            current = await run_sync(
+                broadcasts_collection.find_one_and_update,
+                {"_id": broadcast_id, "lease_owner": {"$in": [self.owner, None]}},
+                {"$set": {"cursor": cursor, "lease_owner": self.owner, "lease_until": self._lease_until()}},
+                return_document=ReturnDocument.AFTER
+            )
+            if current is None:
+                logger.info(f"Рассылку {broadcast_id} взял другой воркер")
+                return
+            if current["status"] != STATUS_RUNNING:
+                await run_sync(
+                    broadcasts_collection.update_one,
+                    {"_id": broadcast_id, "lease_owner": self.owner},
+                    {"$set": {"lease_owner": None, "lease_until": datetime.min}}
+                )
+                logger.info(f"Рассылка {broadcast_id} приостановлена на курсоре {cursor}")
+                return
+
+    async def _upload_document(self, broadcast: Dict[str, Any]):
+        """Загрузка файла рассылки в служебный чат до отправки пользователям"""
+        if not broadcast.get("document_path") or not self.cache_chat_id:
+            return
+        try:
+            await self.media_cache.preload(
+                broadcast["document_path"],
+                MEDIA_DOCUMENT,
+                lambda document: self.bot.send_document(
+                    chat_id=self.cache_chat_id, document=document,
+                    disable_notification=True, rate_limit_args=BULK
+                )
+            )
+        except Exception as e:
+            # Файл загрузят первые получатели по одному
+            logger.error(f"Не удалось загрузить файл рассылки {broadcast['_id']} в служебный чат: {e}")
+
+    async def _document_ready(self, broadcast: Dict[str, Any]) -> bool:
+        """Можно ли отправлять параллельно: рассылка без файла или у файла есть file_id"""
+        if not broadcast.get("document_path"):
+            return True
+        return await self.media_cache.get_file_id(broadcast["document_path"], MEDIA_DOCUMENT) is not None
+
+    def _next_users(self, cursor: Optional[ObjectId]) -> List[Dict[str, Any]]:
+        query = {"_id": {"$gt": cursor}} if cursor is not None else {}
+        return list(
+            database.users_collection.find(query, {"user_id": 1}).sort("_id", 1).limit(BROADCAST_BATCH_SIZE)
+        )
+
+    async def _deliver(self, broadcast: Dict[str, Any], user: Dict[str, Any]):
+        """Отправка одному пользователю с учетом в broadcast_deliveries"""
+        key = {"broadcast_id": broadcast["_id"], "user_id": user.get("user_id")}
+        try:
+            await run_sync(
+                deliveries_collection.insert_one,
+                {**key, "status": DELIVERY_SENDING, "updated_at": datetime.utcnow()}
+            )
+        except DuplicateKeyError:
+            return
+
+        update = {"status": DELIVERY_SENT, "updated_at": datetime.utcnow()}
+        try:
+            await self._send(broadcast, int(user["user_id"]))
+        except Forbidden as e:
+            # Пользователь заблокировал бота
+            update.update(status=DELIVERY_BLOCKED, error=str(e))
+        except Exception as e:
+            # Любая ошибка отправки завершает доставку, иначе она навсегда останется "sending"
+            update.update(status=DELIVERY_FAILED, error=str(e) or repr(e))
+        metrics.BROADCAST_DELIVERIES.labels(status=update["status"]).inc()
+        await run_sync(deliveries_collection.update_one, key, {"$set": update})
+
+    async def _send(self, broadcast: Dict[str, Any], chat_id: int):
+        if broadcast.get("document_path"):
+            await self.media_cache.send(
+                broadcast["document_path"],
+                MEDIA_DOCUMENT,
+                lambda document: self.bot.send_document(
+                    chat_id=chat_id, document=document, caption=broadcast["text"], rate_limit_args=BULK
+                )
+            )
+        else:
+            await self.bot.send_message(chat_id=chat_id, text=broadcast["text"], rate_limit_args=BULK)
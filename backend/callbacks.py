@@ -0,0 +1,140 @@
+import os
+import re
+import hmac
+import base64
+import hashlib
+from dataclasses import dataclass
+from typing import Optional
+
+from dotenv import load_dotenv
+
+# Загрузка переменных окружения
+load_dotenv()
+
+# Ключ подписи callback_data; по умолчанию выводится из токена бота
+CALLBACK_SECRET = os.getenv("CALLBACK_SECRET") or os.getenv("TELEGRAM_BOT_TOKEN") or ""
+# Принимать ли кнопки старого текстового формата ("answer_1_2", "get_diet"),
+# уже отправленные пользователям до перехода на новую кодировку; включается
+# только на переходный период после выкатки
+CALLBACK_ACCEPT_LEGACY = os.getenv("CALLBACK_ACCEPT_LEGACY", "0") == "1"
+
+# Версия формата: первый байт полезной нагрузки
+FORMAT_VERSION = 1
+# Длина усеченной подписи HMAC-SHA256 (байт)
+MAC_LENGTH = 6
+# Ограничение Telegram на callback_data (байт)
+MAX_CALLBACK_DATA = 64
+
+# Действия кнопок
+ACTION_CHECK_SUBSCRIPTION = 1
+ACTION_START_TEST = 2
+ACTION_ANSWER = 3
+ACTION_GET_DIET = 4
+
+# Причины отклонения (метка метрики)
+REJECT_MALFORMED = "malformed"
+REJECT_SIGNATURE = "signature"
+REJECT_FORMAT = "format"
+
+# Ровно те callback_data, которые отправлял старый бот
+_LEGACY_ACTIONS = {
+    "check_subscription": ACTION_CHECK_SUBSCRIPTION,
+    "start_test": ACTION_START_TEST,
+    "get_diet": ACTION_GET_DIET,
+}
+_LEGACY_ANSWER = re.compile(r"answer_(\d+)_(\d+)")
+
+_mac_key = hashlib.sha256(b"callback-data:" + CALLBACK_SECRET.encode()).digest()
+
+
+class CallbackRejected(ValueError):
+    """callback_data не прошла проверку; reason - причина для метрик"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+@dataclass(frozen=True)
+class CallbackData:
+    """Разобранная кнопка: действие, тест, версия контента, вопрос и вариант"""
+    action: int
+    quiz_id: Optional[str] = None
+    version: Optional[str] = None
+    question: int = 0
+    option: int = 0
+
+
+def _sign(body: bytes) -> bytes:
+    return hmac.new(_mac_key, body, hashlib.sha256).digest()[:MAC_LENGTH]
+
+
+def _short_string(value: Optional[str]) -> bytes:
+    raw = (value or "").encode()
+    if len(raw) > 255:
+        raise ValueError(f"Слишком длинное значение для callback_data: {value}")
+    return bytes((len(raw),)) + raw
+
+
+def encode(
+    action: int,
+    quiz_id: Optional[str] = None,
+    version: Optional[str] = None,
+    question: int = 0,
+    option: int = 0
+) -> str:
+    """callback_data: base64url(версия, действие, тест, версия контента, вопрос, вариант) + подпись"""
+    body = (
+        bytes((FORMAT_VERSION, action))
+        + _short_string(quiz_id)
+        + _short_string(version)
+        + bytes((question, option))
+    )
+    data = base64.urlsafe_b64encode(body + _sign(body)).rstrip(b"=").decode()
+    if len(data) > MAX_CALLBACK_DATA:
+        raise ValueError(f"callback_data длиннее {MAX_CALLBACK_DATA} байт: {quiz_id}, {version}")
+    return data
+
+
+def _decode_legacy(data: str) -> Optional[CallbackData]:
+    """Кнопки текстового формата: "answer_1_2", "start_test", "get_diet"; None для остальных"""
+    if data in _LEGACY_ACTIONS:
+        return CallbackData(_LEGACY_ACTIONS[data])
+    match = _LEGACY_ANSWER.fullmatch(data)
+    if match is None:
+        return None
+    return CallbackData(ACTION_ANSWER, question=int(match.group(1)), option=int(match.group(2)))
+
+
+def decode(data: str) -> CallbackData:
+    """Разбор и проверка подписи за один проход; CallbackRejected при ошибке"""
+    # Первый байт (версия формата) не дает в base64url ни "answer_", ни имен действий
+    if CALLBACK_ACCEPT_LEGACY:
+        legacy = _decode_legacy(data)
+        if legacy is not None:
+            return legacy
+    try:
+        raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+    except ValueError:
+        raise CallbackRejected(REJECT_MALFORMED)
+    if len(raw) < 6 + MAC_LENGTH:
+        raise CallbackRejected(REJECT_MALFORMED)
+
+    body, mac = raw[:-MAC_LENGTH], raw[-MAC_LENGTH:]
+    if not hmac.compare_digest(mac, _sign(body)):
+        raise CallbackRejected(REJECT_SIGNATURE)
+    if body[0] != FORMAT_VERSION:
+        raise CallbackRejected(REJECT_FORMAT)
+
+    try:
+        position = 2
+        quiz_length = body[position]
+        quiz_id = body[position + 1:position + 1 + quiz_length].decode()
+        position += 1 + quiz_length
+        version_length = body[position]
+        version = body[position + 1:position + 1 + version_length].decode()
+        position += 1 + version_length
+        question, option = body[position], body[position + 1]
+    except (IndexError, UnicodeDecodeError):
+        raise CallbackRejected(REJECT_MALFORMED)
+    return CallbackData(body[1], quiz_id or None, version or None, question, option)
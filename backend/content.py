@@ -0,0 +1,491 @@
+import os
+import json
+import asyncio
+import logging
+import itertools
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from types import MappingProxyType
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import assets
+import callbacks
+import database
+from database import run_sync
+from media_cache import MEDIA_PHOTO, MEDIA_DOCUMENT
+from quiz_engine import QuizEngine, QuizResult, TEST_HEADER, QUESTION_PREFIX, DIET_BUTTON
+
+logger = logging.getLogger(__name__)
+
+# Источник контента: file (JSON-файл) или mongo (коллекция content)
+CONTENT_SOURCE = os.getenv("CONTENT_SOURCE", "file")
+CONTENT_PATH = os.getenv(
+    "CONTENT_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "content", "quiz.json")
+)
+# Как часто проверять изменения контента (секунды)
+CONTENT_RELOAD_INTERVAL = float(os.getenv("CONTENT_RELOAD_INTERVAL", "5"))
+# Сколько скомпилированных версий держать в памяти для незавершенных тестов
+CONTENT_KEEP_VERSIONS = int(os.getenv("CONTENT_KEEP_VERSIONS", "10"))
+
+# Каталог, от которого считаются относительные пути к файлам в контенте
+CONTENT_ASSETS_DIR = assets.ASSETS_ROOT
+
+CONTENT_DOCUMENT_ID = "quiz"
+# Тест по умолчанию и тест старого формата контента с единственным "quiz"
+DEFAULT_QUIZ_ID = "keto"
+# Файлы контента старого формата, где пути не указывались
+LEGACY_WELCOME_PHOTO = "telegram_bot_images/anna_photo.jpg"
+LEGACY_DIET_PDF = "telegram_bot_pdfs/Кето_Анна_Герц.pdf"
+
+# Тексты, без которых бот не работает
+REQUIRED_MESSAGES = (
+    "welcome", "subscription_prompt", "subscribe_button", "check_subscription_button",
+    "subscription_confirmed", "subscription_missing", "subscription_check_failed",
+    "test_invitation", "start_test_button", "test_not_found", "diet_error",
+)
+
+content_collection = database.db.content
+versions_collection = database.db.content_versions
+
+
+@dataclass(frozen=True)
+class MediaItem:
+    """Файл для отправки: фото или документ"""
+    media_type: str
+    path: str
+    caption: Optional[str] = None
+    filename: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class QuizContent:
+    """Скомпилированный тест с текстами, клавиатурами и файлами по диапазонам баллов"""
+    quiz_id: str
+    engine: QuizEngine
+    messages: Mapping[str, str]
+    subscription_markup: InlineKeyboardMarkup
+    invitation_markup: InlineKeyboardMarkup
+    # Нижняя граница диапазона результата -> файлы; default_media - для остальных
+    media_by_band: Mapping[int, Tuple[MediaItem, ...]]
+    default_media: Tuple[MediaItem, ...]
+    # Шаблон персонального PDF рациона (см. pdf_render); включается автором
+    # контента ключом diet_pdf теста, без него (или null) - только статичные файлы
+    diet_pdf: Optional[Mapping[str, Any]] = None
+
+    def media_for(self, result: QuizResult) -> Tuple[MediaItem, ...]:
+        """Файлы, которые получает пользователь с этим результатом"""
+        return self.media_by_band.get(result.low, self.default_media)
+
+    def pdf_spec(self, result: QuizResult, answers: Sequence[int]) -> Optional[Dict[str, Any]]:
+        """Описание персонального PDF по результату и индексам ответов.
+
+        В описание попадают только ответы на вопросы из personalize, поэтому
+        одинаковые описания (и файлы в кэше) получают все пользователи
+        с тем же результатом и теми же ответами на эти вопросы.
+        """
+        if self.diet_pdf is None:
+            return None
+        sections = []
+        for item in self.diet_pdf["personalize"]:
+            question = item["question"]
+            if question >= len(answers):
+                return None
+            sections.append({"heading": item["heading"], "text": item["notes"][answers[question]]})
+        return {
+            "title": self.diet_pdf["title"],
+            "cover_image": self.diet_pdf["cover_image"],
+            "result_title": f"{result.percentage}% — {result.title}",
+            "sections": sections,
+            "days": self.diet_pdf["days"],
+        }
+
+    def pdf_specs(self) -> Iterator[Dict[str, Any]]:
+        """Описания всех возможных персональных PDF (для прогрева кэша)"""
+        if self.diet_pdf is None:
+            return
+        questions = [item["question"] for item in self.diet_pdf["personalize"]]
+        answers = [0] * (max(questions) + 1 if questions else 0)
+        for result in self.engine.results:
+            for combination in itertools.product(
+                *(range(len(self.engine.questions[q].options)) for q in questions)
+            ):
+                for question, answer in zip(questions, combination):
+                    answers[question] = answer
+                yield self.pdf_spec(result, answers)
+
+
+@dataclass(frozen=True)
+class Content:
+    """Скомпилированный контент одной версии: тексты, тесты и готовые клавиатуры"""
+    version: str
+    messages: Mapping[str, str]
+    quizzes: Mapping[str, QuizContent]
+    default_quiz_id: str
+    # Параметр /start (deep link) -> идентификатор теста
+    payloads: Mapping[str, str]
+    welcome_photo: Optional[str]
+
+    def quiz(self, quiz_id: Optional[str] = None) -> QuizContent:
+        """Тест по идентификатору; неизвестный - тест по умолчанию"""
+        return self.quizzes.get(quiz_id) or self.quizzes[self.default_quiz_id]
+
+    def quiz_for_payload(self, payload: Optional[str]) -> QuizContent:
+        """Тест по параметру ссылки t.me/<bot>?start=<payload>"""
+        return self.quiz(self.payloads.get(payload or ""))
+
+    def media_items(self) -> Tuple[MediaItem, ...]:
+        """Все файлы контента без повторов"""
+        items = {}
+        if self.welcome_photo:
+            items[(MEDIA_PHOTO, self.welcome_photo)] = MediaItem(MEDIA_PHOTO, self.welcome_photo)
+        for quiz in self.quizzes.values():
+            for bundle in (quiz.default_media, *quiz.media_by_band.values()):
+                for item in bundle:
+                    items.setdefault((item.media_type, item.path), item)
+        return tuple(items.values())
+
+
+def asset_path(path: str) -> str:
+    """Абсолютный путь к файлу контента: собранный файл из манифеста или исходник"""
+    if os.path.isabs(path):
+        return path
+    return assets.resolve(path) or os.path.join(CONTENT_ASSETS_DIR, path)
+
+
+def _compile_media(items: Sequence[Dict[str, Any]]) -> Tuple[MediaItem, ...]:
+    media = []
+    for item in items:
+        media_type = item.get("type", MEDIA_DOCUMENT)
+        if media_type not in (MEDIA_PHOTO, MEDIA_DOCUMENT):
+            raise ValueError(f"Неизвестный тип файла: {media_type}")
+        path = asset_path(item["path"])
+        if not os.path.isfile(path):
+            raise ValueError(f"Файл контента не найден: {path}")
+        media.append(MediaItem(media_type, path, item.get("caption"), item.get("filename")))
+    return tuple(media)
+
+
+def _compile_diet_pdf(quiz_id: str, diet_pdf: Dict[str, Any], questions: List[Dict]) -> Dict[str, Any]:
+    """Проверка шаблона персонального PDF: вопросы существуют, тексты есть для каждого ответа"""
+    personalize = []
+    for item in diet_pdf.get("personalize", []):
+        question = int(item["question"])
+        if not 0 <= question < len(questions):
+            raise ValueError(f"В PDF теста {quiz_id} указан несуществующий вопрос {question}")
+        if len(item["notes"]) != len(questions[question]["options"]):
+            raise ValueError(f"В PDF теста {quiz_id} тексты для вопроса {question} не совпадают с ответами")
+        personalize.append({"question": question, "heading": item["heading"], "notes": list(item["notes"])})
+    cover_image = diet_pdf.get("cover_image")
+    if cover_image:
+        cover_image = _compile_media([{"type": MEDIA_PHOTO, "path": cover_image}])[0].path
+    return {
+        "filename": diet_pdf.get("filename"),
+        "caption": diet_pdf.get("caption"),
+        "title": diet_pdf["title"],
+        "cover_image": cover_image,
+        "personalize": personalize,
+        "days": [{"title": day["title"], "meals": list(day["meals"])} for day in diet_pdf.get("days", [])],
+    }
+
+
+def _compile_quiz(quiz_id: str, version: str, quiz: Dict[str, Any], messages: Dict[str, str]) -> QuizContent:
+    messages = {**messages, **quiz.get("messages", {})}
+    try:
+        questions = [
+            {"question": q["question"], "options": [(o["text"], int(o["score"])) for o in q["options"]]}
+            for q in quiz["questions"]
+        ]
+        results = {
+            (int(r["low"]), int(r["high"])): {
+                "percentage": r["percentage"], "title": r["title"], "description": r["description"],
+            }
+            for r in quiz["results"]
+        }
+        media_by_band = {
+            int(r["low"]): _compile_media(r["media"]) for r in quiz["results"] if "media" in r
+        }
+        default_media = _compile_media(quiz.get("media", []))
+        diet_pdf = _compile_diet_pdf(quiz_id, quiz["diet_pdf"], questions) if quiz.get("diet_pdf") else None
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Некорректное описание теста {quiz_id}: {e!r}")
+    if not questions or not results:
+        raise ValueError(f"В тесте {quiz_id} нет вопросов или результатов")
+
+    return QuizContent(
+        quiz_id=quiz_id,
+        engine=QuizEngine(
+            questions,
+            results,
+            header=quiz.get("header", TEST_HEADER),
+            question_prefix=quiz.get("question_prefix", QUESTION_PREFIX),
+            diet_button=messages.get("get_diet_button", DIET_BUTTON),
+            quiz_id=quiz_id,
+            version=version
+        ),
+        messages=MappingProxyType(messages),
+        # Идентификатор теста едет в callback_data, чтобы не читать его из БД
+        subscription_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(messages["subscribe_button"], url=messages["channel_url"])],
+            [InlineKeyboardButton(
+                messages["check_subscription_button"],
+                callback_data=callbacks.encode(callbacks.ACTION_CHECK_SUBSCRIPTION, quiz_id, version)
+            )]
+        ]),
+        invitation_markup=InlineKeyboardMarkup([[InlineKeyboardButton(
+            messages["start_test_button"],
+            callback_data=callbacks.encode(callbacks.ACTION_START_TEST, quiz_id, version)
+        )]]),
+        media_by_band=MappingProxyType(media_by_band),
+        default_media=default_media,
+        diet_pdf=diet_pdf
+    )
+
+
+def _upgrade_legacy(raw: Dict[str, Any]) -> Dict[str, Any]:
+    """Контент первого формата (один "quiz") в формат с несколькими тестами"""
+    messages = raw.get("messages", {})
+    quiz = {
+        **raw["quiz"],
+        "id": DEFAULT_QUIZ_ID,
+        "media": [{
+            "type": MEDIA_DOCUMENT,
+            "path": LEGACY_DIET_PDF,
+            "filename": messages.get("diet_filename"),
+            "caption": messages.get("diet_caption"),
+        }],
+    }
+    return {
+        **raw,
+        "default_quiz": DEFAULT_QUIZ_ID,
+        "assets": {"welcome_photo": LEGACY_WELCOME_PHOTO},
+        "quizzes": [quiz],
+    }
+
+
+def raw_quiz_ids(raw: Dict[str, Any]) -> List[str]:
+    """Идентификаторы тестов сохраненной версии контента"""
+    if "quiz" in raw and "quizzes" not in raw:
+        return [DEFAULT_QUIZ_ID]
+    return [quiz.get("id") for quiz in raw.get("quizzes", [])]
+
+
+def raw_quiz_options(raw: Dict[str, Any], quiz_id: Optional[str]) -> Optional[List[List[Tuple[str, int]]]]:
+    """Варианты ответов (текст, баллы) по вопросам теста из сохраненной версии контента"""
+    if "quiz" in raw and "quizzes" not in raw:
+        raw = _upgrade_legacy(raw)
+    for quiz in raw.get("quizzes", []):
+        if quiz.get("id") == (quiz_id or raw.get("default_quiz", DEFAULT_QUIZ_ID)):
+            return [[(o["text"], int(o["score"])) for o in q["options"]] for q in quiz["questions"]]
+    return None
+
+
+def compile_content(raw: Dict[str, Any], channel_url: str) -> Content:
+    """Проверка и компиляция описания контента; ValueError при ошибках"""
+    if "version" not in raw:
+        raise ValueError("В контенте нет поля version")
+    if "quiz" in raw and "quizzes" not in raw:
+        raw = _upgrade_legacy(raw)
+    messages = {**raw.get("messages", {}), "channel_url": channel_url}
+    missing = [key for key in REQUIRED_MESSAGES if not messages.get(key)]
+    if missing:
+        raise ValueError(f"В контенте нет текстов: {', '.join(missing)}")
+
+    quizzes: Dict[str, QuizContent] = {}
+    payloads: Dict[str, str] = {}
+    for quiz in raw.get("quizzes", []):
+        quiz_id = quiz.get("id")
+        if not quiz_id or quiz_id in quizzes:
+            raise ValueError(f"У теста нет id или id повторяется: {quiz_id}")
+        quizzes[quiz_id] = _compile_quiz(quiz_id, str(raw["version"]), quiz, messages)
+        for payload in quiz.get("payloads", [quiz_id]):
+            if payload in payloads:
+                raise ValueError(f"Параметр /start {payload} указан у нескольких тестов")
+            payloads[payload] = quiz_id
+
+    default_quiz_id = raw.get("default_quiz", next(iter(quizzes), None))
+    if default_quiz_id not in quizzes:
+        raise ValueError(f"Тест по умолчанию не найден: {default_quiz_id}")
+
+    welcome_photo = raw.get("assets", {}).get("welcome_photo")
+    if welcome_photo:
+        welcome_photo = _compile_media([{"type": MEDIA_PHOTO, "path": welcome_photo}])[0].path
+
+    return Content(
+        version=str(raw["version"]),
+        messages=MappingProxyType(messages),
+        quizzes=MappingProxyType(quizzes),
+        default_quiz_id=default_quiz_id,
+        payloads=MappingProxyType(payloads),
+        welcome_photo=welcome_photo
+    )
+
+
+class FileContentSource:
+    """Контент из JSON-файла; файл перечитывается, когда меняются mtime или размер"""
+
+    def __init__(self, path: str = CONTENT_PATH):
+        self.path = path
+        self._signature = None
+
+    async def fetch(self, known_version: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Описание контента, если файл изменился, иначе None"""
+        stat = os.stat(self.path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self._signature:
+            return None
+        with open(self.path, encoding="utf-8") as f:
+            raw = json.load(f)
+        self._signature = signature
+        return raw
+
+
+class MongoContentSource:
+    """Контент из документа коллекции content; изменения видны по полю version"""
+
+    def __init__(self, collection=None, document_id: str = CONTENT_DOCUMENT_ID):
+        self.collection = collection if collection is not None else content_collection
+        self.document_id = document_id
+
+    async def fetch(self, known_version: Optional[str]) -> Optional[Dict[str, Any]]:
+        query: Dict[str, Any] = {"_id": self.document_id}
+        if known_version is not None:
+            query["version"] = {"$ne": known_version}
+        raw = await run_sync(self.collection.find_one, query, {"_id": 0})
+        # Версия могла быть сохранена числом - сравнение выше ее пропустит
+        if raw is not None and known_version is not None and str(raw.get("version")) == known_version:
+            return None
+        return raw
+
+
+def create_content_source(source: str = CONTENT_SOURCE):
+    """Источник контента по настройке CONTENT_SOURCE"""
+    if source == "mongo":
+        return MongoContentSource()
+    return FileContentSource()
+
+
+class ContentRegistry:
+    """Текущий контент бота с горячей заменой.
+
+    Новая версия компилируется целиком и подменяет текущую одним
+    присваиванием, поэтому обработчики всегда видят согласованный
+    контент. Каждая загруженная версия сохраняется в content_versions:
+    незавершенный тест продолжается и считается по той версии, с которой
+    начался, даже после перезапуска бота.
+    """
+
+    def __init__(self, source, channel_url: str, keep_versions: int = CONTENT_KEEP_VERSIONS, on_change=None):
+        self.source = source
+        self.channel_url = channel_url
+        # Корутина, вызываемая с новым контентом после замены
+        self.on_change = on_change
+        self.keep_versions = keep_versions
+        self._current: Optional[Content] = None
+        self._current_raw: Optional[Dict[str, Any]] = None
+        self._versions: "OrderedDict[str, Content]" = OrderedDict()
+        self.loaded_at: Optional[datetime] = None
+        self._task: Optional[asyncio.Task] = None
+        # Event loop бота: в нем выполняются reload и on_change
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def current(self) -> Content:
+        if self._current is None:
+            raise RuntimeError("Контент еще не загружен")
+        return self._current
+
+    def _remember(self, content: Content):
+        self._versions[content.version] = content
+        self._versions.move_to_end(content.version)
+        while len(self._versions) > self.keep_versions:
+            self._versions.popitem(last=False)
+
+    async def load(self):
+        """Первая загрузка; без контента бот работать не может"""
+        if not await self.reload():
+            raise RuntimeError("Не удалось загрузить контент бота")
+
+    async def reload(self) -> bool:
+        """Проверка источника и замена контента; True, если загружена новая версия"""
+        known = self._current.version if self._current else None
+        raw = await self.source.fetch(known)
+        if raw is None:
+            return False
+
+        content = compile_content(raw, self.channel_url)
+        if self._current is not None and content.version == self._current.version:
+            if raw != self._current_raw:
+                logger.error(f"Контент изменился без смены версии {content.version} - изменения не применены")
+            return False
+
+        await run_sync(
+            versions_collection.update_one,
+            {"_id": content.version},
+            {"$setOnInsert": {"raw": raw, "published_at": datetime.utcnow()}},
+            upsert=True
+        )
+        self._remember(content)
+        self._current, self._current_raw = content, raw
+        self.loaded_at = datetime.utcnow()
+        logger.info(f"Загружен контент версии {content.version}")
+        if self.on_change is not None:
+            await self.on_change(content)
+        return True
+
+    async def get(self, version: Optional[str]) -> Content:
+        """Контент нужной версии; для неизвестной версии - текущий"""
+        if version is None:
+            return self.current
+        content = self._versions.get(version)
+        if content is not None:
+            self._versions.move_to_end(version)
+            return content
+
+        document = await run_sync(versions_collection.find_one, {"_id": version})
+        if document is None:
+            logger.warning(f"Версия контента {version} не найдена, используется текущая")
+            return self.current
+        content = compile_content(document["raw"], self.channel_url)
+        self._remember(content)
+        return content
+
+    async def _watch(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reload()
+            except Exception as e:
+                # Ошибочный контент не заменяет рабочий
+                logger.error(f"Ошибка загрузки контента: {e}")
+
+    def start_watching(self, interval: float = CONTENT_RELOAD_INTERVAL):
+        """Периодическая проверка изменений в текущем event loop"""
+        self._loop = asyncio.get_running_loop()
+        self._task = self._loop.create_task(self._watch(interval))
+
+    async def reload_from_any_loop(self) -> bool:
+        """reload из другого event loop (например, из потока FastAPI) в loop бота"""
+        try:
+            current_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            current_loop = None
+        if self._loop is None or self._loop is current_loop or self._loop.is_closed():
+            return await self.reload()
+        future = asyncio.run_coroutine_threadsafe(self.reload(), self._loop)
+        return await asyncio.wrap_future(future)
+
+    def stop_watching(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def info(self) -> Dict[str, Any]:
+        """Текущая версия и кэш версий"""
+        return {
+            "version": self._current.version if self._current else None,
+            "loaded_at": self.loaded_at,
+            "cached_versions": list(self._versions),
+        }
@@ -0,0 +1,402 @@
+import os
+import json
+import time
+import base64
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import MongoClient
+from pymongo.errors import OperationFailure
+from dotenv import load_dotenv
+
+from metrics import MongoCommandMetrics
+
+# Загрузка переменных окружения
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Настройка MongoDB
+MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017")
+DB_NAME = os.getenv("DB_NAME", "test_database")
+
+# Параметры пула соединений и таймауты
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "10000"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000"))
+
+# Время жизни кэша точных подсчетов с фильтрами (секунды)
+COUNT_CACHE_TTL = float(os.getenv("COUNT_CACHE_TTL", "60"))
+
+# Сколько хранить выполненные отложенные задачи (часы); удаляет TTL-индекс по done_at
+DONE_JOBS_TTL_HOURS = int(os.getenv("DONE_JOBS_TTL_HOURS", "24"))
+
+# Пакетная отложенная запись пользователей и результатов (см. write_buffer.py)
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "0") == "1"
+
+# Один клиент с общим пулом соединений на весь процесс (и для бота, и для API).
+# Бот и FastAPI работают в разных event loop, поэтому вместо Motor, который
+# привязывается к одному loop, блокирующие вызовы PyMongo выполняются в пуле
+# потоков, а корутины ниже можно вызывать из любого loop.
+client = MongoClient(
+    MONGO_URL,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+    waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    event_listeners=[MongoCommandMetrics()],
+    connect=False
+)
+db = client[DB_NAME]
+users_collection = db.users
+test_results_collection = db.test_results
+media_cache_collection = db.media_cache
+scheduled_jobs_collection = db.scheduled_jobs
+quiz_states_collection = db.quiz_states
+
+# Поля, которые можно запрашивать через API
+USER_FIELDS = (
+    "user_id", "username", "first_name", "last_name",
+    "created_at", "test_completed", "last_test_score", "quiz_id", "last_quiz_id",
+)
+TEST_RESULT_FIELDS = (
+    "user_id", "test_id", "answers", "total_score",
+    "result_percentage", "result_title", "quiz_id", "quiz_version", "completed_at",
+)
+
+# Потоков не больше, чем соединений в пуле
+_executor = ThreadPoolExecutor(max_workers=MONGO_MAX_POOL_SIZE, thread_name_prefix="mongo")
+
+# Буфер отложенной записи; создается ботом при WRITE_BEHIND=1
+write_buffer = None
+
+# Подписчики на новые документы: callback(имя коллекции, документ).
+# Вызываются из потока бота; используются живой лентой без change streams (см. live.py)
+insert_listeners: List[Callable[[str, Dict[str, Any]], None]] = []
+
+
+async def run_sync(func, *args, **kwargs):
+    """Выполнение блокирующего вызова PyMongo в пуле потоков"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+async def ping():
+    """Проверка подключения к MongoDB"""
+    return await run_sync(db.command, 'ping')
+
+
+def start_write_behind():
+    """Запуск буфера отложенной записи в текущем event loop"""
+    global write_buffer
+    if not WRITE_BEHIND or (write_buffer is not None and write_buffer.running):
+        return
+    from write_buffer import WriteBehindBuffer
+    write_buffer = WriteBehindBuffer()
+    write_buffer.start()
+
+
+async def stop_write_behind():
+    """Сброс накопленных операций; можно вызывать из любого event loop"""
+    if write_buffer is not None:
+        await write_buffer.close_from_any_loop()
+
+
+def _buffered() -> bool:
+    return write_buffer is not None and write_buffer.running
+
+
+def answer_pairs(answers: List[Any]) -> List[Tuple[int, int]]:
+    """Пары (вопрос, вариант): компактный формат - индексы вариантов по порядку
+    вопросов, старый - словари с question_index и answer_index"""
+    return [
+        (answer["question_index"], answer["answer_index"]) if isinstance(answer, dict) else (index, answer)
+        for index, answer in enumerate(answers)
+    ]
+
+
+def _notify_insert(collection, document: Dict[str, Any]):
+    for listener in insert_listeners:
+        try:
+            listener(collection.name, document)
+        except Exception as e:
+            logger.error(f"Ошибка подписчика на новые документы: {e}")
+
+
+async def upsert_user(user_data: Dict[str, Any]):
+    """Создание или обновление пользователя"""
+    if _buffered():
+        # Новый пользователь виден подписчикам после записи пачки
+        await write_buffer.update(
+            users_collection, {"user_id": user_data["user_id"]}, {"$set": user_data}, upsert=True,
+            on_upsert=lambda: _notify_insert(users_collection, user_data)
+        )
+        return
+    result = await run_sync(
+        users_collection.update_one,
+        {"user_id": user_data["user_id"]},
+        {"$set": user_data},
+        upsert=True
+    )
+    if result.upserted_id is not None:
+        _notify_insert(users_collection, user_data)
+
+
+async def save_test_result(test_result: Dict[str, Any]):
+    """Сохранение результата теста"""
+    if _buffered():
+        await write_buffer.insert(test_results_collection, test_result)
+    else:
+        await run_sync(test_results_collection.insert_one, test_result)
+    _notify_insert(test_results_collection, test_result)
+
+
+async def mark_test_completed(user_id: str, total_score: int, quiz_id: Optional[str] = None):
+    """Отметка о прохождении теста пользователем"""
+    update = {"$set": {"test_completed": True, "last_test_score": total_score, "last_quiz_id": quiz_id}}
+    if _buffered():
+        await write_buffer.update(users_collection, {"user_id": user_id}, update)
+        return
+    await run_sync(users_collection.update_one, {"user_id": user_id}, update)
+
+
+async def get_last_test(user_id: str) -> Tuple[Optional[int], Optional[str]]:
+    """Баллы и идентификатор последнего пройденного теста пользователя"""
+    user = await run_sync(
+        users_collection.find_one, {"user_id": user_id}, {"last_test_score": 1, "last_quiz_id": 1}
+    )
+    if not user:
+        return None, None
+    return user.get("last_test_score"), user.get("last_quiz_id")
+
+
+async def count_users() -> int:
+    """Количество пользователей (по метаданным коллекции, без сканирования)"""
+    return await run_sync(users_collection.estimated_document_count)
+
+
+async def count_test_results() -> int:
+    """Количество результатов тестов (по метаданным коллекции, без сканирования)"""
+    return await run_sync(test_results_collection.estimated_document_count)
+
+
+# Кэш точных подсчетов с фильтром: filter_key -> (expires_at, count)
+_count_cache: Dict[str, Tuple[float, int]] = {}
+
+
+async def cached_count(collection, query: Dict[str, Any], ttl: float = COUNT_CACHE_TTL) -> int:
+    """Подсчет документов по фильтру с кэшированием на ttl секунд"""
+    key = f"{collection.name}:{json.dumps(query, sort_keys=True, default=str)}"
+    cached = _count_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    count = await run_sync(collection.count_documents, query)
+    _count_cache[key] = (time.monotonic() + ttl, count)
+    return count
+
+
+def encode_cursor(values: Dict[str, Any]) -> str:
+    """Курсор пагинации из значений ключа сортировки последнего документа"""
+    payload = {}
+    for key, value in values.items():
+        if isinstance(value, ObjectId):
+            payload[key] = {"$oid": str(value)}
+        elif isinstance(value, datetime):
+            payload[key] = {"$date": value.isoformat()}
+        else:
+            payload[key] = value
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, *required: str) -> Dict[str, Any]:
+    """Разбор курсора пагинации; ValueError, если курсор поврежден"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        values = {}
+        for key, value in payload.items():
+            if isinstance(value, dict) and "$oid" in value:
+                values[key] = ObjectId(value["$oid"])
+            elif isinstance(value, dict) and "$date" in value:
+                values[key] = datetime.fromisoformat(value["$date"])
+            else:
+                values[key] = value
+    except Exception:
+        raise ValueError("Некорректный курсор пагинации")
+    if any(key not in values for key in required):
+        raise ValueError("Некорректный курсор пагинации")
+    return values
+
+
+def _projection(fields: Optional[List[str]], allowed: Tuple[str, ...]) -> Dict[str, int]:
+    """Проекция по списку полей; _id нужен для курсора и убирается из ответа"""
+    if not fields:
+        fields = list(allowed)
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise ValueError(f"Неизвестные поля: {', '.join(unknown)}")
+    return {"_id": 1, **{field: 1 for field in fields}}
+
+
+def _date_range(field: str, date_from: Optional[datetime], date_to: Optional[datetime]) -> Dict[str, Any]:
+    condition = {}
+    if date_from:
+        condition["$gte"] = date_from
+    if date_to:
+        condition["$lt"] = date_to
+    return {field: condition} if condition else {}
+
+
+def _fetch_page(collection, query, projection, sort, limit):
+    documents = list(collection.find(query, projection).sort(sort).limit(limit + 1))
+    has_more = len(documents) > limit
+    return documents[:limit], has_more
+
+
+async def list_users(
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    fields: Optional[List[str]] = None,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    test_completed: Optional[bool] = None
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Страница пользователей (новые первыми) и курсор следующей страницы"""
+    conditions = [_date_range("created_at", created_from, created_to)]
+    if test_completed is not None:
+        conditions.append({"test_completed": test_completed})
+    if cursor:
+        conditions.append({"_id": {"$lt": decode_cursor(cursor, "id")["id"]}})
+    query = {"$and": [c for c in conditions if c]} if any(conditions) else {}
+
+    documents, has_more = await run_sync(
+        _fetch_page, users_collection, query, _projection(fields, USER_FIELDS), [("_id", -1)], limit
+    )
+    next_cursor = encode_cursor({"id": documents[-1]["_id"]}) if has_more else None
+    for document in documents:
+        del document["_id"]
+    return documents, next_cursor
+
+
+async def list_test_results(
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    fields: Optional[List[str]] = None,
+    completed_from: Optional[datetime] = None,
+    completed_to: Optional[datetime] = None,
+    min_score: Optional[int] = None,
+    max_score: Optional[int] = None,
+    user_id: Optional[str] = None
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Страница результатов тестов (новые первыми) и курсор следующей страницы"""
+    conditions = [_date_range("completed_at", completed_from, completed_to)]
+    score = {}
+    if min_score is not None:
+        score["$gte"] = min_score
+    if max_score is not None:
+        score["$lte"] = max_score
+    if score:
+        conditions.append({"total_score": score})
+    if user_id:
+        conditions.append({"user_id": user_id})
+    if cursor:
+        position = decode_cursor(cursor, "t", "id")
+        conditions.append({"$or": [
+            {"completed_at": {"$lt": position["t"]}},
+            {"completed_at": position["t"], "_id": {"$lt": position["id"]}}
+        ]})
+    query = {"$and": [c for c in conditions if c]} if any(conditions) else {}
+
+    projection = _projection(fields, TEST_RESULT_FIELDS)
+    # completed_at нужен для курсора, даже если его нет в выбранных полях
+    drop_completed_at = "completed_at" not in projection
+    projection["completed_at"] = 1
+
+    documents, has_more = await run_sync(
+        _fetch_page, test_results_collection, query, projection,
+        [("completed_at", -1), ("_id", -1)], limit
+    )
+    next_cursor = None
+    if has_more:
+        last = documents[-1]
+        next_cursor = encode_cursor({"t": last["completed_at"], "id": last["_id"]})
+    for document in documents:
+        del document["_id"]
+        if drop_completed_at:
+            document.pop("completed_at", None)
+    return documents, next_cursor
+
+
+async def ensure_indexes():
+    """Создание индексов для бота и API"""
+    await run_sync(scheduled_jobs_collection.create_index, [("status", 1), ("run_at", 1)])
+    # Задачи создаются на каждый /start: выполненные удаляются, чтобы коллекция не росла
+    await run_sync(
+        scheduled_jobs_collection.create_index, "done_at",
+        expireAfterSeconds=DONE_JOBS_TTL_HOURS * 3600, name="done_at_ttl"
+    )
+
+    try:
+        await run_sync(users_collection.create_index, "user_id", unique=True)
+    except OperationFailure as e:
+        # В старых данных могут быть дубликаты - индекс все равно нужен для поиска
+        logger.warning(f"Не удалось создать уникальный индекс users.user_id: {e}")
+        await run_sync(users_collection.create_index, "user_id", name="user_id_lookup")
+    await run_sync(users_collection.create_index, [("test_completed", 1), ("_id", -1)])
+    await run_sync(users_collection.create_index, [("created_at", -1)])
+
+    await run_sync(test_results_collection.create_index, "user_id")
+    await run_sync(test_results_collection.create_index, [("completed_at", -1), ("_id", -1)])
+    await run_sync(test_results_collection.create_index, [("total_score", 1), ("completed_at", -1)])
+
+
+async def schedule_job(
+    kind: str, chat_id: int, run_at: datetime, payload: Optional[Dict[str, Any]] = None
+) -> str:
+    """Сохранение отложенной задачи, чтобы она пережила перезапуск бота"""
+    result = await run_sync(
+        scheduled_jobs_collection.insert_one,
+        {
+            "kind": kind,
+            "chat_id": chat_id,
+            "run_at": run_at,
+            "payload": payload or {},
+            "status": "pending",
+            "created_at": datetime.utcnow()
+        }
+    )
+    return str(result.inserted_id)
+
+
+async def claim_job(job_id: str) -> bool:
+    """Атомарный захват задачи; False, если она уже выполнена"""
+    result = await run_sync(
+        scheduled_jobs_collection.update_one,
+        {"_id": ObjectId(job_id), "status": "pending"},
+        {"$set": {"status": "done", "done_at": datetime.utcnow()}}
+    )
+    return result.modified_count == 1
+
+
+async def pending_jobs() -> List[Dict[str, Any]]:
+    """Невыполненные отложенные задачи"""
+    return await run_sync(
+        lambda: list(scheduled_jobs_collection.find({"status": "pending"}).sort("run_at", 1))
+    )
+
+
+def close():
+    """Закрытие пула потоков и соединений с MongoDB"""
+    _executor.shutdown(wait=True)
+    client.close()
@@ -0,0 +1,284 @@
+"""Диспетчер обновлений для запуска бота в нескольких процессах.
+
+Диспетчер принимает вебхук Telegram и пересылает каждое обновление одному
+из воркеров (server.py с BOT_MODE=worker). Воркер выбирается по
+консистентному хэшу user_id, поэтому все нажатия одного пользователя
+обрабатываются одним воркером и строго по порядку. Состояние тестов
+воркеры хранят в MongoDB (STATE_BACKEND=mongo), так что при падении воркера
+его пользователей подхватывает следующий узел кольца.
+
+Запуск:
+    python dispatcher.py --workers 4
+"""
+import os
+import sys
+import time
+import hmac
+import asyncio
+import bisect
+import hashlib
+import logging
+import argparse
+import subprocess
+from typing import Any, Dict, Iterable, List, Optional
+
+import httpx
+from fastapi import FastAPI, HTTPException, Header, Request
+from dotenv import load_dotenv
+
+# Загрузка переменных окружения
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Адреса воркеров через запятую (если воркеры запускаются отдельно;
+# тогда им нужен RATE_LIMIT_PROCESSES по числу воркеров)
+SHARD_WORKER_URLS = os.getenv("SHARD_WORKER_URLS", "")
+# Ограничение одновременных пересылок на все воркеры
+SHARD_MAX_IN_FLIGHT = int(os.getenv("SHARD_MAX_IN_FLIGHT", "256"))
+# Сколько секунд не отправлять обновления на упавший воркер
+SHARD_WORKER_COOLDOWN = float(os.getenv("SHARD_WORKER_COOLDOWN", "10"))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+WORKER_PATH = "/api/telegram/webhook"
+
+# Поля обновления, в которых Telegram передает отправителя
+USER_FIELDS = (
+    "message", "edited_message", "callback_query", "inline_query",
+    "chosen_inline_result", "shipping_query", "pre_checkout_query",
+    "my_chat_member", "chat_member", "chat_join_request",
+)
+
+
+def extract_user_id(update: Dict[str, Any]) -> Optional[int]:
+    """user_id отправителя обновления или None"""
+    for field in USER_FIELDS:
+        payload = update.get(field)
+        if payload and "from" in payload:
+            return payload["from"]["id"]
+    return None
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Консистентное хэширование с виртуальными узлами"""
+
+    def __init__(self, nodes: Iterable[str], replicas: int = 100):
+        self.nodes = list(nodes)
+        if not self.nodes:
+            raise ValueError("Нужен хотя бы один воркер")
+        points = sorted(
+            (_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(replicas)
+        )
+        self._keys = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def get(self, key: str, exclude: Iterable[str] = ()) -> str:
+        """Узел для ключа; узлы из exclude пропускаются по часовой стрелке"""
+        excluded = set(exclude)
+        if len(excluded) >= len(self.nodes):
+            excluded = set()
+        index = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        for offset in range(len(self._keys)):
+            node = self._nodes[(index + offset) % len(self._keys)]
+            if node not in excluded:
+                return node
+        return self._nodes[index]
+
+
+class ShardDispatcher:
+    """Пересылка обновлений воркерам с сохранением порядка для каждого пользователя"""
+
+    def __init__(
+        self,
+        worker_urls: List[str],
+        secret_token: str,
+        max_in_flight: int = SHARD_MAX_IN_FLIGHT,
+        worker_cooldown: float = SHARD_WORKER_COOLDOWN,
+        max_attempts: int = 3,
+        client: Optional[httpx.AsyncClient] = None
+    ):
+        self.ring = HashRing(worker_urls)
+        self.secret_token = secret_token
+        self.worker_cooldown = worker_cooldown
+        self.max_attempts = max_attempts
+        self.client = client or httpx.AsyncClient(timeout=30)
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        # Очередь на пользователя; удаляется, когда опустеет
+        self._lanes: Dict[str, asyncio.Queue] = {}
+        self._lane_tasks: Dict[str, asyncio.Task] = {}
+        self._down_until: Dict[str, float] = {}
+        self.counters = {"received": 0, "forwarded": 0, "failed": 0, "rerouted": 0}
+
+    def _down_workers(self) -> List[str]:
+        now = time.monotonic()
+        return [url for url, until in self._down_until.items() if until > now]
+
+    def worker_for(self, key: str) -> str:
+        """Воркер, отвечающий за ключ (user_id)"""
+        return self.ring.get(key, exclude=self._down_workers())
+
+    async def dispatch(self, update: Dict[str, Any]):
+        """Постановка обновления в очередь пользователя"""
+        self.counters["received"] += 1
+        user_id = extract_user_id(update)
+        key = str(user_id) if user_id is not None else f"update:{update.get('update_id')}"
+
+        queue = self._lanes.get(key)
+        if queue is None:
+            queue = asyncio.Queue()
+            self._lanes[key] = queue
+            self._lane_tasks[key] = asyncio.create_task(self._run_lane(key, queue))
+        queue.put_nowait(update)
+
+    async def _run_lane(self, key: str, queue: asyncio.Queue):
+        try:
+            while not queue.empty():
+                update = queue.get_nowait()
+                await self._forward(key, update)
+        finally:
+            del self._lanes[key]
+            del self._lane_tasks[key]
+
+    async def _forward(self, key: str, update: Dict[str, Any]):
+        primary = self.ring.get(key)
+        for attempt in range(self.max_attempts):
+            worker = self.worker_for(key)
+            try:
+                async with self._semaphore:
+                    response = await self.client.post(
+                        worker + WORKER_PATH,
+                        json=update,
+                        headers={SECRET_HEADER: self.secret_token}
+                    )
+                response.raise_for_status()
+                self.counters["forwarded"] += 1
+                if worker != primary:
+                    self.counters["rerouted"] += 1
+                return
+            except httpx.HTTPError as e:
+                logger.warning(f"Воркер {worker} не обработал обновление {update.get('update_id')}: {e}")
+                if isinstance(e, httpx.TransportError):
+                    # Воркер недоступен - временно исключаем его из кольца
+                    self._down_until[worker] = time.monotonic() + self.worker_cooldown
+                await asyncio.sleep(0.1 * (2 ** attempt))
+
+        self.counters["failed"] += 1
+        logger.error(f"Обновление {update.get('update_id')} не доставлено ни одному воркеру")
+
+    async def drain(self):
+        """Ожидание отправки всех поставленных в очередь обновлений"""
+        while self._lane_tasks:
+            await asyncio.gather(*list(self._lane_tasks.values()), return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "active_lanes": len(self._lanes),
+            "workers": self.ring.nodes,
+            "down_workers": self._down_workers(),
+        }
+
+    async def close(self):
+        await self.drain()
+        await self.client.aclose()
+
+
+def create_app(dispatcher_factory) -> FastAPI:
+    """FastAPI-приложение диспетчера"""
+    app = FastAPI(title="Anna Hertz Telegram Bot Dispatcher")
+    state: Dict[str, ShardDispatcher] = {}
+
+    @app.on_event("startup")
+    async def startup_event():
+        state["dispatcher"] = dispatcher_factory()
+        if TELEGRAM_BOT_TOKEN and WEBHOOK_URL:
+            from telegram import Bot, Update
+            async with Bot(TELEGRAM_BOT_TOKEN) as bot:
+                await bot.set_webhook(
+                    url=WEBHOOK_URL,
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=Update.ALL_TYPES
+                )
+            logger.info(f"Вебхук установлен: {WEBHOOK_URL}")
+
+    @app.on_event("shutdown")
+    async def shutdown_event():
+        await state["dispatcher"].close()
+
+    @app.post(WORKER_PATH)
+    async def telegram_webhook(
+        request: Request,
+        x_telegram_bot_api_secret_token: Optional[str] = Header(None)
+    ):
+        """Прием обновлений от Telegram"""
+        if not hmac.compare_digest((x_telegram_bot_api_secret_token or "").encode(), WEBHOOK_SECRET.encode()):
+            raise HTTPException(status_code=403, detail="Неверный секрет вебхука")
+        await state["dispatcher"].dispatch(await request.json())
+        return {"ok": True}
+
+    @app.get("/api/dispatcher/status")
+    async def dispatcher_status():
+        """Состояние диспетчера и воркеров"""
+        return state["dispatcher"].stats()
+
+    return app
+
+
+def spawn_workers(count: int, base_port: int) -> List[subprocess.Popen]:
+    """Запуск воркеров server.py в отдельных процессах"""
+    # Общий лимит Telegram делится между воркерами (см. rate_limiter.py)
+    env = {**os.environ, "BOT_MODE": "worker", "STATE_BACKEND": "mongo", "RATE_LIMIT_PROCESSES": str(count)}
+    backend_dir = os.path.dirname(os.path.abspath(__file__))
+    return [
+        subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "server:app",
+             "--host", "127.0.0.1", "--port", str(base_port + i)],
+            cwd=backend_dir,
+            env=env
+        )
+        for i in range(count)
+    ]
+
+
+def main():
+    """Запуск диспетчера и воркеров"""
+    parser = argparse.ArgumentParser(description="Диспетчер обновлений для нескольких воркеров бота")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Сколько воркеров запустить (0 - использовать SHARD_WORKER_URLS)")
+    parser.add_argument("--base-port", type=int, default=8101)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8001)
+    args = parser.parse_args()
+
+    import uvicorn
+
+    if not WEBHOOK_SECRET:
+        raise SystemExit("Нужен WEBHOOK_SECRET")
+
+    processes = []
+    if args.workers > 0:
+        processes = spawn_workers(args.workers, args.base_port)
+        worker_urls = [f"http://127.0.0.1:{args.base_port + i}" for i in range(args.workers)]
+    else:
+        worker_urls = [url.strip() for url in SHARD_WORKER_URLS.split(",") if url.strip()]
+
+    app = create_app(lambda: ShardDispatcher(worker_urls, WEBHOOK_SECRET))
+    try:
+        uvicorn.run(app, host=args.host, port=args.port)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import io
+import csv
+import json
+import zlib
+import logging
+from datetime import datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+
+import database
+from database import run_sync
+
+logger = logging.getLogger(__name__)
+
+# Размер пачки, читаемой из курсора за один вызов
+EXPORT_BATCH_SIZE = 1000
+
+EXPORT_FORMATS = ("ndjson", "csv")
+
+# Колонки CSV; вложенные значения (answers) пишутся как JSON
+USER_COLUMNS = ("id",) + database.USER_FIELDS
+TEST_RESULT_COLUMNS = ("id",) + database.TEST_RESULT_FIELDS
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Тип {type(value)} не сериализуется")
+
+
+def _prepare(document: Dict[str, Any]) -> Dict[str, Any]:
+    """_id в строковое поле id - по нему продолжается инкрементальная выгрузка"""
+    document["id"] = str(document.pop("_id"))
+    return document
+
+
+class _CursorReader:
+    """Пачечное чтение серверного курсора в пуле потоков MongoDB"""
+
+    def __init__(self, collection, query: Dict[str, Any], sort: List[Tuple[str, int]]):
+        self.cursor = collection.find(query, batch_size=EXPORT_BATCH_SIZE).sort(sort)
+
+    def next_batch(self) -> List[Dict[str, Any]]:
+        batch = []
+        for document in self.cursor:
+            batch.append(document)
+            if len(batch) >= EXPORT_BATCH_SIZE:
+                break
+        return batch
+
+    def close(self):
+        self.cursor.close()
+
+
+async def iter_batches(
+    collection,
+    query: Dict[str, Any],
+    sort: List[Tuple[str, int]],
+    transform: Optional[Callable[[List[Dict[str, Any]]], Awaitable[List[Dict[str, Any]]]]] = None
+) -> AsyncIterator[List[Dict[str, Any]]]:
+    """Асинхронный обход курсора пачками; в памяти не больше одной пачки"""
+    reader = _CursorReader(collection, query, sort)
+    try:
+        while True:
+            batch = await run_sync(reader.next_batch)
+            if not batch:
+                return
+            batch = [_prepare(document) for document in batch]
+            yield await transform(batch) if transform is not None else batch
+    finally:
+        await run_sync(reader.close)
+
+
+def export_query(
+    time_field: str,
+    since: Optional[datetime] = None,
+    after_id: Optional[str] = None
+) -> Tuple[Dict[str, Any], List[Tuple[str, int]]]:
+    """Фильтр и сортировка для выгрузки с водяным знаком.
+
+    since - выгрузить документы с time_field >= since (по времени),
+    after_id - выгрузить документы с _id > after_id (по последней строке
+    предыдущей выгрузки). Сортировка совпадает с водяным знаком, чтобы
+    следующий запуск продолжил с последней выгруженной строки.
+    """
+    if after_id:
+        try:
+            return {"_id": {"$gt": ObjectId(after_id)}}, [("_id", 1)]
+        except Exception:
+            raise ValueError("Некорректный after_id")
+    if since:
+        return {time_field: {"$gte": since}}, [(time_field, 1), ("_id", 1)]
+    return {}, [("_id", 1)]
+
+
+async def ndjson_chunks(batches: AsyncIterator[List[Dict[str, Any]]]) -> AsyncIterator[bytes]:
+    """Пачки документов в NDJSON, один фрагмент ответа на пачку"""
+    async for batch in batches:
+        yield "".join(
+            json.dumps(document, ensure_ascii=False, default=_json_default) + "\n" for document in batch
+        ).encode()
+
+
+def _csv_value(value):
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False, default=_json_default)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+async def csv_chunks(batches: AsyncIterator[List[Dict[str, Any]]], columns: Tuple[str, ...]) -> AsyncIterator[bytes]:
+    """Пачки документов в CSV с заголовком, один фрагмент ответа на пачку"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction="ignore")
+    writer.writeheader()
+    yield buffer.getvalue().encode()
+    async for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(
+            {key: _csv_value(value) for key, value in document.items()} for document in batch
+        )
+        yield buffer.getvalue().encode()
+
+
+async def gzip_stream(chunks: AsyncIterator[bytes], flush_every: int = 64 * 1024) -> AsyncIterator[bytes]:
+    """Потоковое gzip-сжатие"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    pending = 0
+    async for chunk in chunks:
+        pending += len(chunk)
+        data = compressor.compress(chunk)
+        if pending >= flush_every:
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_filename(name: str, fmt: str, gzip: bool) -> str:
+    """Имя файла выгрузки с датой"""
+    suffix = ".gz" if gzip else ""
+    return f"{name}-{datetime.utcnow():%Y%m%dT%H%M%S}.{fmt}{suffix}"
+
+
+def export_stream(
+    collection,
+    columns: Tuple[str, ...],
+    time_field: str,
+    fmt: str = "ndjson",
+    gzip: bool = False,
+    since: Optional[datetime] = None,
+    after_id: Optional[str] = None,
+    transform: Optional[Callable[[List[Dict[str, Any]]], Awaitable[List[Dict[str, Any]]]]] = None
+) -> Tuple[AsyncIterator[bytes], str]:
+    """Поток байтов выгрузки и его media type; transform - обработка каждой пачки"""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Формат должен быть одним из: {', '.join(EXPORT_FORMATS)}")
+    query, sort = export_query(time_field, since, after_id)
+    batches = iter_batches(collection, query, sort, transform)
+
+    if fmt == "csv":
+        stream, media_type = csv_chunks(batches, columns), "text/csv; charset=utf-8"
+    else:
+        stream, media_type = ndjson_chunks(batches), "application/x-ndjson"
+    if gzip:
+        stream, media_type = gzip_stream(stream), "application/gzip"
+    return stream, media_type
@@ -0,0 +1,116 @@
+"""Локальная имитация Telegram Bot API для нагрузочных тестов.
+
+Отвечает на методы, которые вызывает бот (getMe, sendMessage, sendPhoto,
+sendDocument, editMessageText, answerCallbackQuery, getChatMember,
+setWebhook и др.), правдоподобными ответами с настраиваемой задержкой.
+Бот направляется сюда переменной TELEGRAM_API_BASE_URL.
+
+Настройки (переменные окружения):
+    FAKE_API_LATENCY_MS       - задержка ответа, мс
+    FAKE_API_JITTER_MS        - случайная добавка к задержке, мс
+    FAKE_API_RETRY_AFTER_RATE - доля ответов 429 с retry_after (0..1)
+
+Пример:
+    FAKE_API_LATENCY_MS=50 uvicorn fake_bot_api:app --port 8081
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import itertools
+from collections import Counter
+from email import policy
+from email.parser import BytesParser
+from typing import Any, Dict
+from urllib.parse import parse_qsl
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+FAKE_API_LATENCY_MS = float(os.getenv("FAKE_API_LATENCY_MS", "30"))
+FAKE_API_JITTER_MS = float(os.getenv("FAKE_API_JITTER_MS", "10"))
+FAKE_API_RETRY_AFTER_RATE = float(os.getenv("FAKE_API_RETRY_AFTER_RATE", "0"))
+
+BOT_USER = {
+    "id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot",
+    "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False,
+}
+
+app = FastAPI(title="Fake Telegram Bot API")
+_calls: Counter = Counter()
+_message_ids = itertools.count(1000)
+_file_ids = itertools.count(1)
+
+
+async def _parse_body(request: Request) -> Dict[str, Any]:
+    """Параметры запроса: форма, multipart (загрузка файла) или JSON"""
+    body = await request.body()
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        message = BytesParser(policy=policy.HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        params = {}
+        for part in message.iter_parts():
+            if part.get_filename() is None:
+                params[part.get_param("name", header="content-disposition")] = part.get_payload(decode=True).decode()
+        return params
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    return dict(parse_qsl(body.decode()))
+
+
+def _chat(params: Dict[str, Any]) -> Dict[str, Any]:
+    chat_id = int(params.get("chat_id", 0) or 0)
+    return {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}
+
+
+def _message(params: Dict[str, Any], **extra) -> Dict[str, Any]:
+    message_id = int(params.get("message_id") or next(_message_ids))
+    return {"message_id": message_id, "date": int(time.time()), "chat": _chat(params), "from": BOT_USER, **extra}
+
+
+def _file(prefix: str) -> Dict[str, Any]:
+    number = next(_file_ids)
+    return {"file_id": f"{prefix}-{number}", "file_unique_id": f"u{prefix}-{number}"}
+
+
+def _result(method: str, params: Dict[str, Any]):
+    if method == "getme":
+        return BOT_USER
+    if method in ("sendmessage", "editmessagetext"):
+        return _message(params, text=params.get("text", ""))
+    if method == "sendphoto":
+        return _message(params, photo=[{**_file("photo"), "width": 800, "height": 800}],
+                        caption=params.get("caption"))
+    if method == "senddocument":
+        return _message(params, document=_file("document"), caption=params.get("caption"))
+    if method == "getchatmember":
+        return {
+            "status": "member",
+            "user": {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "Test"},
+        }
+    if method == "getupdates":
+        return []
+    # answerCallbackQuery, setWebhook, deleteWebhook и прочие - просто True
+    return True
+
+
+@app.post("/bot{token}/{method}")
+async def bot_api_method(token: str, method: str, request: Request):
+    params = await _parse_body(request)
+    _calls[method] += 1
+    await asyncio.sleep((FAKE_API_LATENCY_MS + random.uniform(0, FAKE_API_JITTER_MS)) / 1000)
+
+    if FAKE_API_RETRY_AFTER_RATE and random.random() < FAKE_API_RETRY_AFTER_RATE:
+        _calls["429"] += 1
+        return JSONResponse(status_code=429, content={
+            "ok": False, "error_code": 429,
+            "description": "Too Many Requests: retry after 1", "parameters": {"retry_after": 1},
+        })
+    return {"ok": True, "result": _result(method.lower(), params)}
+
+
+@app.get("/stats")
+async def fake_api_stats():
+    """Число вызовов по методам"""
+    return dict(_calls)
@@ -0,0 +1,113 @@
+"""Локальный отправитель обновлений, имитирующий Telegram.
+
+Строит обновления в формате Bot API (команда /start, нажатия inline-кнопок)
+и отправляет их на вебхук сервера с секретным заголовком, как это делает
+Telegram. Используется для проверки режима вебхука без реального бота.
+
+Пример:
+    python fake_telegram.py --url http://localhost:8001/api/telegram/webhook \\
+        --secret my-secret --user-id 1001 start
+"""
+import time
+import asyncio
+import argparse
+import itertools
+from typing import Any, Dict, Optional
+
+import httpx
+
+import callbacks
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class FakeTelegramSender:
+    """Отправка синтетических обновлений на вебхук бота"""
+
+    def __init__(self, webhook_url: str, secret_token: str, first_update_id: int = 1):
+        self.webhook_url = webhook_url
+        self.secret_token = secret_token
+        self._update_ids = itertools.count(first_update_id)
+        self._message_ids = itertools.count(1)
+
+    @staticmethod
+    def user(user_id: int, first_name: str = "Test", username: Optional[str] = None) -> Dict[str, Any]:
+        return {
+            "id": user_id,
+            "is_bot": False,
+            "first_name": first_name,
+            "username": username or f"user{user_id}",
+        }
+
+    @staticmethod
+    def private_chat(user_id: int) -> Dict[str, Any]:
+        return {"id": user_id, "type": "private"}
+
+    def message_update(self, user_id: int, text: str) -> Dict[str, Any]:
+        """Обновление с текстовым сообщением от пользователя"""
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": self.private_chat(user_id),
+            "from": self.user(user_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def start_update(self, user_id: int, payload: str = "") -> Dict[str, Any]:
+        """Обновление с командой /start"""
+        return self.message_update(user_id, f"/start {payload}".strip())
+
+    def callback_update(self, user_id: int, data: str, message_id: int = 1) -> Dict[str, Any]:
+        """Обновление с нажатием inline-кнопки"""
+        update_id = next(self._update_ids)
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": f"cb{update_id}",
+                "from": self.user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": self.private_chat(user_id),
+                    "from": {"id": 1, "is_bot": True, "first_name": "Bot", "username": "bot"},
+                    "text": "",
+                },
+            },
+        }
+
+    async def send(self, update: Dict[str, Any], client: Optional[httpx.AsyncClient] = None) -> httpx.Response:
+        """Отправка обновления на вебхук"""
+        headers = {SECRET_HEADER: self.secret_token}
+        if client is not None:
+            return await client.post(self.webhook_url, json=update, headers=headers)
+        async with httpx.AsyncClient() as own_client:
+            return await own_client.post(self.webhook_url, json=update, headers=headers)
+
+
+async def _main(args):
+    sender = FakeTelegramSender(args.url, args.secret)
+    if args.action == "start":
+        update = sender.start_update(args.user_id, args.payload)
+    else:
+        # Без --data - подписанная кнопка проверки подписки (нужен тот же CALLBACK_SECRET, что у бота)
+        data = args.data or callbacks.encode(callbacks.ACTION_CHECK_SUBSCRIPTION)
+        update = sender.callback_update(args.user_id, data)
+    response = await sender.send(update)
+    print(response.status_code, response.text)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Отправка тестового обновления на вебхук бота")
+    parser.add_argument("--url", default="http://localhost:8001/api/telegram/webhook")
+    parser.add_argument("--secret", required=True)
+    parser.add_argument("--user-id", type=int, default=1001)
+    parser.add_argument("--payload", default="", help="Параметр deep-link для /start")
+    parser.add_argument("--data", default="", help="callback_data для action=callback")
+    parser.add_argument("action", choices=["start", "callback"])
+    asyncio.run(_main(parser.parse_args()))
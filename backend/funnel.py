@@ -0,0 +1,277 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+import database
+import metrics
+from database import run_sync
+
+logger = logging.getLogger(__name__)
+
+# Сколько хранить события воронки (дни)
+FUNNEL_TTL_DAYS = int(os.getenv("FUNNEL_TTL_DAYS", "90"))
+# Буфер событий: размер (при переполнении теряются самые старые), пачка и период сброса
+FUNNEL_BUFFER_SIZE = int(os.getenv("FUNNEL_BUFFER_SIZE", "50000"))
+FUNNEL_BATCH_SIZE = int(os.getenv("FUNNEL_BATCH_SIZE", "1000"))
+FUNNEL_FLUSH_INTERVAL = float(os.getenv("FUNNEL_FLUSH_INTERVAL", "2"))
+# Наибольшее окно /api/funnel (дни) и время жизни кэша ответа (секунды)
+FUNNEL_MAX_WINDOW_DAYS = int(os.getenv("FUNNEL_MAX_WINDOW_DAYS", "31"))
+FUNNEL_CACHE_TTL = float(os.getenv("FUNNEL_CACHE_TTL", "30"))
+
+FUNNEL_COLLECTION = "funnel_events"
+
+events_collection = database.db[FUNNEL_COLLECTION]
+
+# Кэш ответов: ключ запроса -> (expires_at, funnel)
+_cache: Dict[Tuple, Tuple[float, Dict[str, Any]]] = {}
+
+
+async def ensure_collection():
+    """Создание time-series коллекции событий с TTL и индексов.
+
+    На MongoDB без time-series коллекций (или в mongomock) события пишутся
+    в обычную коллекцию с TTL-индексом по времени.
+    """
+    ttl = FUNNEL_TTL_DAYS * 86400
+    try:
+        existing = await run_sync(lambda: list(database.db.list_collections(filter={"name": FUNNEL_COLLECTION})))
+    except NotImplementedError:
+        # mongomock: только обычные коллекции
+        existing = [{"options": {}}]
+    if not existing:
+        try:
+            await run_sync(
+                database.db.create_collection,
+                FUNNEL_COLLECTION,
+                timeseries={"timeField": "ts", "metaField": "meta", "granularity": "seconds"},
+                expireAfterSeconds=ttl
+            )
+            existing = [{"options": {"timeseries": True}}]
+        except (OperationFailure, NotImplementedError) as e:
+            logger.warning(f"Time-series коллекция недоступна ({e}), события пишутся в обычную коллекцию")
+            existing = [{"options": {}}]
+
+    if existing[0].get("options", {}).get("timeseries"):
+        try:
+            # Срок хранения мог измениться с прошлого запуска
+            await run_sync(database.db.command, "collMod", FUNNEL_COLLECTION, expireAfterSeconds=ttl)
+        except OperationFailure as e:
+            logger.warning(f"Не удалось обновить срок хранения событий воронки: {e}")
+    else:
+        await run_sync(events_collection.create_index, "ts", expireAfterSeconds=ttl, name="ts_ttl")
+    # Запросы /api/funnel всегда ограничены окном по времени
+    await run_sync(events_collection.create_index, [("meta.quiz_id", 1), ("ts", 1)])
+
+
+class FunnelEmitter:
+    """Неблокирующая запись шагов воронки.
+
+    emit() только добавляет событие в ограниченный deque и не ждет
+    MongoDB; фоновая задача сбрасывает события пачками через insert_many.
+    При переполнении буфера (MongoDB недоступна) теряются самые старые
+    события - воронка приблизительна, обработчики важнее.
+    """
+
+    def __init__(
+        self,
+        buffer_size: int = FUNNEL_BUFFER_SIZE,
+        batch_size: int = FUNNEL_BATCH_SIZE,
+        flush_interval: float = FUNNEL_FLUSH_INTERVAL
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer: deque = deque(maxlen=buffer_size)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._metrics = {"emitted": 0, "written": 0, "dropped": 0, "failed_flushes": 0}
+
+    def emit(self, step: str, user_id: int, quiz_id: Optional[str] = None):
+        """Событие шага воронки"""
+        if len(self._buffer) == self._buffer.maxlen:
+            self._metrics["dropped"] += 1
+            metrics.FUNNEL_EVENTS_DROPPED.inc()
+        self._buffer.append({
+            "ts": datetime.utcnow(),
+            "meta": {"step": step, "quiz_id": quiz_id},
+            "user_id": int(user_id),
+        })
+        self._metrics["emitted"] += 1
+        if self._wakeup is not None and len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self):
+        """Запуск фонового сброса в текущем event loop"""
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Остановка с записью оставшихся событий"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self._buffer and await self.flush():
+            pass
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            while self._buffer and await self.flush() and len(self._buffer) >= self.batch_size:
+                pass
+
+    async def flush(self) -> bool:
+        """Запись одной пачки; False, если MongoDB не приняла ее"""
+        batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+        if not batch:
+            return True
+        try:
+            await run_sync(events_collection.insert_many, batch, ordered=False)
+        except PyMongoError as e:
+            # Пачка возвращается в начало буфера и уйдет со следующим сбросом
+            self._metrics["failed_flushes"] += 1
+            self._buffer.extendleft(reversed(batch))
+            logger.error(f"Не удалось записать события воронки: {e}")
+            return False
+        self._metrics["written"] += len(batch)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._metrics, "buffered": len(self._buffer)}
+
+
+def step_order(steps) -> List[str]:
+    """Шаги воронки по порядку: фиксированные, затем вопросы по номеру, затем финальные"""
+    answers = sorted(
+        (step for step in steps if step.startswith("answer_")), key=lambda step: int(step.split("_")[1])
+    )
+    head = [metrics.STEP_START, metrics.STEP_SUBSCRIPTION_CHECK, metrics.STEP_SUBSCRIBED, metrics.STEP_TEST_STARTED]
+    return head + answers + [metrics.STEP_TEST_FINISHED, metrics.STEP_DIET_SENT]
+
+
+def _steps_pipeline(match: Dict[str, Any], order: List[str], with_median: bool) -> List[Dict[str, Any]]:
+    """Подсчет в MongoDB: сколько пользователей дошло до каждого шага и время от предыдущего шага.
+
+    В Python возвращается один документ с итогами, а не пользователи окна.
+    """
+    reached: Dict[str, Any] = {}
+    durations: Dict[str, Any] = {}
+    for index, step in enumerate(order):
+        current = f"$steps.{step}"
+        reached[f"r{index}"] = {"$cond": [{"$ifNull": [current, False]}, 1, 0]}
+        if index:
+            previous = f"$steps.{order[index - 1]}"
+            durations[f"d{index}"] = {"$cond": [
+                {"$and": [{"$ifNull": [current, False]}, {"$ifNull": [previous, False]},
+                          {"$gte": [current, previous]}]},
+                {"$divide": [{"$subtract": [current, previous]}, 1000]},
+                None,
+            ]}
+    totals: Dict[str, Any] = {"_id": None, "users": {"$sum": 1}}
+    for field in reached:
+        totals[field] = {"$sum": f"${field}"}
+    for field in durations:
+        totals[f"mean_{field}"] = {"$avg": f"${field}"}
+        if with_median:
+            totals[f"median_{field}"] = {"$median": {"input": f"${field}", "method": "approximate"}}
+    return [
+        {"$match": match},
+        # Время первого достижения каждого шага каждым пользователем
+        {"$group": {"_id": {"user": "$user_id", "step": "$meta.step"}, "ts": {"$min": "$ts"}}},
+        {"$group": {"_id": "$_id.user", "steps": {"$push": {"k": "$_id.step", "v": "$ts"}}}},
+        {"$project": {"steps": {"$arrayToObject": "$steps"}}},
+        {"$project": {**reached, **durations}},
+        {"$group": totals},
+    ]
+
+
+# $median есть только в MongoDB 7.0+; без него медианы не считаются
+_median_supported = True
+
+
+def _count_steps(match: Dict[str, Any]) -> Tuple[int, List[Dict[str, Any]]]:
+    """Число пользователей окна и шаги воронки с конверсией и временем между шагами"""
+    global _median_supported
+    order = step_order(events_collection.distinct("meta.step", match))
+    totals = None
+    if _median_supported:
+        try:
+            totals = next(events_collection.aggregate(_steps_pipeline(match, order, True), allowDiskUse=True), None)
+        except (OperationFailure, NotImplementedError) as e:
+            logger.warning(f"$median недоступен ({e}), медианы воронки не считаются")
+            _median_supported = False
+    if not _median_supported:
+        totals = next(events_collection.aggregate(_steps_pipeline(match, order, False), allowDiskUse=True), None)
+    totals = totals or {}
+
+    def rounded(value):
+        return round(value, 1) if value is not None else None
+
+    first = totals.get("r0", 0)
+    steps = []
+    for index, step in enumerate(order):
+        users_count = totals.get(f"r{index}", 0)
+        previous_count = totals.get(f"r{index - 1}", 0) if index else users_count
+        steps.append({
+            "step": step,
+            "users": users_count,
+            "conversion_from_previous": round(users_count / previous_count, 4) if previous_count else None,
+            "conversion_from_start": round(users_count / first, 4) if first else None,
+            "median_seconds_from_previous": rounded(totals.get(f"median_d{index}")),
+            "mean_seconds_from_previous": rounded(totals.get(f"mean_d{index}")),
+        })
+    return totals.get("users", 0), steps
+
+
+def _naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Время с часовым поясом в UTC без пояса, как ts событий"""
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+async def get_funnel(
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    quiz_id: Optional[str] = None
+) -> Dict[str, Any]:
+    """Конверсия и время между шагами для пользователей с событиями в окне [date_from, date_to)"""
+    date_to = _naive_utc(date_to) or datetime.utcnow()
+    date_from = _naive_utc(date_from) or date_to - timedelta(days=1)
+    if date_from >= date_to:
+        raise ValueError("Начало окна должно быть раньше конца")
+    if date_to - date_from > timedelta(days=FUNNEL_MAX_WINDOW_DAYS):
+        raise ValueError(f"Окно не больше {FUNNEL_MAX_WINDOW_DAYS} дней")
+
+    key = (date_from.replace(second=0, microsecond=0), date_to.replace(second=0, microsecond=0), quiz_id)
+    cached = _cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    match: Dict[str, Any] = {"ts": {"$gte": date_from, "$lt": date_to}}
+    if quiz_id is not None:
+        match["meta.quiz_id"] = quiz_id
+    users, steps = await run_sync(_count_steps, match)
+    funnel = {
+        "from": date_from,
+        "to": date_to,
+        "quiz_id": quiz_id,
+        "users": users,
+        "steps": steps,
+    }
+    _cache[key] = (time.monotonic() + FUNNEL_CACHE_TTL, funnel)
+    if len(_cache) > 100:
+        _cache.pop(next(iter(_cache)))
+    return funnel
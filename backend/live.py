@@ -0,0 +1,293 @@
+import os
+import json
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Set
+
+from pymongo.errors import PyMongoError
+
+import database
+import metrics
+from database import run_sync
+
+logger = logging.getLogger(__name__)
+
+# Источник событий: auto (change stream, а без replica set - события процесса),
+# changestream (только change stream) или local (только события процесса)
+LIVE_SOURCE = os.getenv("LIVE_SOURCE", "auto")
+# Очередь событий одного клиента; у медленного клиента теряются самые старые
+LIVE_CLIENT_QUEUE = int(os.getenv("LIVE_CLIENT_QUEUE", "100"))
+LIVE_MAX_CLIENTS = int(os.getenv("LIVE_MAX_CLIENTS", "100"))
+# Период пустых сообщений, по которым обнаруживается отключение клиента (секунды)
+LIVE_HEARTBEAT = float(os.getenv("LIVE_HEARTBEAT", "15"))
+# Период сверки счетчиков с MongoDB (секунды): учитывает удаления и
+# записи, которых не видно в событиях процесса
+LIVE_COUNTS_RESYNC = float(os.getenv("LIVE_COUNTS_RESYNC", "60"))
+
+SOURCE_AUTO = "auto"
+SOURCE_CHANGE_STREAM = "changestream"
+SOURCE_LOCAL = "local"
+
+EVENT_USER = "user"
+EVENT_TEST_RESULT = "test_result"
+EVENT_COUNTERS = "counters"
+
+# Коллекция -> (тип события, счетчик, поля в событии)
+_COLLECTIONS = {
+    database.users_collection.name: (
+        EVENT_USER, "users", ("user_id", "username", "first_name", "quiz_id", "created_at")
+    ),
+    database.test_results_collection.name: (
+        EVENT_TEST_RESULT, "test_results",
+        ("user_id", "total_score", "result_percentage", "result_title", "quiz_id", "completed_at")
+    ),
+}
+
+# Ожидание следующего изменения в потоке наблюдателя (мс): столько же ждет остановка
+_AWAIT_MS = 1000
+# Пауза перед переоткрытием курсора после ошибки (секунды)
+_RETRY_DELAY = 5
+
+
+class LiveFeedFull(Exception):
+    """Достигнут LIVE_MAX_CLIENTS"""
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _change_pipeline():
+    """Только вставки в users и test_results и только поля, попадающие в события"""
+    fields = {f"fullDocument.{field}": 1 for _, _, names in _COLLECTIONS.values() for field in names}
+    return [
+        {"$match": {"operationType": "insert", "ns.coll": {"$in": list(_COLLECTIONS)}}},
+        {"$project": {"ns.coll": 1, **fields}},
+    ]
+
+
+def _open_stream(resume_token: Optional[Dict[str, Any]] = None):
+    return database.db.watch(_change_pipeline(), max_await_time_ms=_AWAIT_MS, resume_after=resume_token)
+
+
+class ChangeStreamWatcher:
+    """Один курсор change stream по базе в отдельном потоке.
+
+    Курсор открывается при старте (здесь же выясняется, поддерживает ли
+    MongoDB change streams), а при ошибках переоткрывается с последнего
+    resume token, поэтому вставки за время переподключения не теряются.
+    """
+
+    def __init__(self, on_insert: Callable[[str, Dict[str, Any]], None]):
+        self.on_insert = on_insert
+        self._stream = None
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    async def start(self):
+        """Открытие курсора; ошибка, если change streams недоступны"""
+        self._stream = await run_sync(_open_stream)
+        self._thread = threading.Thread(target=self._run, name="live-change-stream", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Остановка: поток завершится после текущего ожидания курсора"""
+        self._stopping.set()
+
+    def _run(self):
+        stream = self._stream
+        resume_token = stream.resume_token
+        while not self._stopping.is_set():
+            try:
+                if stream is None:
+                    stream = _open_stream(resume_token)
+                change = stream.try_next()
+                # Токен сдвигается и без изменений - переоткрытие не вернет старые события
+                resume_token = stream.resume_token
+                if change is not None:
+                    self.on_insert(change["ns"]["coll"], change.get("fullDocument", {}))
+            except PyMongoError as e:
+                logger.error(f"Ошибка change stream живой ленты: {e}")
+                if stream is not None:
+                    stream.close()
+                stream = None
+                self._stopping.wait(_RETRY_DELAY)
+        if stream is not None:
+            stream.close()
+
+
+class LiveFeed:
+    """Живая лента для панели: новые пользователи, результаты тестов и счетчики.
+
+    Все клиенты получают события из одного источника: одного курсора
+    change stream (или подписки на записи этого процесса, если MongoDB
+    без replica set), поэтому N открытых панелей стоят один курсор, а не
+    N опросов count_documents. Источник запускается с первым клиентом и
+    останавливается с последним. События из других потоков передаются в
+    event loop ленты через call_soon_threadsafe.
+    """
+
+    def __init__(
+        self,
+        source: str = LIVE_SOURCE,
+        queue_size: int = LIVE_CLIENT_QUEUE,
+        max_clients: int = LIVE_MAX_CLIENTS
+    ):
+        if source not in (SOURCE_AUTO, SOURCE_CHANGE_STREAM, SOURCE_LOCAL):
+            raise ValueError(f"Неизвестный источник живой ленты: {source}")
+        self.source = source
+        self.queue_size = queue_size
+        self.max_clients = max_clients
+        self.active_source: Optional[str] = None
+        self._clients: Set[asyncio.Queue] = set()
+        self._counters = {"users": 0, "test_results": 0}
+        self._sequence = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = asyncio.Lock()
+        self._watcher: Optional[ChangeStreamWatcher] = None
+        self._resync_task: Optional[asyncio.Task] = None
+        self._metrics = {"events": 0, "dropped": 0}
+
+    async def _load_counters(self):
+        users = await run_sync(database.users_collection.estimated_document_count)
+        test_results = await run_sync(database.test_results_collection.estimated_document_count)
+        return {"users": users, "test_results": test_results}
+
+    async def _start(self):
+        self._loop = asyncio.get_running_loop()
+        self._counters = await self._load_counters()
+        if self.source != SOURCE_LOCAL:
+            watcher = ChangeStreamWatcher(self._insert_threadsafe)
+            try:
+                await watcher.start()
+                self._watcher = watcher
+                self.active_source = SOURCE_CHANGE_STREAM
+            except PyMongoError as e:
+                # Standalone MongoDB: $changeStream только на replica set / sharded cluster
+                if self.source == SOURCE_CHANGE_STREAM:
+                    raise
+                logger.warning(f"Change streams недоступны ({e}), живая лента берет события процесса")
+        if self._watcher is None:
+            database.insert_listeners.append(self._insert_threadsafe)
+            self.active_source = SOURCE_LOCAL
+        self._resync_task = self._loop.create_task(self._resync_counters())
+        logger.info(f"Живая лента запущена, источник: {self.active_source}")
+
+    async def _stop(self):
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+        if self._insert_threadsafe in database.insert_listeners:
+            database.insert_listeners.remove(self._insert_threadsafe)
+        if self._resync_task is not None:
+            self._resync_task.cancel()
+            self._resync_task = None
+        self.active_source = None
+
+    async def _stop_if_idle(self):
+        async with self._lock:
+            if not self._clients and self.active_source is not None:
+                await self._stop()
+                logger.info("Живая лента остановлена: нет клиентов")
+
+    async def close(self):
+        """Остановка источника (при остановке сервера)"""
+        async with self._lock:
+            self._clients.clear()
+            await self._stop()
+
+    async def subscribe(self) -> asyncio.Queue:
+        """Очередь событий нового клиента; первым событием идут текущие счетчики"""
+        async with self._lock:
+            if len(self._clients) >= self.max_clients:
+                raise LiveFeedFull()
+            if self.active_source is None:
+                await self._start()
+            queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+            queue.put_nowait(self._event(EVENT_COUNTERS, {}))
+            self._clients.add(queue)
+            metrics.LIVE_CLIENTS.set(len(self._clients))
+            return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        """Отключение клиента; без ожиданий, чтобы работать и при отмене ответа"""
+        self._clients.discard(queue)
+        metrics.LIVE_CLIENTS.set(len(self._clients))
+        if not self._clients and self._loop is not None:
+            self._loop.create_task(self._stop_if_idle())
+
+    def _event(self, kind: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        self._sequence += 1
+        return {"id": self._sequence, "event": kind, "data": {**data, "counters": dict(self._counters)}}
+
+    def _insert_threadsafe(self, collection_name: str, document: Dict[str, Any]):
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._insert, collection_name, document)
+
+    def _insert(self, collection_name: str, document: Dict[str, Any]):
+        described = _COLLECTIONS.get(collection_name)
+        if described is None:
+            return
+        kind, counter, fields = described
+        self._counters[counter] += 1
+        self._publish(self._event(kind, {field: document.get(field) for field in fields}))
+
+    def _publish(self, event: Dict[str, Any]):
+        self._metrics["events"] += 1
+        for queue in self._clients:
+            if queue.full():
+                queue.get_nowait()
+                self._metrics["dropped"] += 1
+            queue.put_nowait(event)
+
+    async def _resync_counters(self):
+        while True:
+            await asyncio.sleep(LIVE_COUNTS_RESYNC)
+            try:
+                counters = await self._load_counters()
+            except PyMongoError as e:
+                logger.error(f"Не удалось сверить счетчики живой ленты: {e}")
+                continue
+            if counters != self._counters:
+                self._counters = counters
+                self._publish(self._event(EVENT_COUNTERS, {}))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "source": self.active_source,
+            "clients": len(self._clients),
+            "counters": dict(self._counters),
+            **self._metrics,
+        }
+
+
+def format_event(event: Dict[str, Any]) -> str:
+    """Событие в формате text/event-stream"""
+    data = json.dumps(event["data"], ensure_ascii=False, default=_json_default)
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {data}\n\n"
+
+
+async def sse_stream(
+    feed: LiveFeed,
+    queue: asyncio.Queue,
+    is_disconnected: Callable[[], Awaitable[bool]],
+    heartbeat: float = LIVE_HEARTBEAT
+) -> AsyncIterator[str]:
+    """Поток событий клиента; пустые комментарии поддерживают соединение"""
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=heartbeat)
+            except asyncio.TimeoutError:
+                if await is_disconnected():
+                    break
+                yield ": ping\n\n"
+                continue
+            yield format_event(event)
+    finally:
+        feed.unsubscribe(queue)
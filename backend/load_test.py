@@ -0,0 +1,277 @@
+"""Нагрузочный тест обработчиков бота.
+
+Прогоняет через TelegramBot полные сессии множества пользователей
+(/start, проверка подписки, тест из 5 вопросов, получение рациона).
+Bot API подменяется локальной имитацией (fake_bot_api.py) с заданной
+задержкой, MongoDB - mongomock в памяти или локальным mongod. Печатает
+p50/p95/p99 задержки обработки обновления по шагам и пропускную
+способность; результат в JSON можно сравнить с прошлым запуском.
+
+Пример:
+    python load_test.py --users 2000 --concurrency 200 --api-latency-ms 50 --json run.json
+    python load_test.py --mongo mongodb://localhost:27017 --baseline run.json
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import subprocess
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from fake_telegram import FakeTelegramSender
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+STEPS = ("start", "check_subscription", "start_test") + tuple(f"answer_{q}" for q in range(5)) + ("get_diet",)
+
+
+def session_callbacks(quiz) -> List[str]:
+    """callback_data кнопок сессии из скомпилированного теста (первый вариант каждого ответа)"""
+    return (
+        [quiz.subscription_markup.inline_keyboard[1][0].callback_data,
+         quiz.invitation_markup.inline_keyboard[0][0].callback_data]
+        + [question.reply_markup.inline_keyboard[0][0].callback_data for question in quiz.engine.questions]
+        + [quiz.engine.diet_reply_markup.inline_keyboard[0][0].callback_data]
+    )
+
+
+def session_updates(sender: FakeTelegramSender, user_id: int, buttons: List[str]) -> List[Tuple[str, Dict[str, Any]]]:
+    """Обновления одной сессии с именами шагов"""
+    updates = [("start", sender.start_update(user_id))]
+    for step, data in zip(STEPS[1:], buttons):
+        updates.append((step, sender.callback_update(user_id, data)))
+    return updates
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Перцентиль по ближайшему рангу"""
+    if not sorted_values:
+        return 0.0
+    index = max(int(round(p / 100 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    """Сводка задержек в миллисекундах"""
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p95_ms": round(percentile(values, 95) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+        "max_ms": round(values[-1] * 1000, 2) if values else 0.0,
+        "mean_ms": round(sum(values) / len(values) * 1000, 2) if values else 0.0,
+    }
+
+
+def use_in_memory_mongo():
+    """Подмена коллекций всех модулей на mongomock"""
+    import mongomock
+    import database
+    import stats
+    import broadcast
+    import content
+    import funnel
+
+    db = mongomock.MongoClient()[database.DB_NAME]
+    database.db = db
+    database.users_collection = db.users
+    database.test_results_collection = db.test_results
+    database.media_cache_collection = db.media_cache
+    database.scheduled_jobs_collection = db.scheduled_jobs
+    database.quiz_states_collection = db.quiz_states
+    stats.rollups_collection = db.stats_rollups
+    stats.hourly_collection = db.stats_hourly
+    broadcast.broadcasts_collection = db.broadcasts
+    broadcast.deliveries_collection = db.broadcast_deliveries
+    content.content_collection = db.content
+    content.versions_collection = db.content_versions
+    funnel.events_collection = db.funnel_events
+    # mongomock не потокобезопасен - вызовы выполняются по одному
+    database._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mongomock")
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def wait_for_api(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                await client.get(url + "/stats")
+                return
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+
+
+async def run(args) -> Dict[str, Any]:
+    api_url = f"http://127.0.0.1:{args.api_port}"
+    api_process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "fake_bot_api:app",
+         "--host", "127.0.0.1", "--port", str(args.api_port), "--log-level", "warning"],
+        cwd=BACKEND_DIR,
+        env={
+            **os.environ,
+            "FAKE_API_LATENCY_MS": str(args.api_latency_ms),
+            "FAKE_API_JITTER_MS": str(args.api_jitter_ms),
+            "FAKE_API_RETRY_AFTER_RATE": str(args.retry_after_rate),
+        }
+    )
+    try:
+        await wait_for_api(api_url)
+
+        # Модули бота читают настройки при импорте
+        os.environ["TELEGRAM_API_BASE_URL"] = api_url
+        os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:load-test")
+        if args.mongo != "memory":
+            os.environ["MONGO_URL"] = args.mongo
+            os.environ["DB_NAME"] = args.db_name
+        from telegram import Update
+        from rate_limiter import PriorityRateLimiter
+        import telegram_bot
+        import database
+
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+
+        if args.mongo == "memory":
+            use_in_memory_mongo()
+
+        bot = telegram_bot.TelegramBot()
+        bot.media_cache.collection = database.media_cache_collection
+        if not args.rate_limit:
+            # Лимиты Telegram иначе ограничат пропускную способность, а не обработчики
+            unlimited = float("inf")
+            bot.rate_limiter = PriorityRateLimiter(unlimited, unlimited, unlimited, unlimited)
+        await bot.start(polling=False)
+
+        errors: List[str] = []
+
+        async def on_error(update, context):
+            errors.append(repr(context.error))
+
+        bot.application.add_error_handler(on_error)
+
+        latencies: Dict[str, List[float]] = defaultdict(list)
+        sender = FakeTelegramSender(api_url, "")
+        semaphore = asyncio.Semaphore(args.concurrency)
+        buttons = session_callbacks(bot.content.current.quiz())
+
+        async def run_session(user_id: int):
+            async with semaphore:
+                for step, data in session_updates(sender, user_id, buttons):
+                    update = Update.de_json(data, bot.application.bot)
+                    started = time.perf_counter()
+                    # Через обработчик обновлений приложения, как при polling и вебхуке
+                    await bot.application.update_processor.process_update(
+                        update, bot.application.process_update(update)
+                    )
+                    latencies[step].append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(run_session(args.first_user_id + i) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+
+        await bot.stop()
+        async with httpx.AsyncClient() as client:
+            api_calls = (await client.get(api_url + "/stats")).json()
+    finally:
+        api_process.terminate()
+        api_process.wait()
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        "revision": git_revision(),
+        "timestamp": datetime.utcnow().isoformat(),
+        "config": {
+            "users": args.users,
+            "concurrency": args.concurrency,
+            "api_latency_ms": args.api_latency_ms,
+            "api_jitter_ms": args.api_jitter_ms,
+            "retry_after_rate": args.retry_after_rate,
+            "mongo": "memory" if args.mongo == "memory" else "mongod",
+            "rate_limit": args.rate_limit,
+        },
+        "sessions": args.users,
+        "updates": len(all_latencies),
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(len(all_latencies) / elapsed, 1),
+        "sessions_per_second": round(args.users / elapsed, 1),
+        "latency": {
+            "all": summarize(all_latencies),
+            "steps": {step: summarize(latencies[step]) for step in STEPS},
+        },
+        "bot_api_calls": api_calls,
+    }
+
+
+def print_report(result: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None):
+    def delta(current: float, previous: Optional[float], lower_is_better: bool = True) -> str:
+        if not previous:
+            return ""
+        change = (current - previous) / previous * 100
+        worse = change > 0 if lower_is_better else change < 0
+        return f"  ({change:+.1f}%{' !' if worse and abs(change) >= 10 else ''})"
+
+    base_steps = baseline["latency"]["steps"] if baseline else {}
+    print(f"{'step':<20}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for step, summary in list(result["latency"]["steps"].items()) + [("all", result["latency"]["all"])]:
+        previous = baseline["latency"]["all"] if baseline and step == "all" else base_steps.get(step, {})
+        print(
+            f"{step:<20}{summary['count']:>8}{summary['p50_ms']:>10}{summary['p95_ms']:>10}"
+            f"{summary['p99_ms']:>10}{delta(summary['p95_ms'], previous.get('p95_ms'))}"
+        )
+    print(
+        f"updates/s={result['updates_per_second']}"
+        f"{delta(result['updates_per_second'], baseline and baseline['updates_per_second'], lower_is_better=False)}"
+        f"  sessions/s={result['sessions_per_second']}  errors={result['errors']}  time={result['seconds']}s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест обработчиков бота")
+    parser.add_argument("--users", type=int, default=1000, help="Число пользователей (сессий)")
+    parser.add_argument("--concurrency", type=int, default=100, help="Одновременных сессий")
+    parser.add_argument("--api-latency-ms", type=float, default=30, help="Задержка ответа Bot API")
+    parser.add_argument("--api-jitter-ms", type=float, default=10)
+    parser.add_argument("--retry-after-rate", type=float, default=0, help="Доля ответов 429")
+    parser.add_argument("--api-port", type=int, default=8181)
+    parser.add_argument("--mongo", default="memory", help="memory (mongomock) или URL mongod")
+    parser.add_argument("--db-name", default="load_test", help="База для прогона на mongod")
+    parser.add_argument("--rate-limit", action="store_true", help="Оставить лимиты Telegram на отправку")
+    parser.add_argument("--first-user-id", type=int, default=100000)
+    parser.add_argument("--json", help="Куда сохранить результат в JSON")
+    parser.add_argument("--baseline", help="JSON прошлого запуска для сравнения")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import os
+import asyncio
+import hashlib
+import logging
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from telegram import Message
+from telegram.error import BadRequest
+
+from database import run_sync
+
+logger = logging.getLogger(__name__)
+
+# Типы медиа, которые умеет кэшировать MediaCache
+MEDIA_PHOTO = "photo"
+MEDIA_DOCUMENT = "document"
+
+# Ошибки Bot API, означающие, что сохраненный file_id больше не действует;
+# остальные BadRequest (чат не найден, длинная подпись) к файлу не относятся
+FILE_ID_ERRORS = (
+    "wrong file identifier",
+    "wrong remote file identifier",
+    "file reference expired",
+    "file_reference_expired",
+    "type of file mismatch",
+)
+
+
+def is_file_id_error(error: BadRequest) -> bool:
+    """Отклонен ли именно file_id"""
+    message = str(error.message).lower()
+    return any(marker in message for marker in FILE_ID_ERRORS)
+
+
+def file_sha256(path: str) -> str:
+    """Вычисление SHA-256 содержимого файла"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def extract_file_id(message: Message, media_type: str) -> Optional[str]:
+    """Извлечение file_id из отправленного сообщения"""
+    if media_type == MEDIA_PHOTO and message.photo:
+        # Telegram возвращает несколько размеров, берем самый большой
+        return message.photo[-1].file_id
+    if media_type == MEDIA_DOCUMENT and message.document:
+        return message.document.file_id
+    return None
+
+
+class MediaCache:
+    """Кэш Telegram file_id для статичных файлов (фото, PDF).
+
+    Каждый файл загружается в Telegram один раз, полученный file_id
+    сохраняется в MongoDB вместе с хэшем содержимого и переиспользуется
+    при следующих отправках. Повторная загрузка происходит только если
+    файл изменился или Telegram отклонил сохраненный file_id.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        # path -> {"mtime", "size", "hash", "file_id", "pinned"} для текущего процесса
+        self._entries: Dict[str, Dict[str, Any]] = {}
+
+    async def ensure_indexes(self):
+        """Создание индекса для поиска file_id по хэшу"""
+        await run_sync(self.collection.create_index, [("hash", 1), ("media_type", 1)], unique=True)
+
+    def _current_hash(self, path: str) -> str:
+        """Хэш файла; пересчитывается только при изменении mtime/размера"""
+        entry = self._entries.get(path)
+        # Зарегистрированные файлы не проверяются на диске при каждой отправке
+        if entry and entry["pinned"]:
+            return entry["hash"]
+        stat = os.stat(path)
+        if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+            return entry["hash"]
+
+        content_hash = file_sha256(path)
+        self._entries[path] = {
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "hash": content_hash,
+            "file_id": None,
+            "pinned": False,
+        }
+        return content_hash
+
+    async def preload(
+        self,
+        path: str,
+        media_type: str,
+        upload_func: Optional[Callable[[Any], Awaitable[Message]]] = None,
+        content_hash: Optional[str] = None
+    ) -> Optional[str]:
+        """Регистрация файла до первой отправки.
+
+        Хэш считается один раз (или берется готовым content_hash, например
+        из манифеста сборки), file_id берется из MongoDB, а если его нет
+        и передан upload_func - файл загружается им (например, в служебный
+        чат). Дальше отправки не обращаются к диску; изменения файла
+        подхватываются повторным вызовом preload.
+        """
+        entry = self._entries.get(path)
+        if content_hash is not None:
+            if not entry or entry["hash"] != content_hash:
+                self._entries[path] = {
+                    "mtime": None, "size": None, "hash": content_hash, "file_id": None, "pinned": True,
+                }
+        else:
+            if entry:
+                entry["pinned"] = False
+            await asyncio.to_thread(self._current_hash, path)
+        file_id = await self.get_file_id(path, media_type)
+        if file_id is None and upload_func is not None:
+            message = await self.send(path, media_type, upload_func)
+            file_id = extract_file_id(message, media_type)
+        self._entries[path]["pinned"] = True
+        return file_id
+
+    async def get_file_id(self, path: str, media_type: str) -> Optional[str]:
+        """Получение сохраненного file_id для актуальной версии файла"""
+        # Новые файлы (например, свежие персональные PDF) хэшируются вне event loop
+        content_hash = await asyncio.to_thread(self._current_hash, path)
+        entry = self._entries[path]
+        if entry["file_id"]:
+            return entry["file_id"]
+
+        doc = await run_sync(self.collection.find_one, {"hash": content_hash, "media_type": media_type})
+        if doc:
+            entry["file_id"] = doc["file_id"]
+            return doc["file_id"]
+        return None
+
+    async def store_file_id(self, path: str, media_type: str, file_id: str):
+        """Сохранение file_id после загрузки файла"""
+        content_hash = await asyncio.to_thread(self._current_hash, path)
+        self._entries[path]["file_id"] = file_id
+        await run_sync(
+            self.collection.update_one,
+            {"hash": content_hash, "media_type": media_type},
+            {"$set": {
+                "file_id": file_id,
+                "path": path,
+                "updated_at": datetime.utcnow()
+            }},
+            upsert=True
+        )
+
+    async def invalidate(self, path: str, media_type: str):
+        """Удаление file_id, который Telegram больше не принимает"""
+        entry = self._entries.get(path)
+        if not entry:
+            return
+        entry["file_id"] = None
+        await run_sync(self.collection.delete_one, {"hash": entry["hash"], "media_type": media_type})
+
+    async def send(
+        self,
+        path: str,
+        media_type: str,
+        send_func: Callable[[Any], Awaitable[Message]]
+    ) -> Message:
+        """Отправка файла через send_func с использованием кэша file_id.
+
+        send_func принимает либо file_id, либо открытый файл и выполняет
+        соответствующий вызов Bot API (reply_photo, send_document и т.д.).
+        """
+        file_id = await self.get_file_id(path, media_type)
+        if file_id:
+            try:
+                return await send_func(file_id)
+            except BadRequest as e:
+                if not is_file_id_error(e):
+                    raise
+                logger.warning(f"Telegram отклонил сохраненный file_id для {path}: {e}")
+                await self.invalidate(path, media_type)
+
+        with open(path, 'rb') as media_file:
+            message = await send_func(media_file)
+
+        new_file_id = extract_file_id(message, media_type)
+        if new_file_id:
+            await self.store_file_id(path, media_type, new_file_id)
+            logger.info(f"Файл {path} загружен в Telegram, file_id сохранен")
+        return message
@@ -0,0 +1,171 @@
+import time
+import asyncio
+import functools
+import logging
+from typing import Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+from pymongo import monitoring
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин задержек (секунды)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+HANDLER_LATENCY = Histogram(
+    "bot_handler_duration_seconds", "Время работы обработчика бота",
+    ["handler"], buckets=LATENCY_BUCKETS
+)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Исключения в обработчиках бота", ["handler"]
+)
+
+TELEGRAM_API_LATENCY = Histogram(
+    "telegram_api_request_duration_seconds", "Время запроса к Bot API",
+    ["method"], buckets=LATENCY_BUCKETS
+)
+TELEGRAM_API_ERRORS = Counter(
+    "telegram_api_errors_total", "Ошибки запросов к Bot API", ["method", "error"]
+)
+
+TELEGRAM_RETRY_AFTER = Counter(
+    "telegram_retry_after_total", "Ответы 429 (флуд-контроль) от Bot API", ["method"]
+)
+RATE_LIMIT_WAIT = Histogram(
+    "telegram_rate_limit_wait_seconds", "Ожидание в ограничителе исходящих запросов",
+    ["priority"], buckets=LATENCY_BUCKETS
+)
+BROADCAST_DELIVERIES = Counter(
+    "broadcast_deliveries_total", "Доставки рассылок по итогу", ["status"]
+)
+
+PDF_RENDER_DURATION = Histogram(
+    "pdf_render_duration_seconds", "Время рендеринга персонального PDF", buckets=LATENCY_BUCKETS
+)
+PDF_CACHE_REQUESTS = Counter(
+    "pdf_cache_requests_total", "Запросы персонального PDF по итогу (hit/miss)", ["result"]
+)
+
+MONGO_LATENCY = Histogram(
+    "mongo_command_duration_seconds", "Время выполнения команды MongoDB",
+    ["command"], buckets=LATENCY_BUCKETS
+)
+MONGO_ERRORS = Counter(
+    "mongo_command_errors_total", "Ошибки команд MongoDB", ["command"]
+)
+
+DUPLICATE_UPDATES = Counter(
+    "bot_duplicate_updates_total", "Отсеянные дубли обновлений по причине", ["reason"]
+)
+CALLBACK_REJECTED = Counter(
+    "bot_callback_rejected_total", "Отброшенные нажатия кнопок по причине", ["reason"]
+)
+
+FUNNEL_STEPS = Counter(
+    "quiz_funnel_steps_total", "Пользователи, дошедшие до шага воронки", ["step"]
+)
+
+FUNNEL_EVENTS_DROPPED = Counter(
+    "funnel_events_dropped_total", "События воронки, потерянные из-за переполнения буфера"
+)
+
+WRITE_BUFFER_QUEUE_DEPTH = Gauge(
+    "write_buffer_queue_depth", "Операции в очереди буфера отложенной записи"
+)
+WRITE_BUFFER_FLUSH_DURATION = Histogram(
+    "write_buffer_flush_duration_seconds", "Время сброса пачки буфера отложенной записи",
+    buckets=LATENCY_BUCKETS
+)
+WRITE_BUFFER_DEAD_LETTERS = Counter(
+    "write_buffer_dead_letter_ops_total", "Операции, не записанные после всех повторов и отложенные в файл"
+)
+
+LIVE_CLIENTS = Gauge(
+    "live_feed_clients", "Подключенные клиенты живой ленты /api/live"
+)
+
+EVENT_LOOP_LAG = Gauge(
+    "event_loop_lag_seconds", "Последняя измеренная задержка event loop", ["loop"]
+)
+EVENT_LOOP_LAG_HISTOGRAM = Histogram(
+    "event_loop_lag_histogram_seconds", "Задержка event loop",
+    ["loop"], buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+)
+
+# Шаги воронки теста
+STEP_START = "start"
+STEP_SUBSCRIPTION_CHECK = "subscription_check"
+STEP_SUBSCRIBED = "subscribed"
+STEP_TEST_STARTED = "test_started"
+STEP_TEST_FINISHED = "test_finished"
+STEP_DIET_SENT = "diet_sent"
+
+
+def funnel_step(step: str):
+    """Отметка шага воронки"""
+    FUNNEL_STEPS.labels(step=step).inc()
+
+
+def instrument_handler(name: str):
+    """Декоратор: гистограмма времени и счетчик ошибок асинхронного обработчика"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.labels(handler=name).inc()
+                raise
+            finally:
+                HANDLER_LATENCY.labels(handler=name).observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest с замером задержки и ошибок каждого метода Bot API"""
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception as e:
+            TELEGRAM_API_ERRORS.labels(method=api_method, error=type(e).__name__).inc()
+            raise
+        finally:
+            TELEGRAM_API_LATENCY.labels(method=api_method).observe(time.perf_counter() - started)
+        if code >= 400:
+            TELEGRAM_API_ERRORS.labels(method=api_method, error=str(code)).inc()
+        return code, payload
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Слушатель команд PyMongo: задержка и ошибки по имени команды"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_LATENCY.labels(command=event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        MONGO_LATENCY.labels(command=event.command_name).observe(event.duration_micros / 1e6)
+        MONGO_ERRORS.labels(command=event.command_name).inc()
+
+
+async def monitor_event_loop_lag(loop_name: str, interval: float = 0.5):
+    """Периодический замер задержки текущего event loop"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(time.perf_counter() - started - interval, 0.0)
+        EVENT_LOOP_LAG.labels(loop=loop_name).set(lag)
+        EVENT_LOOP_LAG_HISTOGRAM.labels(loop=loop_name).observe(lag)
+
+
+def start_loop_monitor(loop_name: str) -> Optional[asyncio.Task]:
+    """Запуск замера задержки в текущем event loop"""
+    return asyncio.get_running_loop().create_task(monitor_event_loop_lag(loop_name))
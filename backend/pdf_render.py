@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Iterable, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Каталог кэша готовых PDF (имя файла - хэш описания)
+PDF_CACHE_DIR = os.getenv(
+    "PDF_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "pdf_cache")
+)
+# Сколько файлов держать в кэше; самые давно запрошенные удаляются
+PDF_CACHE_MAX_FILES = int(os.getenv("PDF_CACHE_MAX_FILES", "1000"))
+# Процессов для рендеринга и предельное время рендеринга одного файла (секунды)
+PDF_RENDER_WORKERS = int(os.getenv("PDF_RENDER_WORKERS", "2"))
+PDF_RENDER_TIMEOUT = float(os.getenv("PDF_RENDER_TIMEOUT", "60"))
+# Шрифты с кириллицей (TTF)
+PDF_FONT_PATH = os.getenv("PDF_FONT_PATH", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf")
+PDF_FONT_BOLD_PATH = os.getenv("PDF_FONT_BOLD_PATH", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf")
+
+# Меняется при изменении верстки, чтобы старые файлы не попадали в выдачу
+RENDER_VERSION = 1
+
+_fonts_registered = False
+
+
+def spec_key(spec: Dict[str, Any]) -> str:
+    """Адрес файла в кэше: хэш описания PDF и версии верстки"""
+    payload = json.dumps(
+        {"spec": spec, "render_version": RENDER_VERSION, "fonts": [PDF_FONT_PATH, PDF_FONT_BOLD_PATH]},
+        ensure_ascii=False, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _register_fonts():
+    global _fonts_registered
+    if _fonts_registered:
+        return
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+
+    pdfmetrics.registerFont(TTFont("Body", PDF_FONT_PATH))
+    pdfmetrics.registerFont(TTFont("Body-Bold", PDF_FONT_BOLD_PATH))
+    _fonts_registered = True
+
+
+def render_pdf(spec: Dict[str, Any], output_path: str):
+    """Рендеринг PDF рациона по описанию (выполняется в процессе пула)"""
+    # reportlab нужен только процессам рендеринга
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import ParagraphStyle
+    from reportlab.lib.units import mm
+    from reportlab.lib.utils import ImageReader
+    from reportlab.platypus import Image, ListFlowable, ListItem, PageBreak, Paragraph, SimpleDocTemplate, Spacer
+    from xml.sax.saxutils import escape
+
+    _register_fonts()
+    accent = colors.HexColor("#b5477a")
+    title_style = ParagraphStyle("title", fontName="Body-Bold", fontSize=22, leading=28, textColor=accent)
+    heading_style = ParagraphStyle("heading", fontName="Body-Bold", fontSize=14, leading=18, spaceBefore=10, spaceAfter=4)
+    body_style = ParagraphStyle("body", fontName="Body", fontSize=11, leading=15)
+
+    def paragraph(text: str, style: ParagraphStyle) -> Paragraph:
+        return Paragraph(escape(text).replace("\n", "<br/>"), style)
+
+    story = [paragraph(spec["title"], title_style), Spacer(1, 6 * mm)]
+    if spec.get("cover_image"):
+        width = A4[0] - 40 * mm
+        image_width, image_height = ImageReader(spec["cover_image"]).getSize()
+        height = min(width * image_height / image_width, 120 * mm)
+        story += [Image(spec["cover_image"], width=height * image_width / image_height, height=height), Spacer(1, 6 * mm)]
+    story.append(paragraph(spec["result_title"], heading_style))
+    for section in spec["sections"]:
+        story += [paragraph(section["heading"], heading_style), paragraph(section["text"], body_style)]
+
+    if spec["days"]:
+        story.append(PageBreak())
+    for day in spec["days"]:
+        story.append(paragraph(day["title"], heading_style))
+        story.append(ListFlowable(
+            [ListItem(paragraph(meal, body_style), leftIndent=12) for meal in day["meals"]],
+            bulletType="bullet", bulletFontName="Body"
+        ))
+
+    # invariant: одинаковое описание дает побайтно одинаковый файл
+    document = SimpleDocTemplate(
+        output_path, pagesize=A4, title=spec["title"], invariant=1,
+        leftMargin=20 * mm, rightMargin=20 * mm, topMargin=20 * mm, bottomMargin=20 * mm
+    )
+    document.build(story)
+
+
+class PdfRenderer:
+    """Персональные PDF с кэшем на диске.
+
+    Файл адресуется хэшем описания (spec_key): пользователи с одинаковыми
+    значимыми ответами получают один и тот же файл, а значит и один file_id
+    в MediaCache. Рендеринг идет в пуле процессов, чтобы не занимать event
+    loop и GIL; одновременные запросы одного файла ждут один рендеринг.
+    Индекс кэша - LRU в памяти, при старте восстанавливается по mtime.
+    Файлы, которые сейчас отправляются (hold), не вытесняются.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = PDF_CACHE_DIR,
+        max_files: int = PDF_CACHE_MAX_FILES,
+        workers: int = PDF_RENDER_WORKERS
+    ):
+        self.cache_dir = cache_dir
+        self.max_files = max_files
+        self.workers = workers
+        self._index: "OrderedDict[str, str]" = OrderedDict()
+        self._pending: Dict[str, asyncio.Future] = {}
+        # Путь -> число незавершенных отправок
+        self._in_use: Dict[str, int] = {}
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._loaded = False
+        self._metrics = {"hits": 0, "misses": 0, "rendered": 0, "evicted": 0, "errors": 0}
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.pdf")
+
+    def _scan(self):
+        """Восстановление индекса по файлам на диске (старые первыми)"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith(".pdf"):
+                    path = os.path.join(root, name)
+                    files.append((os.stat(path).st_mtime, name[:-4], path))
+        for _, key, path in sorted(files):
+            self._index[key] = path
+        self._evict()
+
+    def _evict(self):
+        excess = len(self._index) - self.max_files
+        if excess <= 0:
+            return
+        # Отправляемые файлы пропускаются и будут вытеснены позже
+        keys = [key for key, path in self._index.items() if path not in self._in_use][:excess]
+        for key in keys:
+            path = self._index.pop(key)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._metrics["evicted"] += 1
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn: процессы не наследуют потоки и event loop бота
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    async def _render(self, key: str, spec: Dict[str, Any]) -> str:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Запись во временный файл и переименование - другие процессы не увидят недописанный PDF
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.wait_for(
+                loop.run_in_executor(self._executor(), render_pdf, spec, tmp_path), timeout=PDF_RENDER_TIMEOUT
+            )
+            os.replace(tmp_path, path)
+        except Exception as e:
+            self._metrics["errors"] += 1
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if isinstance(e, BrokenProcessPool):
+                # Упавший процесс ломает весь пул - следующий рендеринг создаст новый
+                self.close()
+            raise
+        metrics.PDF_RENDER_DURATION.observe(time.perf_counter() - started)
+        self._metrics["rendered"] += 1
+        self._index[key] = path
+        self._evict()
+        return path
+
+    async def render(self, spec: Dict[str, Any]) -> str:
+        """Путь к PDF для описания: из кэша или после рендеринга"""
+        if not self._loaded:
+            await asyncio.to_thread(self._scan)
+            self._loaded = True
+        key = spec_key(spec)
+        path = self._index.get(key)
+        # Файл мог удалить другой процесс с тем же каталогом кэша
+        if path is not None and os.path.exists(path):
+            self._index.move_to_end(key)
+            self._metrics["hits"] += 1
+            metrics.PDF_CACHE_REQUESTS.labels(result="hit").inc()
+            return path
+
+        self._metrics["misses"] += 1
+        metrics.PDF_CACHE_REQUESTS.labels(result="miss").inc()
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._render(key, spec))
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        # shield: отмена одного ожидающего не прерывает рендеринг для остальных
+        return await asyncio.shield(task)
+
+    @contextmanager
+    def hold(self, path: str):
+        """Файл не вытесняется из кэша, пока блок не завершится"""
+        self._in_use[path] = self._in_use.get(path, 0) + 1
+        try:
+            yield path
+        finally:
+            self._in_use[path] -= 1
+            if not self._in_use[path]:
+                del self._in_use[path]
+
+    async def prewarm(self, specs: Iterable[Dict[str, Any]]) -> int:
+        """Рендеринг всех описаний заранее; возвращает число готовых файлов"""
+        results = await asyncio.gather(*(self.render(spec) for spec in specs), return_exceptions=True)
+        failed = [result for result in results if isinstance(result, Exception)]
+        if failed:
+            logger.error(f"Прогрев PDF: ошибок {len(failed)}, первая: {failed[0]!r}")
+        return len(results) - len(failed)
+
+    def close(self):
+        """Остановка пула процессов"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stats(self) -> Dict[str, Any]:
+        """Счетчики кэша и рендеринга"""
+        return {
+            "cache_dir": self.cache_dir,
+            "cached_files": len(self._index),
+            "max_files": self.max_files,
+            "rendering": len(self._pending),
+            **self._metrics,
+        }
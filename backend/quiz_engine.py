@@ -0,0 +1,158 @@
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Optional, Sequence, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import callbacks
+
+# Заголовок перед первым вопросом теста
+TEST_HEADER = "Ответь на 5 вопросов — и я пришлю твой результат + адаптированный рацион на 3 дня\n\n"
+# Префикс текста вопроса, {number} - номер с единицы
+QUESTION_PREFIX = "Вопрос {number}: "
+DIET_BUTTON = "Получить рацион"
+
+
+@dataclass(frozen=True)
+class QuizResult:
+    """Результат теста для диапазона баллов с готовым текстом"""
+    low: int
+    high: int
+    percentage: int
+    title: str
+    description: str
+    text: str
+
+
+@dataclass(frozen=True)
+class QuizQuestion:
+    """Вопрос теста с готовым текстом и клавиатурой"""
+    question: str
+    options: Tuple[Tuple[str, int], ...]
+    text: str
+    reply_markup: InlineKeyboardMarkup
+
+
+def reachable_totals(questions: Sequence[Dict]) -> FrozenSet[int]:
+    """Все суммы баллов, которые можно набрать, ответив на каждый вопрос"""
+    totals = {0}
+    for question in questions:
+        scores = {score for _, score in question["options"]}
+        totals = {total + score for total in totals for score in scores}
+    return frozenset(totals)
+
+
+def validate_results(questions: Sequence[Dict], results: Dict[Tuple[int, int], Dict]):
+    """Проверка, что диапазоны результатов не пересекаются и покрывают все суммы"""
+    ranges = sorted(results)
+    for low, high in ranges:
+        if low > high:
+            raise ValueError(f"Пустой диапазон результата: ({low}, {high})")
+    for (_, prev_high), (low, high) in zip(ranges, ranges[1:]):
+        if low <= prev_high:
+            raise ValueError(f"Диапазоны результатов пересекаются: {prev_high} и ({low}, {high})")
+
+    uncovered = sorted(
+        total for total in reachable_totals(questions)
+        if not any(low <= total <= high for low, high in ranges)
+    )
+    if uncovered:
+        raise ValueError(f"Суммы баллов без результата: {uncovered}")
+
+
+class QuizEngine:
+    """Скомпилированный тест: вопросы, клавиатуры и таблица баллы → результат.
+
+    Собирается один раз при загрузке контента и дальше не изменяется,
+    обработчики только читают готовые тексты и клавиатуры.
+    """
+
+    def __init__(
+        self,
+        questions: Sequence[Dict],
+        results: Dict[Tuple[int, int], Dict],
+        header: str = TEST_HEADER,
+        question_prefix: str = QUESTION_PREFIX,
+        diet_button: str = DIET_BUTTON,
+        quiz_id: Optional[str] = None,
+        version: Optional[str] = None
+    ):
+        validate_results(questions, results)
+        # Тест и версия контента зашиваются в кнопки, чтобы отсекать устаревшие нажатия
+        self.quiz_id = quiz_id
+        self.version = version
+
+        self.questions: Tuple[QuizQuestion, ...] = tuple(
+            self._compile_question(index, question, header, question_prefix)
+            for index, question in enumerate(questions)
+        )
+        self.results: Tuple[QuizResult, ...] = tuple(
+            QuizResult(
+                low=low,
+                high=high,
+                percentage=data["percentage"],
+                title=data["title"],
+                description=data["description"],
+                text=f"{data['percentage']}% — {data['title']}\n\n{data['description']}"
+            )
+            for (low, high), data in sorted(results.items())
+        )
+        # Для сумм вне диапазонов - максимальный результат
+        self.fallback_result = self.results[-1]
+
+        # Таблица с прямым доступом по сумме баллов для всех достижимых сумм
+        totals = reachable_totals(questions)
+        self.min_total = min(totals)
+        self.max_total = max(totals)
+        self._table: Tuple[QuizResult, ...] = tuple(
+            self._find_result(total) for total in range(self.min_total, self.max_total + 1)
+        )
+
+        self.diet_reply_markup = InlineKeyboardMarkup(
+            [[InlineKeyboardButton(
+                diet_button, callback_data=callbacks.encode(callbacks.ACTION_GET_DIET, quiz_id, version)
+            )]]
+        )
+
+    def _compile_question(self, index: int, question: Dict, header: str, question_prefix: str) -> QuizQuestion:
+        header = header if index == 0 else ""
+        prefix = question_prefix.format(number=index + 1)
+        options = tuple((text, score) for text, score in question["options"])
+        keyboard = [
+            [InlineKeyboardButton(option_text, callback_data=callbacks.encode(
+                callbacks.ACTION_ANSWER, self.quiz_id, self.version, index, i
+            ))]
+            for i, (option_text, _) in enumerate(options)
+        ]
+        return QuizQuestion(
+            question=question["question"],
+            options=options,
+            text=f"{header}{prefix}{question['question']}",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+
+    def _find_result(self, total: int) -> QuizResult:
+        for result in self.results:
+            if result.low <= total <= result.high:
+                return result
+        return self.fallback_result
+
+    @property
+    def question_count(self) -> int:
+        return len(self.questions)
+
+    def result_for(self, total_score: int) -> QuizResult:
+        """Результат для суммы баллов за O(1)"""
+        if self.min_total <= total_score <= self.max_total:
+            return self._table[total_score - self.min_total]
+        return self._find_result(total_score)
+
+    def has_option(self, question_index: int, answer_index: int) -> bool:
+        """Есть ли такой вопрос и вариант ответа"""
+        return (
+            0 <= question_index < len(self.questions)
+            and 0 <= answer_index < len(self.questions[question_index].options)
+        )
+
+    def option(self, question_index: int, answer_index: int) -> Tuple[str, int]:
+        """Текст и баллы варианта ответа"""
+        return self.questions[question_index].options[answer_index]
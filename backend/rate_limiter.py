@@ -0,0 +1,204 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Dict, Optional
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Общий лимит исходящих сообщений бота (сообщений в секунду)
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+# Доля общего лимита для рассылок; остаток всегда доступен ответам пользователям
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+# Лимиты одного чата: личный чат - около 1 сообщения в секунду, группа - 20 в минуту
+PRIVATE_CHAT_RATE = float(os.getenv("PRIVATE_CHAT_RATE", "1"))
+PRIVATE_CHAT_BURST = float(os.getenv("PRIVATE_CHAT_BURST", "3"))
+GROUP_CHAT_RATE = 20 / 60
+# Сколько процессов отправляют сообщения от имени бота (диспетчер шардов
+# передает число воркеров): общий лимит и лимит рассылок делятся поровну.
+# Чат обслуживает один воркер, поэтому лимиты чатов не делятся
+RATE_LIMIT_PROCESSES = max(1, int(os.getenv("RATE_LIMIT_PROCESSES", "1")))
+# Сколько раз повторять запрос после 429
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "3"))
+# Сколько чатов держать в таблице лимитов (самые давние вытесняются)
+CHAT_BUCKETS_MAX = 10000
+
+# Приоритеты запросов (передаются через rate_limit_args)
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BULK = "bulk"
+BULK = {"priority": PRIORITY_BULK}
+
+# Методы, на которые действуют лимиты Telegram на отправку сообщений
+LIMITED_PREFIXES = ("send", "edit", "copy", "forward")
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity про запас"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> float:
+        """Взять токен; 0, если получилось, иначе сколько секунд ждать"""
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    async def acquire(self):
+        """Ожидание токена"""
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """retry_after в секундах (в разных версиях PTB это int или timedelta)"""
+    value = error.retry_after
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
+
+
+class PriorityRateLimiter(BaseRateLimiter[Dict[str, Any]]):
+    """Ограничитель исходящих запросов к Bot API с двумя приоритетами.
+
+    Ответы пользователям (по умолчанию) проходят только общий лимит и лимит
+    чата, и пока такой запрос ждет, рассылка токены не забирает. Рассылка
+    (rate_limit_args={"priority": "bulk"}) дополнительно ограничена
+    BROADCAST_RATE, поэтому часть общего лимита всегда остается ответам.
+    При 429 все запросы приостанавливаются на retry_after, затем запрос
+    повторяется. Лимиты считаются в процессе; при нескольких процессах
+    общий лимит делится между ними (processes).
+    """
+
+    def __init__(
+        self,
+        global_rate: float = TELEGRAM_GLOBAL_RATE,
+        bulk_rate: float = BROADCAST_RATE,
+        chat_rate: float = PRIVATE_CHAT_RATE,
+        chat_burst: float = PRIVATE_CHAT_BURST,
+        max_retries: int = RATE_LIMIT_MAX_RETRIES,
+        processes: int = RATE_LIMIT_PROCESSES
+    ):
+        global_rate /= processes
+        bulk_rate /= processes
+        self.global_bucket = TokenBucket(global_rate)
+        self.bulk_bucket = TokenBucket(min(bulk_rate, global_rate))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chat_buckets: "OrderedDict[Any, TokenBucket]" = OrderedDict()
+        self._interactive_waiting = 0
+        self._paused_until = 0.0
+        self._metrics = {PRIORITY_INTERACTIVE: 0, PRIORITY_BULK: 0, "retry_after": 0}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        self._chat_buckets.clear()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            group = isinstance(chat_id, str) or (isinstance(chat_id, int) and chat_id < 0)
+            bucket = (
+                TokenBucket(GROUP_CHAT_RATE, 1) if group
+                else TokenBucket(self.chat_rate, self.chat_burst)
+            )
+            self._chat_buckets[chat_id] = bucket
+            if len(self._chat_buckets) > CHAT_BUCKETS_MAX:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def _wait_pause(self):
+        while True:
+            remaining = self._paused_until - time.monotonic()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(remaining)
+
+    async def _acquire_global(self, priority: str):
+        """Токен общего лимита; рассылка уступает ожидающим ответам"""
+        if priority == PRIORITY_INTERACTIVE:
+            self._interactive_waiting += 1
+        try:
+            while True:
+                await self._wait_pause()
+                if priority == PRIORITY_BULK and self._interactive_waiting:
+                    await asyncio.sleep(1 / self.global_bucket.rate)
+                    continue
+                wait = self.global_bucket.try_acquire()
+                if wait <= 0:
+                    return
+                await asyncio.sleep(wait)
+        finally:
+            if priority == PRIORITY_INTERACTIVE:
+                self._interactive_waiting -= 1
+
+    async def _acquire(self, priority: str, chat_id):
+        started = time.perf_counter()
+        if priority == PRIORITY_BULK:
+            await self.bulk_bucket.acquire()
+        if chat_id is not None:
+            await self._chat_bucket(chat_id).acquire()
+        await self._acquire_global(priority)
+        metrics.RATE_LIMIT_WAIT.labels(priority=priority).observe(time.perf_counter() - started)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = (rate_limit_args or {}).get("priority", PRIORITY_INTERACTIVE)
+        limited = endpoint.lower().startswith(LIMITED_PREFIXES)
+        chat_id = data.get("chat_id")
+
+        for attempt in range(self.max_retries + 1):
+            if limited:
+                await self._acquire(priority, chat_id)
+            else:
+                await self._wait_pause()
+            try:
+                result = await callback(*args, **kwargs)
+                self._metrics[priority] += 1
+                return result
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                self._metrics["retry_after"] += 1
+                metrics.TELEGRAM_RETRY_AFTER.labels(method=endpoint).inc()
+                if attempt == self.max_retries:
+                    raise
+                # Флуд-контроль действует на весь бот - останавливаем все запросы
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                logger.warning(f"429 на {endpoint}, пауза {delay:.1f} с (попытка {attempt + 1})")
+
+    def stats(self) -> Dict[str, Any]:
+        """Счетчики ограничителя"""
+        return {
+            "global_rate": self.global_bucket.rate,
+            "bulk_rate": self.bulk_bucket.rate,
+            "sent_interactive": self._metrics[PRIORITY_INTERACTIVE],
+            "sent_bulk": self._metrics[PRIORITY_BULK],
+            "retry_after": self._metrics["retry_after"],
+            "interactive_waiting": self._interactive_waiting,
+            "paused_for": round(max(self._paused_until - time.monotonic(), 0.0), 2),
+            "tracked_chats": len(self._chat_buckets),
+        }
@@ -0,0 +1,495 @@
+import os
+import json
+import gzip
+import uuid
+import shutil
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+import database
+from content import raw_quiz_ids, raw_quiz_options, versions_collection
+from database import run_sync
+
+logger = logging.getLogger(__name__)
+
+# Результаты старше стольких дней переносятся в архив; 0 - архивирование выключено
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "0"))
+# Каталог архива и формат новых частей: ndjson (NDJSON.gz) или parquet (нужен pyarrow)
+RETENTION_ARCHIVE_DIR = os.getenv(
+    "RETENTION_ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "archive")
+)
+RETENTION_FORMAT = os.getenv("RETENTION_FORMAT", "ndjson")
+# Период запуска и размер пачки переноса
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "5000"))
+# Дни хранения архивных разделов; 0 - хранить бессрочно
+ARCHIVE_TTL_DAYS = int(os.getenv("ARCHIVE_TTL_DAYS", "0"))
+# Разрешить сжатие ответов старого формата (словари с текстами) в индексы
+# вариантов; выполняется только по запросу (compact_legacy), не периодически
+RETENTION_COMPACT_LEGACY = os.getenv("RETENTION_COMPACT_LEGACY", "0") == "1"
+
+FORMAT_NDJSON = "ndjson"
+FORMAT_PARQUET = "parquet"
+FORMAT_SUFFIXES = {FORMAT_NDJSON: ".ndjson.gz", FORMAT_PARQUET: ".parquet"}
+
+# Раздел архива - день completed_at: test_results/date=YYYY-MM-DD/part-*.ndjson.gz
+ARCHIVE_TABLE = "test_results"
+PARTITION_PREFIX = "date="
+PARTITION_FORMAT = "%Y-%m-%d"
+
+RUN_ID = "test_results"
+# Срок захвата задачи одним процессом (секунды)
+LEASE_SECONDS = 600
+
+runs_collection = database.db.retention_runs
+
+# (версия контента, тест) -> варианты ответов; сохраненные версии не меняются
+_options_cache: Dict[Tuple[str, Optional[str]], Optional[List[List[Tuple[str, int]]]]] = {}
+_task: Optional[asyncio.Task] = None
+_owner = uuid.uuid4().hex
+
+
+def _table_dir(archive_dir: str) -> str:
+    return os.path.join(archive_dir, ARCHIVE_TABLE)
+
+
+def _row(document: Dict[str, Any]) -> Dict[str, Any]:
+    row = {field: document.get(field) for field in database.TEST_RESULT_FIELDS}
+    row["id"] = str(document["_id"])
+    row["answers"] = [option for _, option in database.answer_pairs(document.get("answers") or [])]
+    if row["quiz_version"] is not None:
+        row["quiz_version"] = str(row["quiz_version"])
+    return row
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Тип {type(value)} не сериализуется")
+
+
+def _parquet_schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ("id", pa.string()), ("user_id", pa.string()), ("test_id", pa.string()),
+        ("answers", pa.list_(pa.int16())), ("total_score", pa.int32()),
+        ("result_percentage", pa.int32()), ("result_title", pa.string()),
+        ("quiz_id", pa.string()), ("quiz_version", pa.string()), ("completed_at", pa.timestamp("ms")),
+    ])
+
+
+def _write_part(partition_dir: str, rows: List[Dict[str, Any]], fmt: str) -> str:
+    """Запись части раздела: во временный файл и переименование"""
+    os.makedirs(partition_dir, exist_ok=True)
+    name = f"part-{datetime.utcnow():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}{FORMAT_SUFFIXES[fmt]}"
+    path = os.path.join(partition_dir, name)
+    tmp_path = os.path.join(partition_dir, f".{name}.tmp")
+    if fmt == FORMAT_PARQUET:
+        # pyarrow нужен только для формата parquet
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        pq.write_table(pa.Table.from_pylist(rows, schema=_parquet_schema()), tmp_path, compression="zstd")
+    else:
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False, default=_json_default) + "\n")
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return path
+
+
+def _read_part(path: str) -> List[Dict[str, Any]]:
+    if path.endswith(FORMAT_SUFFIXES[FORMAT_PARQUET]):
+        import pyarrow.parquet as pq
+
+        return pq.read_table(path).to_pylist()
+    rows = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            row = json.loads(line)
+            row["completed_at"] = datetime.fromisoformat(row["completed_at"])
+            rows.append(row)
+    return rows
+
+
+def _partitions(archive_dir: str) -> List[Tuple[str, str]]:
+    """Разделы архива (день, каталог) по возрастанию дня"""
+    table_dir = _table_dir(archive_dir)
+    if not os.path.isdir(table_dir):
+        return []
+    return sorted(
+        (name[len(PARTITION_PREFIX):], os.path.join(table_dir, name))
+        for name in os.listdir(table_dir) if name.startswith(PARTITION_PREFIX)
+    )
+
+
+def _part_files(partition_dir: str) -> List[str]:
+    return sorted(
+        os.path.join(partition_dir, name) for name in os.listdir(partition_dir)
+        if name.endswith(tuple(FORMAT_SUFFIXES.values())) and not name.startswith(".")
+    )
+
+
+def _stored_quiz_options() -> List[Tuple[str, str, List[List[Tuple[str, int]]]]]:
+    """(версия, тест, варианты ответов) всех сохраненных версий контента, новые первыми"""
+    candidates = []
+    for stored in versions_collection.find({}, {"raw": 1}).sort("published_at", -1):
+        for quiz_id in raw_quiz_ids(stored["raw"]):
+            options = raw_quiz_options(stored["raw"], quiz_id)
+            if options:
+                candidates.append((str(stored["_id"]), quiz_id, options))
+    return candidates
+
+
+def _match_version(document: Dict[str, Any], candidates) -> Optional[Tuple[str, str]]:
+    """Тест и версия контента, в которой есть все ответы документа с теми же текстами и баллами"""
+    for version, quiz_id, options in candidates:
+        if document.get("quiz_id") not in (None, quiz_id):
+            continue
+        if all(
+            answer["question_index"] < len(options)
+            and answer["answer_index"] < len(options[answer["question_index"]])
+            and options[answer["question_index"]][answer["answer_index"]]
+            == (answer.get("answer_text"), answer.get("score"))
+            for answer in document["answers"]
+        ):
+            return quiz_id, version
+    return None
+
+
+def _compact_legacy_sync(batch_size: int) -> Dict[str, int]:
+    """Перевод ответов старого формата (словари с текстами) в индексы вариантов.
+
+    Индексы восстанавливаются в тексты только по версии контента, поэтому
+    документ сжимается вместе с найденными quiz_id и quiz_version; если ни
+    одна сохраненная версия не совпала с ответами, документ не меняется.
+    """
+    collection = database.test_results_collection
+    candidates = _stored_quiz_options()
+    report = {"compacted": 0, "unmatched": 0}
+    last_id = None
+    while _renew_lease():
+        query: Dict[str, Any] = {"answers.0.answer_index": {"$exists": True}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        documents = list(collection.find(query, {"answers": 1, "quiz_id": 1}).sort("_id", 1).limit(batch_size))
+        if not documents:
+            break
+        last_id = documents[-1]["_id"]
+        operations = []
+        for document in documents:
+            matched = _match_version(document, candidates)
+            if matched is None:
+                report["unmatched"] += 1
+                continue
+            quiz_id, version = matched
+            operations.append(UpdateOne(
+                {"_id": document["_id"], "answers": document["answers"]},
+                {"$set": {
+                    "answers": [option for _, option in database.answer_pairs(document["answers"])],
+                    "quiz_id": quiz_id,
+                    "quiz_version": version,
+                }}
+            ))
+        if operations:
+            report["compacted"] += collection.bulk_write(operations, ordered=False).modified_count
+    return report
+
+
+async def compact_legacy(batch_size: int = RETENTION_BATCH_SIZE) -> Optional[Dict[str, Any]]:
+    """Сжатие ответов старого формата по явному запросу (нужен RETENTION_COMPACT_LEGACY=1).
+
+    None, если задачу уже выполняет другой процесс.
+    """
+    if not RETENTION_COMPACT_LEGACY:
+        raise ValueError("Сжатие старых ответов выключено (RETENTION_COMPACT_LEGACY)")
+    if not await run_sync(_acquire_lease):
+        return None
+    try:
+        report = await run_sync(_compact_legacy_sync, batch_size)
+    finally:
+        await run_sync(_release_lease)
+    logger.info(f"Сжатие старых ответов: сжато {report['compacted']}, без совпавшей версии {report['unmatched']}")
+    return report
+
+
+def _archive_sync(cutoff: datetime, archive_dir: str, fmt: str, batch_size: int) -> int:
+    """Перенос результатов с completed_at < cutoff в архив пачками.
+
+    Пачка сначала записывается на диск, затем удаляется из MongoDB: при
+    сбое между шагами результаты окажутся и там, и там, а не пропадут;
+    повторы по id отсеиваются при чтении архива. Захват задачи продлевается
+    перед каждой пачкой; если его перехватил другой процесс, проход
+    останавливается.
+    """
+    collection = database.test_results_collection
+    archived = 0
+    candidates = None
+    while _renew_lease():
+        documents = list(
+            collection.find({"completed_at": {"$lt": cutoff}})
+            .sort([("completed_at", 1), ("_id", 1)])
+            .limit(batch_size)
+        )
+        if not documents:
+            return archived
+        by_day: Dict[str, List[Dict[str, Any]]] = {}
+        for document in documents:
+            answers = document.get("answers")
+            if document.get("quiz_version") is None and answers and isinstance(answers[0], dict):
+                # В архиве ответы - индексы: без версии контента их не восстановить в тексты
+                if candidates is None:
+                    candidates = _stored_quiz_options()
+                matched = _match_version(document, candidates)
+                if matched is not None:
+                    document["quiz_id"], document["quiz_version"] = matched
+            row = _row(document)
+            by_day.setdefault(row["completed_at"].strftime(PARTITION_FORMAT), []).append(row)
+        for day, rows in by_day.items():
+            _write_part(os.path.join(_table_dir(archive_dir), f"{PARTITION_PREFIX}{day}"), rows, fmt)
+        collection.delete_many({"_id": {"$in": [document["_id"] for document in documents]}})
+        archived += len(documents)
+    return archived
+
+
+def _expire_sync(archive_dir: str, ttl_days: int) -> int:
+    """Удаление разделов архива старше ttl_days"""
+    oldest = (datetime.utcnow() - timedelta(days=ttl_days)).strftime(PARTITION_FORMAT)
+    expired = 0
+    for day, path in _partitions(archive_dir):
+        if day < oldest:
+            shutil.rmtree(path)
+            expired += 1
+    return expired
+
+
+def _acquire_lease() -> bool:
+    """Захват задачи: в нескольких процессах API переносом занимается один"""
+    now = datetime.utcnow()
+    try:
+        runs_collection.update_one(
+            {"_id": RUN_ID, "$or": [{"locked_until": {"$lt": now}}, {"locked_until": {"$exists": False}}]},
+            {"$set": {"locked_until": now + timedelta(seconds=LEASE_SECONDS), "owner": _owner}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+def _renew_lease() -> bool:
+    """Продление захвата перед следующей пачкой; False, если задачу захватил другой процесс"""
+    result = runs_collection.update_one(
+        {"_id": RUN_ID, "owner": _owner},
+        {"$set": {"locked_until": datetime.utcnow() + timedelta(seconds=LEASE_SECONDS)}}
+    )
+    if not result.matched_count:
+        logger.warning("Захват переноса в архив перешел к другому процессу, проход остановлен")
+        return False
+    return True
+
+
+def _release_lease(last_run: Optional[Dict[str, Any]] = None):
+    update: Dict[str, Any] = {"locked_until": datetime.utcnow()}
+    if last_run is not None:
+        update["last_run"] = last_run
+    runs_collection.update_one({"_id": RUN_ID, "owner": _owner}, {"$set": update})
+
+
+async def run_once(
+    days: int = RETENTION_DAYS,
+    archive_dir: str = RETENTION_ARCHIVE_DIR,
+    fmt: str = RETENTION_FORMAT,
+    batch_size: int = RETENTION_BATCH_SIZE,
+    archive_ttl_days: int = ARCHIVE_TTL_DAYS
+) -> Optional[Dict[str, Any]]:
+    """Один проход: перенос в архив и удаление старых разделов.
+
+    None, если проход уже выполняет другой процесс.
+    """
+    if fmt not in FORMAT_SUFFIXES:
+        raise ValueError(f"Формат архива должен быть одним из: {', '.join(FORMAT_SUFFIXES)}")
+    if not await run_sync(_acquire_lease):
+        return None
+    started = datetime.utcnow()
+    report: Dict[str, Any] = {"started_at": started, "archived": 0, "expired_partitions": 0}
+    try:
+        if days > 0:
+            cutoff = started - timedelta(days=days)
+            report["archived"] = await run_sync(_archive_sync, cutoff, archive_dir, fmt, batch_size)
+        if archive_ttl_days > 0:
+            report["expired_partitions"] = await asyncio.to_thread(_expire_sync, archive_dir, archive_ttl_days)
+        report["finished_at"] = datetime.utcnow()
+    finally:
+        await run_sync(_release_lease, report)
+    logger.info(
+        f"Хранение результатов: в архив {report['archived']}, удалено разделов {report['expired_partitions']}"
+    )
+    return report
+
+
+async def _run_periodically():
+    while True:
+        try:
+            await run_once()
+        except (PyMongoError, OSError) as e:
+            logger.error(f"Ошибка переноса результатов в архив: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+
+def start():
+    """Запуск периодического прохода в текущем event loop"""
+    global _task
+    if RETENTION_FORMAT not in FORMAT_SUFFIXES:
+        raise ValueError(f"Неизвестный формат архива: {RETENTION_FORMAT}")
+    _task = asyncio.get_running_loop().create_task(_run_periodically())
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+
+
+def _iter_archive(
+    archive_dir: str,
+    date_from: Optional[datetime],
+    date_to: Optional[datetime]
+) -> Iterator[List[Dict[str, Any]]]:
+    """Строки разделов в окне, от новых разделов к старым (раздел целиком в памяти)"""
+    first = date_from.strftime(PARTITION_FORMAT) if date_from else None
+    last = date_to.strftime(PARTITION_FORMAT) if date_to else None
+    for day, path in reversed(_partitions(archive_dir)):
+        if (first and day < first) or (last and day > last):
+            continue
+        rows: Dict[str, Dict[str, Any]] = {}
+        for part in _part_files(path):
+            for row in _read_part(part):
+                # Повтор после сбоя между записью части и удалением из MongoDB
+                rows[row["id"]] = row
+        yield sorted(rows.values(), key=lambda row: (row["completed_at"], row["id"]), reverse=True)
+
+
+def archived_rows(archive_dir: str = RETENTION_ARCHIVE_DIR) -> Iterator[List[Dict[str, Any]]]:
+    """Строки всего архива без повторов, по одному разделу за раз"""
+    return _iter_archive(archive_dir, None, None)
+
+
+def _query_archive_sync(
+    archive_dir: str,
+    limit: int,
+    position: Optional[Dict[str, Any]],
+    date_from: Optional[datetime],
+    date_to: Optional[datetime],
+    filters: Dict[str, Any]
+) -> Tuple[List[Dict[str, Any]], bool]:
+    found: List[Dict[str, Any]] = []
+    for rows in _iter_archive(archive_dir, date_from, date_to):
+        for row in rows:
+            if position and (row["completed_at"], row["id"]) >= (position["t"], position["id"]):
+                continue
+            if (date_from and row["completed_at"] < date_from) or (date_to and row["completed_at"] >= date_to):
+                continue
+            if filters["user_id"] and row["user_id"] != filters["user_id"]:
+                continue
+            if filters["quiz_id"] and row["quiz_id"] != filters["quiz_id"]:
+                continue
+            if filters["min_score"] is not None and row["total_score"] < filters["min_score"]:
+                continue
+            if filters["max_score"] is not None and row["total_score"] > filters["max_score"]:
+                continue
+            found.append(row)
+            if len(found) > limit:
+                return found[:limit], True
+    return found, False
+
+
+async def list_archived_results(
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    completed_from: Optional[datetime] = None,
+    completed_to: Optional[datetime] = None,
+    min_score: Optional[int] = None,
+    max_score: Optional[int] = None,
+    user_id: Optional[str] = None,
+    quiz_id: Optional[str] = None,
+    archive_dir: str = RETENTION_ARCHIVE_DIR
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Страница архивных результатов (новые первыми) и курсор следующей страницы.
+
+    Читаются только разделы за дни из окна completed_from..completed_to.
+    """
+    position = database.decode_cursor(cursor, "t", "id") if cursor else None
+    filters = {"user_id": user_id, "quiz_id": quiz_id, "min_score": min_score, "max_score": max_score}
+    rows, has_more = await asyncio.to_thread(
+        _query_archive_sync, archive_dir, limit, position, completed_from, completed_to, filters
+    )
+    next_cursor = None
+    if has_more:
+        next_cursor = database.encode_cursor({"t": rows[-1]["completed_at"], "id": rows[-1]["id"]})
+    return rows, next_cursor
+
+
+async def _quiz_options(version: str, quiz_id: Optional[str]) -> Optional[List[List[Tuple[str, int]]]]:
+    key = (version, quiz_id)
+    if key not in _options_cache:
+        stored = await run_sync(versions_collection.find_one, {"_id": version}, {"raw": 1})
+        _options_cache[key] = raw_quiz_options(stored["raw"], quiz_id) if stored else None
+    return _options_cache[key]
+
+
+async def expand_answers(documents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Компактные ответы в словари с текстом и баллами по сохраненной версии контента"""
+    for document in documents:
+        answers = document.get("answers")
+        if not answers or isinstance(answers[0], dict):
+            continue
+        options = None
+        if document.get("quiz_version") is not None:
+            options = await _quiz_options(str(document["quiz_version"]), document.get("quiz_id"))
+        expanded = []
+        for question, option in database.answer_pairs(answers):
+            answer: Dict[str, Any] = {"question_index": question, "answer_index": option}
+            if options and question < len(options) and option < len(options[question]):
+                answer["answer_text"], answer["score"] = options[question][option]
+            expanded.append(answer)
+        document["answers"] = expanded
+    return documents
+
+
+def _archive_stats_sync(archive_dir: str) -> Dict[str, Any]:
+    partitions = _partitions(archive_dir)
+    files = [part for _, path in partitions for part in _part_files(path)]
+    return {
+        "partitions": len(partitions),
+        "files": len(files),
+        "bytes": sum(os.path.getsize(part) for part in files),
+        "oldest_partition": partitions[0][0] if partitions else None,
+        "newest_partition": partitions[-1][0] if partitions else None,
+    }
+
+
+async def get_stats(archive_dir: str = RETENTION_ARCHIVE_DIR) -> Dict[str, Any]:
+    """Размер горячей коллекции, архива и итог последнего прохода"""
+    state = await run_sync(runs_collection.find_one, {"_id": RUN_ID}) or {}
+    return {
+        "retention_days": RETENTION_DAYS,
+        "archive_ttl_days": ARCHIVE_TTL_DAYS,
+        "format": RETENTION_FORMAT,
+        "hot_test_results": await database.count_test_results(),
+        "archive": await asyncio.to_thread(_archive_stats_sync, archive_dir),
+        "last_run": state.get("last_run"),
+    }
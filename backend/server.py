@@ -1,13 +1,24 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from pydantic import BaseModel
-from pymongo import MongoClient
+from typing import List, Optional
+from datetime import datetime
 import os
 from dotenv import load_dotenv
-import asyncio
-import threading
 import logging
+import hmac
+
+import database
+import stats
+import export
+import metrics
+import broadcast
+import funnel
+import live
+import retention
+from supervisor import BotSupervisor, STATE_RUNNING, STATE_STOPPED
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -16,12 +27,16 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Настройка MongoDB
-MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017")
-DB_NAME = os.getenv("DB_NAME", "test_database")
+# Режим получения обновлений: polling (поток с long polling), webhook
+# или worker (обновления пересылает диспетчер шардов, см. dispatcher.py)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Публичный адрес, по которому Telegram будет отправлять обновления
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Секрет, который Telegram передает в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
 
-client = MongoClient(MONGO_URL)
-db = client[DB_NAME]
+# Максимальный размер страницы списков в API
+MAX_PAGE_SIZE = 200
 
 # Создание FastAPI приложения
 app = FastAPI(title="Anna Hertz Telegram Bot API", version="1.0.0")
@@ -37,82 +52,272 @@ app.add_middleware(
 
 # Глобальная переменная для статуса бота
 bot_status = {"running": False, "message": "Бот не запущен"}
+# Экземпляр бота (создается в потоке бота)
+telegram_bot = None
+# Супервизор потока бота в режиме polling
+bot_supervisor = None
+# Живая лента для панели (один источник событий на всех клиентов)
+live_feed = live.LiveFeed()
 
 class BotStatus(BaseModel):
     status: str
     message: str
+    state: str
+    restart_count: int = 0
+    last_error: Optional[str] = None
+    last_error_at: Optional[datetime] = None
+    started_at: Optional[datetime] = None
+    last_update_at: Optional[datetime] = None
+    last_polling_error: Optional[str] = None
+    heartbeat_age: Optional[float] = None
+    next_restart_in: Optional[float] = None
+
+class BroadcastCreate(BaseModel):
+    text: str
+    document_path: Optional[str] = None
+    start: bool = True
 
 @app.on_event("startup")
 async def startup_event():
     """Событие запуска приложения"""
-    global bot_status
+    global bot_status, bot_supervisor
     
     logger.info("Запуск FastAPI сервера...")
+    metrics.start_loop_monitor("api")
+
+    try:
+        await database.ensure_indexes()
+        await broadcast.ensure_indexes()
+    except Exception as e:
+        logger.error(f"Ошибка при создании индексов MongoDB: {e}")
+    # Сжатие ответов и перенос старых результатов в архив (один процесс за раз)
+    retention.start()
+
+    if BOT_MODE == "webhook":
+        await start_webhook_bot()
+        return
+    if BOT_MODE == "worker":
+        await start_worker_bot()
+        return
     
-    # Импортируем и запускаем бота в отдельном процессе
-    def run_bot():
-        try:
-            from telegram_bot import TelegramBot
-            import asyncio
-            
-            # Создаем новый event loop для бота
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            
-            bot = TelegramBot()
-            
-            # Запускаем бота в бесконечном цикле
-            while True:
-                try:
-                    loop.run_until_complete(bot.run())
-                except KeyboardInterrupt:
-                    break
-                except Exception as e:
-                    logger.error(f"Ошибка в боте: {e}")
-                    asyncio.sleep(5)  # Пауза перед перезапуском
-            
-        except Exception as e:
-            logger.error(f"Ошибка при запуске Telegram бота: {e}")
-            bot_status["running"] = False
-            bot_status["message"] = f"Ошибка: {str(e)}"
-    
-    # Запускаем бота в отдельном потоке
-    bot_thread = threading.Thread(target=run_bot, daemon=True)
-    bot_thread.start()
-    
+    # Бот с long polling работает в отдельном потоке под наблюдением супервизора
+    from telegram_bot import TelegramBot
+
+    bot_supervisor = BotSupervisor(TelegramBot, on_bot_created=set_telegram_bot)
+    bot_supervisor.start()
+
     bot_status["running"] = True
     bot_status["message"] = "Telegram бот запущен"
     
     logger.info("Telegram бот запущен в фоновом режиме")
 
+def set_telegram_bot(bot):
+    """Текущий экземпляр бота (меняется при перезапуске супервизором)"""
+    global telegram_bot
+    telegram_bot = bot
+
+async def start_webhook_bot():
+    """Запуск бота в режиме вебхука в event loop сервера"""
+    global telegram_bot
+    from telegram_bot import TelegramBot
+
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise RuntimeError("Для BOT_MODE=webhook нужны WEBHOOK_URL и WEBHOOK_SECRET")
+
+    bot = TelegramBot()
+    await bot.start_webhook(WEBHOOK_URL, WEBHOOK_SECRET)
+    telegram_bot = bot
+
+    bot_status["running"] = True
+    bot_status["message"] = "Telegram бот запущен (webhook)"
+    logger.info("Telegram бот запущен в режиме вебхука")
+
+async def start_worker_bot():
+    """Запуск бота как воркера шарда: вебхук регистрирует диспетчер"""
+    global telegram_bot
+    from telegram_bot import TelegramBot
+
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("Для BOT_MODE=worker нужен WEBHOOK_SECRET")
+
+    bot = TelegramBot()
+    await bot.start(polling=False)
+    telegram_bot = bot
+
+    bot_status["running"] = True
+    bot_status["message"] = "Telegram бот запущен (worker)"
+    logger.info("Telegram бот запущен в режиме воркера шарда")
+
 @app.on_event("shutdown")
 async def shutdown_event():
     """Событие остановки приложения"""
     logger.info("Остановка приложения...")
     global bot_status
+    if bot_supervisor is not None:
+        # Бот дообрабатывает полученные обновления в своем потоке
+        await bot_supervisor.stop()
+    elif BOT_MODE in ("webhook", "worker") and telegram_bot is not None:
+        await telegram_bot.stop()
+    await live_feed.close()
+    await retention.stop()
+    # Сбрасываем накопленные записи до закрытия соединений с MongoDB
+    await database.stop_write_behind()
     bot_status["running"] = False
     bot_status["message"] = "Бот остановлен"
+    database.close()
 
 @app.get("/")
 async def root():
     """Корневой эндпоинт"""
     return {"message": "Anna Hertz Telegram Bot API is running"}
 
+def current_bot_status() -> dict:
+    """Состояние бота: от супервизора в режиме polling, иначе по флагу запуска"""
+    if bot_supervisor is not None:
+        return bot_supervisor.status()
+    return {
+        "state": STATE_RUNNING if bot_status["running"] else STATE_STOPPED,
+        "last_update_at": getattr(telegram_bot, "last_update_at", None),
+    }
+
 @app.get("/api/bot/status", response_model=BotStatus)
 async def get_bot_status():
     """Получение статуса бота"""
     global bot_status
     
+    details = current_bot_status()
     status = "running" if bot_status["running"] else "stopped"
     message = bot_status["message"]
+    if details["state"] != STATE_RUNNING and bot_status["running"]:
+        message = f"Бот в состоянии {details['state']}"
     
-    return BotStatus(status=status, message=message)
+    return BotStatus(status=status, message=message, **details)
+
+@app.post("/api/telegram/webhook")
+async def telegram_webhook(
+    request: Request,
+    x_telegram_bot_api_secret_token: Optional[str] = Header(None)
+):
+    """Прием обновлений от Telegram в режиме вебхука"""
+    if BOT_MODE not in ("webhook", "worker") or telegram_bot is None:
+        raise HTTPException(status_code=503, detail="Бот не работает в режиме вебхука")
+
+    if not hmac.compare_digest((x_telegram_bot_api_secret_token or "").encode(), WEBHOOK_SECRET.encode()):
+        raise HTTPException(status_code=403, detail="Неверный секрет вебхука")
+
+    data = await request.json()
+    # Воркер отвечает только после обработки, чтобы диспетчер соблюдал порядок
+    await telegram_bot.process_update_json(data, wait=BOT_MODE == "worker")
+    return {"ok": True}
+
+@app.get("/api/bot/subscription-cache")
+async def get_subscription_cache_stats():
+    """Статистика кэша проверки подписки"""
+    if telegram_bot is None:
+        raise HTTPException(status_code=503, detail="Бот не запущен")
+    return telegram_bot.subscription_cache.stats()
+
+@app.get("/api/write-buffer")
+async def get_write_buffer_stats():
+    """Метрики буфера отложенной записи"""
+    if database.write_buffer is None:
+        return {"enabled": database.WRITE_BEHIND, "running": False}
+    return {"enabled": database.WRITE_BEHIND, **database.write_buffer.stats()}
+
+@app.get("/api/content")
+async def get_content_info():
+    """Версия загруженного контента бота"""
+    if telegram_bot is None:
+        raise HTTPException(status_code=503, detail="Бот не запущен")
+    return telegram_bot.content.info()
+
+@app.post("/api/content/reload")
+async def reload_content():
+    """Немедленная проверка изменений контента"""
+    if telegram_bot is None:
+        raise HTTPException(status_code=503, detail="Бот не запущен")
+    try:
+        # В режиме polling контент принадлежит event loop потока бота
+        reloaded = await telegram_bot.content.reload_from_any_loop()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"reloaded": reloaded, **telegram_bot.content.info()}
+
+@app.get("/api/bot/rate-limiter")
+async def get_rate_limiter_stats():
+    """Счетчики ограничителя исходящих запросов"""
+    if telegram_bot is None:
+        raise HTTPException(status_code=503, detail="Бот не запущен")
+    return telegram_bot.rate_limiter.stats()
+
+@app.get("/api/bot/pdf-cache")
+async def get_pdf_cache_stats():
+    """Счетчики кэша персональных PDF"""
+    if telegram_bot is None:
+        raise HTTPException(status_code=503, detail="Бот не запущен")
+    return telegram_bot.pdf_renderer.stats()
+
+@app.post("/api/broadcasts")
+async def create_broadcast(request: BroadcastCreate):
+    """Запуск рассылки по всем пользователям (start=false - создать на паузе)"""
+    # Подпись к документу короче обычного сообщения
+    max_length = 1024 if request.document_path else 4096
+    if not request.text.strip() or len(request.text) > max_length:
+        raise HTTPException(status_code=400, detail=f"Текст рассылки должен быть от 1 до {max_length} символов")
+    try:
+        return await broadcast.create_broadcast(request.text, request.document_path, request.start)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def change_broadcast_status(broadcast_id: str, status: str):
+    """Смена статуса рассылки с проверкой перехода"""
+    try:
+        result = await broadcast.set_broadcast_status(broadcast_id, status)
+        if result is None and await broadcast.get_broadcast(broadcast_id) is None:
+            raise HTTPException(status_code=404, detail="Рассылка не найдена")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if result is None:
+        raise HTTPException(status_code=409, detail="Недопустимый переход статуса рассылки")
+    return result
+
+@app.post("/api/broadcasts/{broadcast_id}/pause")
+async def pause_broadcast(broadcast_id: str):
+    """Пауза рассылки; отправка останавливается после текущей пачки"""
+    return await change_broadcast_status(broadcast_id, broadcast.STATUS_PAUSED)
+
+@app.post("/api/broadcasts/{broadcast_id}/resume")
+async def resume_broadcast(broadcast_id: str):
+    """Продолжение рассылки с сохраненного курсора"""
+    return await change_broadcast_status(broadcast_id, broadcast.STATUS_RUNNING)
+
+@app.get("/api/broadcasts/{broadcast_id}")
+async def get_broadcast(broadcast_id: str):
+    """Статус и прогресс доставки рассылки"""
+    try:
+        result = await broadcast.get_broadcast(broadcast_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if result is None:
+        raise HTTPException(status_code=404, detail="Рассылка не найдена")
+    return result
+
+def parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """Список полей из параметра fields=a,b,c"""
+    if not fields:
+        return None
+    return [field.strip() for field in fields.split(",") if field.strip()]
 
 @app.get("/api/users/count")
-async def get_users_count():
+async def get_users_count(test_completed: Optional[bool] = None):
     """Получение количества пользователей"""
     try:
-        count = db.users.count_documents({})
+        if test_completed is None:
+            count = await database.count_users()
+        else:
+            count = await database.cached_count(
+                database.users_collection, {"test_completed": test_completed}
+            )
         return {"total_users": count}
     except Exception as e:
         logger.error(f"Ошибка при получении количества пользователей: {e}")
@@ -122,50 +327,265 @@ async def get_users_count():
 async def get_test_results_count():
     """Получение количества завершенных тестов"""
     try:
-        count = db.test_results.count_documents({})
+        count = await database.count_test_results()
         return {"total_tests": count}
     except Exception as e:
         logger.error(f"Ошибка при получении количества тестов: {e}")
         raise HTTPException(status_code=500, detail="Ошибка при получении данных")
 
 @app.get("/api/users")
-async def get_users():
-    """Получение списка пользователей"""
+async def get_users(
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    test_completed: Optional[bool] = None
+):
+    """Получение списка пользователей (постранично, новые первыми)"""
     try:
-        users = list(db.users.find({}, {"_id": 0}).limit(50))
-        return {"users": users}
+        users, next_cursor = await database.list_users(
+            limit=limit,
+            cursor=cursor,
+            fields=parse_fields(fields),
+            created_from=created_from,
+            created_to=created_to,
+            test_completed=test_completed
+        )
+        return {"users": users, "next_cursor": next_cursor}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Ошибка при получении пользователей: {e}")
         raise HTTPException(status_code=500, detail="Ошибка при получении данных")
 
 @app.get("/api/test-results")
-async def get_test_results():
-    """Получение результатов тестов"""
+async def get_test_results(
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    completed_from: Optional[datetime] = None,
+    completed_to: Optional[datetime] = None,
+    min_score: Optional[int] = None,
+    max_score: Optional[int] = None,
+    user_id: Optional[str] = None,
+    expand_answers: bool = True
+):
+    """Получение результатов тестов (постранично, новые первыми)"""
     try:
-        results = list(db.test_results.find({}, {"_id": 0}).limit(50))
-        return {"test_results": results}
+        results, next_cursor = await database.list_test_results(
+            limit=limit,
+            cursor=cursor,
+            fields=parse_fields(fields),
+            completed_from=completed_from,
+            completed_to=completed_to,
+            min_score=min_score,
+            max_score=max_score,
+            user_id=user_id
+        )
+        if expand_answers:
+            await retention.expand_answers(results)
+        return {"test_results": results, "next_cursor": next_cursor}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Ошибка при получении результатов тестов: {e}")
         raise HTTPException(status_code=500, detail="Ошибка при получении данных")
 
+@app.get("/api/archive/test-results")
+async def get_archived_test_results(
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    completed_from: Optional[datetime] = None,
+    completed_to: Optional[datetime] = None,
+    min_score: Optional[int] = None,
+    max_score: Optional[int] = None,
+    user_id: Optional[str] = None,
+    quiz_id: Optional[str] = None,
+    expand_answers: bool = True
+):
+    """Результаты тестов из архива (постранично, новые первыми); окно по датам сужает чтение"""
+    try:
+        results, next_cursor = await retention.list_archived_results(
+            limit=limit,
+            cursor=cursor,
+            completed_from=completed_from,
+            completed_to=completed_to,
+            min_score=min_score,
+            max_score=max_score,
+            user_id=user_id,
+            quiz_id=quiz_id
+        )
+        if expand_answers:
+            await retention.expand_answers(results)
+        return {"test_results": results, "next_cursor": next_cursor}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Ошибка при чтении архива результатов: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка при получении данных")
+
+@app.get("/api/retention")
+async def get_retention_stats():
+    """Размер горячей коллекции и архива, итог последнего переноса"""
+    try:
+        return await retention.get_stats()
+    except Exception as e:
+        logger.error(f"Ошибка при получении статистики хранения: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка при получении данных")
+
+@app.post("/api/retention/run")
+async def run_retention():
+    """Внеочередной перенос старых результатов в архив"""
+    try:
+        report = await retention.run_once()
+    except Exception as e:
+        logger.error(f"Ошибка переноса результатов в архив: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка переноса результатов в архив")
+    if report is None:
+        raise HTTPException(status_code=409, detail="Перенос уже выполняется")
+    return report
+
+@app.post("/api/retention/compact-legacy")
+async def compact_legacy_answers():
+    """Сжатие ответов старого формата (только с RETENTION_COMPACT_LEGACY=1)"""
+    try:
+        report = await retention.compact_legacy()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Ошибка сжатия старых ответов: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка сжатия старых ответов")
+    if report is None:
+        raise HTTPException(status_code=409, detail="Задача хранения уже выполняется")
+    return report
+
+def export_response(collection, columns, time_field, name, fmt, gzip, since, after_id, transform=None):
+    """Потоковый ответ с выгрузкой коллекции"""
+    try:
+        stream, media_type = export.export_stream(
+            collection, columns, time_field, fmt=fmt, gzip=gzip, since=since, after_id=after_id,
+            transform=transform
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    filename = export.export_filename(name, fmt, gzip)
+    return StreamingResponse(
+        stream,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@app.get("/api/export/users")
+async def export_users(
+    format: str = "ndjson",
+    gzip: bool = False,
+    since: Optional[datetime] = None,
+    after_id: Optional[str] = None
+):
+    """Выгрузка пользователей (NDJSON/CSV), since - по created_at, after_id - по _id"""
+    return export_response(
+        database.users_collection, export.USER_COLUMNS, "created_at",
+        "users", format, gzip, since, after_id
+    )
+
+@app.get("/api/export/test-results")
+async def export_test_results(
+    format: str = "ndjson",
+    gzip: bool = False,
+    since: Optional[datetime] = None,
+    after_id: Optional[str] = None
+):
+    """Выгрузка результатов тестов (NDJSON/CSV), since - по completed_at, after_id - по _id"""
+    return export_response(
+        database.test_results_collection, export.TEST_RESULT_COLUMNS, "completed_at",
+        "test-results", format, gzip, since, after_id,
+        # Ответы хранятся индексами вариантов - в выгрузке они с текстом и баллами, как раньше
+        transform=retention.expand_answers
+    )
+
+@app.get("/api/stats")
+async def get_stats(quiz_id: Optional[str] = None, quiz_version: Optional[str] = None):
+    """Сводная статистика по результатам тестов, отдельно по тестам и версиям контента"""
+    try:
+        return await stats.get_stats(quiz_id, quiz_version)
+    except Exception as e:
+        logger.error(f"Ошибка при получении статистики: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка при получении данных")
+
+@app.post("/api/stats/rebuild")
+async def rebuild_stats():
+    """Полный пересчет сводок по сохраненным результатам"""
+    try:
+        completions = await stats.rebuild()
+        return {"completions": completions}
+    except Exception as e:
+        logger.error(f"Ошибка при пересчете статистики: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка при пересчете статистики")
+
+@app.get("/api/funnel")
+async def get_funnel(
+    date_from: Optional[datetime] = Query(None, alias="from"),
+    date_to: Optional[datetime] = Query(None, alias="to"),
+    quiz_id: Optional[str] = None
+):
+    """Воронка теста за окно (по умолчанию последние сутки): конверсия и время между шагами"""
+    try:
+        return await funnel.get_funnel(date_from, date_to, quiz_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Ошибка при расчете воронки: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка при получении данных")
+
+@app.get("/api/live")
+async def get_live_feed(request: Request):
+    """Живая лента (Server-Sent Events): новые пользователи, результаты тестов и счетчики"""
+    try:
+        queue = await live_feed.subscribe()
+    except live.LiveFeedFull:
+        raise HTTPException(status_code=503, detail="Слишком много подключений к живой ленте")
+    except Exception as e:
+        logger.error(f"Ошибка при запуске живой ленты: {e}")
+        raise HTTPException(status_code=503, detail="Живая лента недоступна")
+    return StreamingResponse(
+        live.sse_stream(live_feed, queue, request.is_disconnected),
+        media_type="text/event-stream",
+        # X-Accel-Buffering: nginx не должен копить события
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/live/stats")
+async def get_live_feed_stats():
+    """Источник, клиенты и счетчики живой ленты"""
+    return live_feed.stats()
+
+@app.get("/metrics")
+async def get_metrics():
+    """Метрики в формате Prometheus"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 @app.get("/api/health")
 async def health_check():
     """Проверка здоровья приложения"""
     try:
         # Проверяем подключение к MongoDB
-        db.command('ping')
+        await database.ping()
         mongo_status = "connected"
     except Exception:
         mongo_status = "disconnected"
     
     # Проверяем статус бота
-    global bot_status
-    telegram_bot_status = "running" if bot_status["running"] else "stopped"
+    details = current_bot_status()
+    healthy = mongo_status == "connected" and details["state"] == STATE_RUNNING
     
     return {
-        "status": "healthy",
+        "status": "healthy" if healthy else "degraded",
         "mongodb": mongo_status,
-        "telegram_bot": telegram_bot_status,
+        "telegram_bot": details["state"],
+        "bot_restart_count": details.get("restart_count", 0),
+        "bot_last_error": details.get("last_error"),
+        "bot_last_update_at": details.get("last_update_at"),
         "message": "API is working properly"
     }
 
@@ -0,0 +1,162 @@
+"""Стенд для проверки масштабирования диспетчера шардов по числу воркеров.
+
+Запускает N процессов-воркеров, которые имитируют обработку обновления
+(CPU-работа плюс ожидание ввода-вывода), и прогоняет через ShardDispatcher
+квиз-сессии множества пользователей. Для каждого N печатается пропускная
+способность и число нарушений порядка обновлений одного пользователя
+(должно быть 0).
+
+Пример:
+    python shard_bench.py --workers 1 2 4 --users 500 --cpu-ms 5
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import subprocess
+from typing import Dict, List
+
+import httpx
+from fastapi import FastAPI, Request
+
+from dispatcher import ShardDispatcher, WORKER_PATH
+from fake_telegram import FakeTelegramSender
+
+BENCH_SECRET = "shard-bench-secret"
+
+# Воркер-имитация: нагрузка задается переменными окружения
+worker_app = FastAPI()
+_worker_state: Dict[str, object] = {"last_seen": {}, "processed": 0, "order_violations": 0}
+
+
+def _burn_cpu(milliseconds: float):
+    deadline = time.perf_counter() + milliseconds / 1000
+    while time.perf_counter() < deadline:
+        pass
+
+
+@worker_app.post(WORKER_PATH)
+async def fake_worker_webhook(request: Request):
+    update = await request.json()
+    user_id = update["callback_query"]["from"]["id"] if "callback_query" in update else update["message"]["from"]["id"]
+
+    last_seen = _worker_state["last_seen"]
+    if last_seen.get(user_id, 0) > update["update_id"]:
+        _worker_state["order_violations"] += 1
+    last_seen[user_id] = update["update_id"]
+
+    _burn_cpu(float(os.getenv("BENCH_CPU_MS", "5")))
+    await asyncio.sleep(float(os.getenv("BENCH_IO_MS", "20")) / 1000)
+    _worker_state["processed"] += 1
+    return {"ok": True}
+
+
+@worker_app.get("/stats")
+async def fake_worker_stats():
+    return {
+        "processed": _worker_state["processed"],
+        "order_violations": _worker_state["order_violations"],
+    }
+
+
+def quiz_session(sender: FakeTelegramSender, user_id: int) -> List[dict]:
+    """Обновления одной сессии: /start, проверка подписки, тест и рацион"""
+    updates = [
+        sender.start_update(user_id),
+        sender.callback_update(user_id, "check_subscription"),
+        sender.callback_update(user_id, "start_test"),
+    ]
+    updates += [sender.callback_update(user_id, f"answer_{q}_0") for q in range(5)]
+    updates.append(sender.callback_update(user_id, "get_diet"))
+    return updates
+
+
+async def wait_for_workers(urls: List[str], client: httpx.AsyncClient, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    for url in urls:
+        while True:
+            try:
+                await client.get(url + "/stats")
+                break
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+
+
+async def run_round(worker_count: int, args) -> Dict[str, object]:
+    env = {**os.environ, "BENCH_CPU_MS": str(args.cpu_ms), "BENCH_IO_MS": str(args.io_ms)}
+    urls = [f"http://127.0.0.1:{args.base_port + i}" for i in range(worker_count)]
+    processes = [
+        subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "shard_bench:worker_app",
+             "--host", "127.0.0.1", "--port", str(args.base_port + i), "--log-level", "warning"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env
+        )
+        for i in range(worker_count)
+    ]
+    try:
+        async with httpx.AsyncClient(timeout=60, limits=httpx.Limits(max_connections=args.max_in_flight)) as client:
+            await wait_for_workers(urls, client)
+
+            dispatcher = ShardDispatcher(urls, BENCH_SECRET, max_in_flight=args.max_in_flight, client=client)
+            sender = FakeTelegramSender(WORKER_PATH, BENCH_SECRET)
+            # Сессии пользователей перемешаны, как в реальном потоке обновлений
+            sessions = [quiz_session(sender, 100000 + user) for user in range(args.users)]
+            updates = [session[step] for step in range(len(sessions[0])) for session in sessions]
+
+            started = time.perf_counter()
+            for update in updates:
+                await dispatcher.dispatch(update)
+            await dispatcher.drain()
+            elapsed = time.perf_counter() - started
+
+            worker_stats = [(await client.get(url + "/stats")).json() for url in urls]
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    return {
+        "workers": worker_count,
+        "updates": len(updates),
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(len(updates) / elapsed, 1),
+        "failed": dispatcher.counters["failed"],
+        "order_violations": sum(stats["order_violations"] for stats in worker_stats),
+        "per_worker": [stats["processed"] for stats in worker_stats],
+    }
+
+
+async def main(args):
+    results = []
+    for worker_count in args.workers:
+        result = await run_round(worker_count, args)
+        results.append(result)
+        print(
+            f"workers={result['workers']:<3} updates={result['updates']:<6} "
+            f"time={result['seconds']:>7}s  rps={result['updates_per_second']:>8}  "
+            f"order_violations={result['order_violations']}  per_worker={result['per_worker']}"
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    # Логи httpx на каждый запрос искажают замеры
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser(description="Масштабирование диспетчера шардов")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--cpu-ms", type=float, default=5, help="CPU-время обработки одного обновления")
+    parser.add_argument("--io-ms", type=float, default=20, help="Ожидание ввода-вывода на обновление")
+    parser.add_argument("--max-in-flight", type=int, default=256)
+    parser.add_argument("--base-port", type=int, default=8201)
+    parser.add_argument("--json", help="Куда сохранить результаты в JSON")
+    asyncio.run(main(parser.parse_args()))
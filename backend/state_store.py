@@ -0,0 +1,163 @@
+import os
+import time
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from pymongo import ReturnDocument
+
+import database
+from database import run_sync
+
+logger = logging.getLogger(__name__)
+
+# Настройки хранилища состояний теста
+STATE_BACKEND = os.getenv("STATE_BACKEND", "mongo")
+STATE_TTL_SECONDS = int(os.getenv("STATE_TTL_SECONDS", str(7 * 24 * 3600)))
+STATE_MEMORY_MAX_USERS = int(os.getenv("STATE_MEMORY_MAX_USERS", "100000"))
+
+
+def new_test_state(quiz_version: Optional[str] = None, quiz_id: Optional[str] = None) -> Dict[str, Any]:
+    """Начальное состояние теста quiz_id по версии контента quiz_version"""
+    return {
+        "test_active": True,
+        "quiz_id": quiz_id,
+        "quiz_version": quiz_version,
+        "current_question": 0,
+        "answers": [],
+        "total_score": 0
+    }
+
+
+class StateStore:
+    """Интерфейс хранилища состояний теста пользователей"""
+
+    async def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Получение состояния пользователя"""
+        raise NotImplementedError
+
+    async def set(self, user_id: str, state: Dict[str, Any]):
+        """Полная замена состояния пользователя"""
+        raise NotImplementedError
+
+    async def record_answer(
+        self, user_id: str, question_index: int, answer: Dict[str, Any]
+    ) -> Optional[Dict[str, Any]]:
+        """Атомарное сохранение ответа.
+
+        Ответ принимается, только если тест активен и ожидается именно
+        этот вопрос. Возвращает обновленное состояние или None.
+        """
+        raise NotImplementedError
+
+    async def delete(self, user_id: str):
+        """Удаление состояния пользователя"""
+        raise NotImplementedError
+
+    async def ensure_indexes(self):
+        """Подготовка хранилища (индексы и т.п.)"""
+
+
+class MemoryStateStore(StateStore):
+    """Хранилище в памяти процесса с вытеснением по LRU и TTL"""
+
+    def __init__(self, max_size: int = STATE_MEMORY_MAX_USERS, ttl: int = STATE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        # user_id -> (expires_at, state)
+        self._states: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def _get_live(self, user_id: str) -> Optional[Dict[str, Any]]:
+        item = self._states.get(user_id)
+        if item is None:
+            return None
+        expires_at, state = item
+        if expires_at < time.monotonic():
+            del self._states[user_id]
+            return None
+        self._states.move_to_end(user_id)
+        return state
+
+    def _put(self, user_id: str, state: Dict[str, Any]):
+        self._states[user_id] = (time.monotonic() + self.ttl, state)
+        self._states.move_to_end(user_id)
+        while len(self._states) > self.max_size:
+            self._states.popitem(last=False)
+
+    async def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        state = self._get_live(user_id)
+        if state is None:
+            return None
+        return {**state, "answers": list(state.get("answers", []))}
+
+    async def set(self, user_id: str, state: Dict[str, Any]):
+        self._put(user_id, {**state, "answers": list(state.get("answers", []))})
+
+    async def record_answer(self, user_id, question_index, answer):
+        state = self._get_live(user_id)
+        if not state or not state.get("test_active") or state.get("current_question") != question_index:
+            return None
+        state["answers"].append(answer)
+        state["total_score"] += answer["score"]
+        state["current_question"] = question_index + 1
+        self._put(user_id, state)
+        return await self.get(user_id)
+
+    async def delete(self, user_id: str):
+        self._states.pop(user_id, None)
+
+
+class MongoStateStore(StateStore):
+    """Хранилище в MongoDB: общее для всех воркеров и переживает перезапуск"""
+
+    def __init__(self, collection, ttl: int = STATE_TTL_SECONDS):
+        self.collection = collection
+        self.ttl = ttl
+
+    async def ensure_indexes(self):
+        # Брошенные тесты удаляются самой MongoDB
+        await run_sync(self.collection.create_index, "updated_at", expireAfterSeconds=self.ttl)
+
+    async def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        return await run_sync(self.collection.find_one, {"_id": user_id}, {"_id": 0, "updated_at": 0})
+
+    async def set(self, user_id: str, state: Dict[str, Any]):
+        await run_sync(
+            self.collection.replace_one,
+            {"_id": user_id},
+            {**state, "updated_at": datetime.utcnow()},
+            upsert=True
+        )
+
+    async def record_answer(self, user_id, question_index, answer):
+        state = await run_sync(
+            self.collection.find_one_and_update,
+            {"_id": user_id, "test_active": True, "current_question": question_index},
+            {
+                "$push": {"answers": answer},
+                "$inc": {"total_score": answer["score"], "current_question": 1},
+                "$set": {"updated_at": datetime.utcnow()}
+            },
+            projection={"_id": 0, "updated_at": 0},
+            return_document=ReturnDocument.BEFORE
+        )
+        if state is None:
+            return None
+        # Применяем то же изменение к состоянию до обновления
+        state["answers"].append(answer)
+        state["total_score"] += answer["score"]
+        state["current_question"] = question_index + 1
+        return state
+
+    async def delete(self, user_id: str):
+        await run_sync(self.collection.delete_one, {"_id": user_id})
+
+
+def create_state_store(backend: str = STATE_BACKEND) -> StateStore:
+    """Создание хранилища состояний по имени бэкенда"""
+    if backend == "memory":
+        return MemoryStateStore()
+    if backend == "mongo":
+        return MongoStateStore(database.quiz_states_collection)
+    raise ValueError(f"Неизвестный STATE_BACKEND: {backend}")
@@ -0,0 +1,245 @@
+import os
+import time
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import ReplaceOne
+
+import database
+import retention
+from database import run_sync
+
+logger = logging.getLogger(__name__)
+
+# Время жизни кэша /api/stats в процессе (секунды)
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", "5"))
+# Ширина корзины гистограммы баллов
+SCORE_BUCKET = 10
+# Сколько последних часов отдавать в completions_per_hour
+STATS_HOURS = int(os.getenv("STATS_HOURS", "48"))
+
+HOUR_FORMAT = "%Y-%m-%dT%H"
+
+rollups_collection = database.db.stats_rollups
+hourly_collection = database.db.stats_hourly
+
+# Кэш ответов: (quiz_id, quiz_version) -> (expires_at, stats)
+_cache: Dict[Tuple, Tuple[float, Dict[str, Any]]] = {}
+
+
+def score_bucket(total_score: int) -> int:
+    """Нижняя граница корзины гистограммы"""
+    return total_score // SCORE_BUCKET * SCORE_BUCKET
+
+
+def rollup_filter(quiz_id: Optional[str], quiz_version: Optional[str]) -> Dict[str, Any]:
+    """Сводный документ теста и версии контента.
+
+    Варианты ответов и диапазоны результатов могут отличаться между
+    тестами и версиями, поэтому у каждой пары своя сводка.
+    """
+    return {"_id": f"{quiz_id}:{quiz_version}", "quiz_id": quiz_id, "quiz_version": quiz_version}
+
+
+def rollup_increments(test_result: Dict[str, Any]) -> Dict[str, int]:
+    """$inc для сводного документа по одному результату теста"""
+    increments = {
+        "completions": 1,
+        "score_sum": test_result["total_score"],
+        f"score_histogram.{score_bucket(test_result['total_score'])}": 1,
+        f"result_bands.{test_result['result_percentage']}": 1,
+    }
+    for question, option in database.answer_pairs(test_result["answers"]):
+        key = f"answers.{question}.{option}"
+        increments[key] = increments.get(key, 0) + 1
+    return increments
+
+
+async def record_result(test_result: Dict[str, Any]):
+    """Инкрементальное обновление сводок после сохранения результата"""
+    increments = rollup_increments(test_result)
+    hour = test_result["completed_at"].strftime(HOUR_FORMAT)
+    hour_start = datetime.strptime(hour, HOUR_FORMAT)
+    updates = [
+        (
+            rollups_collection,
+            rollup_filter(test_result.get("quiz_id"), test_result.get("quiz_version")),
+            {"$inc": increments}
+        ),
+        (hourly_collection, {"_id": hour}, {"$inc": {"completions": 1}, "$setOnInsert": {"hour": hour_start}}),
+    ]
+    for collection, filter, update in updates:
+        if database.write_buffer is not None and database.write_buffer.running:
+            await database.write_buffer.update(collection, filter, update, upsert=True)
+        else:
+            await run_sync(collection.update_one, filter, update, upsert=True)
+
+
+def _by_int_key(mapping: Dict[str, Any]) -> Dict[int, Any]:
+    """Ключи-строки из MongoDB в числа, по возрастанию"""
+    return {int(key): value for key, value in sorted(mapping.items(), key=lambda item: int(item[0]))}
+
+
+def _format_rollup(rollup: Dict[str, Any]) -> Dict[str, Any]:
+    completions = rollup.get("completions", 0)
+    return {
+        "quiz_id": rollup.get("quiz_id"),
+        "quiz_version": rollup.get("quiz_version"),
+        "completions": completions,
+        "average_score": round(rollup.get("score_sum", 0) / completions, 2) if completions else 0,
+        "score_histogram": _by_int_key(rollup.get("score_histogram", {})),
+        "result_bands": _by_int_key(rollup.get("result_bands", {})),
+        "answers": {
+            question: _by_int_key(options)
+            for question, options in _by_int_key(rollup.get("answers", {})).items()
+        },
+    }
+
+
+def _format_stats(rollups: List[Dict[str, Any]], hourly: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        "completions": sum(rollup.get("completions", 0) for rollup in rollups),
+        "rollups": [_format_rollup(rollup) for rollup in rollups],
+        "completions_per_hour": [
+            {"hour": doc["_id"], "completions": doc["completions"]} for doc in hourly
+        ],
+        "updated_at": datetime.utcnow(),
+    }
+
+
+async def get_stats(quiz_id: Optional[str] = None, quiz_version: Optional[str] = None) -> Dict[str, Any]:
+    """Сводки из материализованных коллекций с кэшем в процессе.
+
+    Сводки отдаются отдельно по каждой паре тест/версия контента;
+    completions_per_hour - по всем тестам.
+    """
+    key = (quiz_id, quiz_version)
+    cached = _cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    query: Dict[str, Any] = {}
+    if quiz_id is not None:
+        query["quiz_id"] = quiz_id
+    if quiz_version is not None:
+        query["quiz_version"] = quiz_version
+    since = (datetime.utcnow() - timedelta(hours=STATS_HOURS)).strftime(HOUR_FORMAT)
+    rollups = await run_sync(lambda: list(rollups_collection.find(query).sort("_id", 1)))
+    hourly = await run_sync(
+        lambda: list(hourly_collection.find({"_id": {"$gte": since}}).sort("_id", 1))
+    )
+    result = _format_stats(rollups, hourly)
+    _cache[key] = (time.monotonic() + STATS_CACHE_TTL, result)
+    if len(_cache) > 100:
+        _cache.pop(next(iter(_cache)))
+    return result
+
+
+def _apply_increments(rollup: Dict[str, Any], increments: Dict[str, int]):
+    """$inc из rollup_increments к сводке в памяти"""
+    for key, value in increments.items():
+        *path, field = key.split(".")
+        target = rollup
+        for part in path:
+            target = target.setdefault(part, {})
+        target[field] = target.get(field, 0) + value
+
+
+def _replace_all(collection, documents: List[Dict[str, Any]]):
+    """Замена содержимого коллекции без промежутка, когда она пуста"""
+    if documents:
+        collection.bulk_write(
+            [ReplaceOne({"_id": document["_id"]}, document, upsert=True) for document in documents], ordered=False
+        )
+    collection.delete_many({"_id": {"$nin": [document["_id"] for document in documents]}})
+
+
+def _rebuild_sync() -> int:
+    """Полный пересчет сводок по test_results и архиву (разовая операция)"""
+    collection = database.test_results_collection
+    rollups: Dict[str, Dict[str, Any]] = {}
+
+    def rollup_for(group: Dict[str, Any]) -> Dict[str, Any]:
+        filter = rollup_filter(group.get("quiz_id"), group.get("quiz_version"))
+        if filter["_id"] not in rollups:
+            rollups[filter["_id"]] = {**filter, "completions": 0, "score_sum": 0,
+                                      "score_histogram": {}, "result_bands": {}, "answers": {}}
+        return rollups[filter["_id"]]
+
+    for row in collection.aggregate([
+        {"$group": {
+            "_id": {"quiz_id": "$quiz_id", "quiz_version": "$quiz_version",
+                    "bucket": {"$subtract": ["$total_score", {"$mod": ["$total_score", SCORE_BUCKET]}]},
+                    "band": "$result_percentage"},
+            "count": {"$sum": 1},
+            "score_sum": {"$sum": "$total_score"},
+        }}
+    ], allowDiskUse=True):
+        rollup = rollup_for(row["_id"])
+        bucket, band = str(int(row["_id"]["bucket"])), str(row["_id"]["band"])
+        rollup["completions"] += row["count"]
+        rollup["score_sum"] += row["score_sum"]
+        rollup["score_histogram"][bucket] = rollup["score_histogram"].get(bucket, 0) + row["count"]
+        rollup["result_bands"][band] = rollup["result_bands"].get(band, 0) + row["count"]
+
+    for row in collection.aggregate([
+        # Компактные ответы - индексы вариантов, вопрос - позиция в массиве
+        {"$unwind": {"path": "$answers", "includeArrayIndex": "position"}},
+        {"$group": {
+            "_id": {
+                "quiz_id": "$quiz_id",
+                "quiz_version": "$quiz_version",
+                "q": {"$ifNull": ["$answers.question_index", "$position"]},
+                "a": {"$ifNull": ["$answers.answer_index", "$answers"]},
+            },
+            "count": {"$sum": 1},
+        }}
+    ], allowDiskUse=True):
+        question = rollup_for(row["_id"])["answers"].setdefault(str(row["_id"]["q"]), {})
+        question[str(row["_id"]["a"])] = row["count"]
+
+    hourly = {
+        row["_id"]: row["completions"] for row in collection.aggregate([
+            {"$group": {
+                "_id": {"$dateToString": {"format": HOUR_FORMAT, "date": "$completed_at"}},
+                "completions": {"$sum": 1},
+            }}
+        ], allowDiskUse=True)
+    }
+
+    for rows in retention.archived_rows():
+        # После сбоя архивирования строка может остаться и в test_results - она уже учтена
+        hot = {
+            str(document["_id"]) for document in collection.find(
+                {"_id": {"$in": [ObjectId(row["id"]) for row in rows if ObjectId.is_valid(row["id"])]}}, {"_id": 1}
+            )
+        }
+        for row in rows:
+            if row["id"] in hot:
+                continue
+            _apply_increments(rollup_for(row), rollup_increments(row))
+            hour = row["completed_at"].strftime(HOUR_FORMAT)
+            hourly[hour] = hourly.get(hour, 0) + 1
+
+    # Документы заменяются на месте, а лишние удаляются после: панель не видит
+    # пустых сводок, а upsert из record_result не столкнется со вставкой
+    _replace_all(rollups_collection, list(rollups.values()))
+    _replace_all(hourly_collection, [
+        {"_id": hour, "completions": completions, "hour": datetime.strptime(hour, HOUR_FORMAT)}
+        for hour, completions in hourly.items()
+    ])
+    return sum(rollup["completions"] for rollup in rollups.values())
+
+
+async def rebuild():
+    """Пересчет сводок по всем результатам, включая архив (см. retention.py).
+
+    Нужен для заполнения сводок по данным, накопленным до их появления.
+    Результаты, записанные во время пересчета, могут не попасть в сводки.
+    """
+    completions = await run_sync(_rebuild_sync)
+    _cache.clear()
+    logger.info(f"Сводки статистики пересчитаны, результатов: {completions}")
+    return completions
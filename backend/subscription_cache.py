@@ -0,0 +1,112 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+# Время жизни закэшированных результатов проверки подписки (секунды)
+SUBSCRIPTION_POSITIVE_TTL = float(os.getenv("SUBSCRIPTION_POSITIVE_TTL", "600"))
+SUBSCRIPTION_NEGATIVE_TTL = float(os.getenv("SUBSCRIPTION_NEGATIVE_TTL", "10"))
+SUBSCRIPTION_ERROR_TTL = float(os.getenv("SUBSCRIPTION_ERROR_TTL", "5"))
+SUBSCRIPTION_CACHE_MAX_USERS = int(os.getenv("SUBSCRIPTION_CACHE_MAX_USERS", "100000"))
+
+# Возможные результаты проверки
+SUBSCRIBED = "subscribed"
+NOT_SUBSCRIBED = "not_subscribed"
+CHECK_ERROR = "error"
+
+
+class SubscriptionCache:
+    """Кэш результатов проверки подписки на канал.
+
+    Положительные, отрицательные и ошибочные результаты живут разное
+    время. Одновременные проверки одного пользователя объединяются в
+    один запрос к Bot API.
+    """
+
+    def __init__(
+        self,
+        positive_ttl: float = SUBSCRIPTION_POSITIVE_TTL,
+        negative_ttl: float = SUBSCRIPTION_NEGATIVE_TTL,
+        error_ttl: float = SUBSCRIPTION_ERROR_TTL,
+        max_size: int = SUBSCRIPTION_CACHE_MAX_USERS
+    ):
+        self.ttls = {
+            SUBSCRIBED: positive_ttl,
+            NOT_SUBSCRIBED: negative_ttl,
+            CHECK_ERROR: error_ttl,
+        }
+        self.max_size = max_size
+        # user_id -> (expires_at, status)
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        self._in_flight: Dict[int, asyncio.Future] = {}
+        self._counters = {"hits": 0, "misses": 0, "coalesced": 0}
+
+    def _lookup(self, user_id: int):
+        item = self._entries.get(user_id)
+        if item is None:
+            return None
+        expires_at, status = item
+        if expires_at < time.monotonic():
+            del self._entries[user_id]
+            return None
+        self._entries.move_to_end(user_id)
+        return status
+
+    def _store(self, user_id: int, status: str):
+        ttl = self.ttls[status]
+        if ttl <= 0:
+            return
+        self._entries[user_id] = (time.monotonic() + ttl, status)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get_status(self, user_id: int, fetch: Callable[[], Awaitable[str]]) -> str:
+        """Статус подписки из кэша или через fetch (один запрос на пользователя)"""
+        status = self._lookup(user_id)
+        if status is not None:
+            self._counters["hits"] += 1
+            return status
+
+        in_flight = self._in_flight.get(user_id)
+        if in_flight is not None:
+            self._counters["coalesced"] += 1
+            return await asyncio.shield(in_flight)
+
+        self._counters["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[user_id] = future
+        try:
+            try:
+                status = await fetch()
+            except Exception as e:
+                logger.error(f"Ошибка при проверке подписки пользователя {user_id}: {e}")
+                status = CHECK_ERROR
+            self._store(user_id, status)
+            future.set_result(status)
+            return status
+        finally:
+            if not future.done():
+                future.cancel()
+            del self._in_flight[user_id]
+
+    def invalidate(self, user_id: int):
+        """Сброс закэшированного результата пользователя"""
+        self._entries.pop(user_id, None)
+
+    def stats(self) -> Dict[str, float]:
+        """Счетчики попаданий/промахов для настройки TTL"""
+        lookups = self._counters["hits"] + self._counters["misses"] + self._counters["coalesced"]
+        return {
+            **self._counters,
+            "hit_ratio": round((self._counters["hits"] + self._counters["coalesced"]) / lookups, 4) if lookups else 0.0,
+            "size": len(self._entries),
+            "in_flight": len(self._in_flight),
+            "positive_ttl": self.ttls[SUBSCRIBED],
+            "negative_ttl": self.ttls[NOT_SUBSCRIBED],
+            "error_ttl": self.ttls[CHECK_ERROR],
+        }
@@ -0,0 +1,191 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Задержка перед перезапуском: от BOT_RESTART_BACKOFF_INITIAL с удвоением до MAX (секунды)
+BOT_RESTART_BACKOFF_INITIAL = float(os.getenv("BOT_RESTART_BACKOFF_INITIAL", "1"))
+BOT_RESTART_BACKOFF_MAX = float(os.getenv("BOT_RESTART_BACKOFF_MAX", "300"))
+# Сколько бот должен проработать без сбоев, чтобы задержка сбросилась
+BOT_STABLE_SECONDS = float(os.getenv("BOT_STABLE_SECONDS", "60"))
+# Период пульса из event loop бота и порог, после которого loop считается зависшим
+BOT_HEARTBEAT_INTERVAL = float(os.getenv("BOT_HEARTBEAT_INTERVAL", "5"))
+BOT_HEARTBEAT_TIMEOUT = float(os.getenv("BOT_HEARTBEAT_TIMEOUT", "30"))
+# Ошибка получения обновлений в последние N секунд переводит бота в degraded
+BOT_DEGRADED_WINDOW = float(os.getenv("BOT_DEGRADED_WINDOW", "60"))
+# Сколько ждать обработки текущих обновлений при остановке
+BOT_DRAIN_TIMEOUT = float(os.getenv("BOT_DRAIN_TIMEOUT", "30"))
+
+# Состояния бота
+STATE_STARTING = "starting"
+STATE_RUNNING = "running"
+STATE_DEGRADED = "degraded"
+STATE_CRASHED = "crashed"
+STATE_STOPPING = "stopping"
+STATE_STOPPED = "stopped"
+
+
+def restart_delay(attempt: int) -> float:
+    """Экспоненциальная задержка с джиттером (от половины до полной)"""
+    delay = min(BOT_RESTART_BACKOFF_MAX, BOT_RESTART_BACKOFF_INITIAL * 2 ** attempt)
+    return delay * random.uniform(0.5, 1.0)
+
+
+class BotSupervisor:
+    """Запуск бота с long polling в отдельном потоке с перезапуском после сбоев.
+
+    В потоке свой event loop. Бот запускается, затем цикл наблюдения
+    раз в BOT_HEARTBEAT_INTERVAL обновляет пульс и проверяет, что
+    приложение и получение обновлений работают. При сбое бот
+    останавливается и перезапускается с экспоненциальной задержкой.
+    Состояние читается из потока FastAPI через status().
+    """
+
+    def __init__(self, bot_factory: Callable[[], Any], on_bot_created: Optional[Callable[[Any], None]] = None):
+        self.bot_factory = bot_factory
+        self.on_bot_created = on_bot_created
+        self.bot = None
+        self.state = STATE_STOPPED
+        self.restart_count = 0
+        self.last_error: Optional[str] = None
+        self.last_error_at: Optional[datetime] = None
+        self.started_at: Optional[datetime] = None
+        self.next_restart_at: Optional[float] = None
+        self._last_heartbeat: Optional[float] = None
+        self._thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop_event: Optional[asyncio.Event] = None
+        self._stop_requested = False
+
+    def start(self):
+        """Запуск потока бота"""
+        self._stop_requested = False
+        self._thread = threading.Thread(target=self._thread_main, name="telegram-bot", daemon=True)
+        self._thread.start()
+
+    def _thread_main(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._supervise())
+        finally:
+            self._loop.close()
+
+    async def _supervise(self):
+        self._stop_event = asyncio.Event()
+        if self._stop_requested:
+            return
+        attempt = 0
+        while not self._stop_event.is_set():
+            self.state = STATE_STARTING
+            self.next_restart_at = None
+            bot = self.bot_factory()
+            self.bot = bot
+            if self.on_bot_created is not None:
+                self.on_bot_created(bot)
+
+            started = time.monotonic()
+            try:
+                await bot.start(polling=True)
+                self.state = STATE_RUNNING
+                self.started_at = datetime.utcnow()
+                logger.info("Telegram бот запущен")
+                await self._watch(bot)
+            except Exception as e:
+                self.last_error = f"{type(e).__name__}: {e}"
+                self.last_error_at = datetime.utcnow()
+                logger.error(f"Сбой Telegram бота: {self.last_error}")
+
+            if self._stop_event.is_set():
+                self.state = STATE_STOPPING
+            await self._stop_bot(bot)
+            if self._stop_event.is_set():
+                break
+
+            # Долго проработавший бот начинает отсчет задержек заново
+            if time.monotonic() - started >= BOT_STABLE_SECONDS:
+                attempt = 0
+            delay = restart_delay(attempt)
+            attempt += 1
+            self.restart_count += 1
+            self.state = STATE_CRASHED
+            self.next_restart_at = time.time() + delay
+            logger.warning(f"Перезапуск бота через {delay:.1f} с (перезапуск №{self.restart_count})")
+            try:
+                await asyncio.wait_for(self._stop_event.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+        self.next_restart_at = None
+        self.state = STATE_STOPPED
+        logger.info("Telegram бот остановлен")
+
+    async def _watch(self, bot):
+        """Пульс и проверка работы приложения до остановки или сбоя"""
+        while True:
+            self._last_heartbeat = time.monotonic()
+            try:
+                await asyncio.wait_for(self._stop_event.wait(), timeout=BOT_HEARTBEAT_INTERVAL)
+                return
+            except asyncio.TimeoutError:
+                pass
+            if not bot.application.running:
+                raise RuntimeError("Приложение бота остановилось")
+            if bot.application.updater is not None and not bot.application.updater.running:
+                raise RuntimeError("Получение обновлений остановилось")
+
+    async def _stop_bot(self, bot):
+        """Остановка с обработкой уже полученных обновлений"""
+        try:
+            await asyncio.wait_for(bot.stop(), timeout=BOT_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f"Бот не остановился за {BOT_DRAIN_TIMEOUT} с")
+        except Exception as e:
+            logger.error(f"Ошибка при остановке бота: {e}")
+
+    async def stop(self, timeout: float = BOT_DRAIN_TIMEOUT):
+        """Остановка из другого потока: дождаться обработки текущих обновлений"""
+        self._stop_requested = True
+        if self._thread is None or not self._thread.is_alive():
+            return
+        if self._loop is not None and self._stop_event is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+        await asyncio.to_thread(self._thread.join, timeout + BOT_HEARTBEAT_INTERVAL)
+        if self._thread.is_alive():
+            logger.error("Поток бота не завершился вовремя")
+
+    def current_state(self) -> str:
+        """Состояние с учетом пульса и ошибок получения обновлений"""
+        if self.state != STATE_RUNNING:
+            return self.state
+        if self._last_heartbeat is not None and time.monotonic() - self._last_heartbeat > BOT_HEARTBEAT_TIMEOUT:
+            return STATE_DEGRADED
+        polling_error_at = getattr(self.bot, "last_polling_error_at", None)
+        if polling_error_at is not None and (datetime.utcnow() - polling_error_at).total_seconds() < BOT_DEGRADED_WINDOW:
+            return STATE_DEGRADED
+        return STATE_RUNNING
+
+    def status(self) -> Dict[str, Any]:
+        """Состояние бота для /api/bot/status и /api/health"""
+        heartbeat_age = (
+            round(time.monotonic() - self._last_heartbeat, 1) if self._last_heartbeat is not None else None
+        )
+        return {
+            "state": self.current_state(),
+            "restart_count": self.restart_count,
+            "last_error": self.last_error,
+            "last_error_at": self.last_error_at,
+            "started_at": self.started_at,
+            "last_update_at": getattr(self.bot, "last_update_at", None),
+            "last_polling_error": getattr(self.bot, "last_polling_error", None),
+            "heartbeat_age": heartbeat_age,
+            "next_restart_in": (
+                round(max(self.next_restart_at - time.time(), 0), 1) if self.next_restart_at else None
+            ),
+        }
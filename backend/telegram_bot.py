@@ -2,15 +2,34 @@ import os
 import logging
 import asyncio
 from typing import Dict, Any
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, PhotoSize
+from telegram import Update, PhotoSize
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler, 
-    MessageHandler, filters, ContextTypes
+    MessageHandler, TypeHandler, filters, ContextTypes
 )
-from pymongo import MongoClient
-from datetime import datetime
+from datetime import datetime, timedelta
 import uuid
 from dotenv import load_dotenv
+import assets
+import callbacks
+import database
+import funnel
+import metrics
+import stats
+import write_buffer
+from database import media_cache_collection
+from media_cache import MediaCache, MEDIA_PHOTO, MEDIA_DOCUMENT
+from state_store import create_state_store, new_test_state
+from metrics import instrument_handler, funnel_step, InstrumentedRequest
+from content import ContentRegistry, MediaItem, create_content_source
+from pdf_render import PdfRenderer
+from funnel import FunnelEmitter
+from update_lanes import UserLaneProcessor
+from subscription_cache import SubscriptionCache, SUBSCRIBED, NOT_SUBSCRIBED
+from callbacks import CallbackData, CallbackRejected
+from rate_limiter import PriorityRateLimiter, BULK
+from broadcast import BroadcastRunner
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -24,157 +43,66 @@ logger = logging.getLogger(__name__)
 
 # Загрузка переменных окружения
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017")
-DB_NAME = os.getenv("DB_NAME", "test_database")
+# Адрес Bot API; для нагрузочных тестов подменяется локальной имитацией
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "https://api.telegram.org").rstrip("/")
 
-# Подключение к MongoDB
-mongo_client = MongoClient(MONGO_URL)
-db = mongo_client[DB_NAME]
-users_collection = db.users
-test_results_collection = db.test_results
+# Задержка перед сообщением о подписке после /start (секунды)
+SUBSCRIPTION_CHECK_DELAY = int(os.getenv("SUBSCRIPTION_CHECK_DELAY", "5"))
+# Максимальное число одновременно обрабатываемых обновлений
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "64"))
+
+# Служебный чат, куда заранее загружаются файлы контента ради file_id
+MEDIA_CACHE_CHAT_ID = os.getenv("MEDIA_CACHE_CHAT_ID")
+# Рендерить все варианты персонального PDF при запуске и смене контента
+PDF_PREWARM = os.getenv("PDF_PREWARM", "0") == "1"
+
+# Тип отложенной задачи в коллекции scheduled_jobs
+JOB_SUBSCRIPTION_CHECK = "subscription_check"
 
 # Канал для проверки подписки
 CHANNEL_USERNAME = "@anna_gertssss"
 CHANNEL_URL = "https://t.me/anna_gertssss"
 
-# Вопросы теста с баллами
-TEST_QUESTIONS = [
-    {
-        "question": "Твой возраст",
-        "options": [
-            ("до 30", 20),
-            ("30–35", 30),
-            ("36–40", 40),
-            ("41–45", 50),
-            ("46+", 60)
-        ]
-    },
-    {
-        "question": "Как у тебя с гормонами?",
-        "options": [
-            ("Всё стабильно", 20),
-            ("ПМС усилился, отёки, раздражение", 40),
-            ("Начались сбои, прыгает цикл", 50),
-            ("Уже менопауза / близко", 60)
-        ]
-    },
-    {
-        "question": "Как ты сейчас питаешься?",
-        "options": [
-            ("ЗОЖ, но вес не уходит", 40),
-            ("Часто срывы", 30),
-            ("Постоянно голодная", 50),
-            ("Ем нормально, но тяжесть", 50)
-        ]
-    },
-    {
-        "question": "Что больше всего бесит?",
-        "options": [
-            ("Лицо стало \"пухлым\"", 40),
-            ("Вес держится на животе", 50),
-            ("Сил нет", 50),
-            ("Постоянные перепады в настроении", 50),
-            ("Падает либидо", 40),
-            ("Всё вместе 😩", 60)
-        ]
-    },
-    {
-        "question": "Пробовала ли ты кето раньше?",
-        "options": [
-            ("Да, но не зашло", 20),
-            ("Никогда", 30),
-            ("Хочу, но боюсь", 40),
-            ("Пробовала — понравилось", 60)
-        ]
-    }
-]
-
-# Результаты теста
-TEST_RESULTS = {
-    (100, 130): {
-        "percentage": 60,
-        "title": "Кето может стать отличным способом сохранить баланс",
-        "description": """Ты на том этапе, когда тело работает стабильно, и это прекрасно.
-Но если ты хочешь:
-— дольше сохранить гормональный ресурс
-— предотвратить "качели" с весом и энергией
-— помочь организму пережить гормональные изменения без стресса
-
-Кето в мягкой форме может быть профилактикой и способом заботы о себе на глубоком уровне.
-
-📩 Забери рацион на 3 дня — начни с легкого входа и посмотри, как тебе."""
-    },
-    (131, 170): {
-        "percentage": 70,
-        "title": "Твоё тело может реагировать на кето очень хорошо",
-        "description": """По твоим ответам видно: ты внимательно следишь за собой и уже знаешь, что работает, а что нет.
-
-Но, возможно, ты чувствуешь, что:
-— привычные схемы больше не дают результата
-— тело "тормозит"
-— хочется больше лёгкости и энергии
-
-Кето — это не просто "есть жир". Это система, которая:
-✅ учит тело не зависеть от сахара
-✅ даёт питание гормонам
-✅ помогает стабилизировать метаболизм
-
-📩 Забери адаптированный рацион на 3 дня и попробуй без стресса и экспериментов над собой."""
-    },
-    (171, 200): {
-        "percentage": 80,
-        "title": "У тебя может быть высокая чувствительность к углеводам",
-        "description": """Ты уже многое знаешь о себе — и, похоже, пришла к моменту, когда хочется изменений, но не через "жесткач".
-
-Кето может тебе подойти, потому что:
-✅ оно помогает сохранять мышечную массу
-✅ регулирует тягу к сладкому
-✅ даёт ощущение насыщения и ясности
-
-Главное — начать грамотно: не с бекона и масла, а с продуманного женского подхода.
-
-📩 Получи рацион на 3 дня — ты почувствуешь первые перемены уже после завтрака."""
-    },
-    (201, 230): {
-        "percentage": 90,
-        "title": "Кето может стать для тебя новым уровнем энергии и комфорта",
-        "description": """Ты точно готова к более глубокому уровню заботы о себе.
-
-Кето помогает женщинам:
-✅ улучшать питание кожи и волос
-✅ мягко убирать "застои" в теле
-✅ питать гормональную систему жирами, а не углеводами
-
-Возможно, ты уже пробовала "есть правильно", считать калории, убирать сладкое.
-Но кето работает не за счёт ограничений, а за счёт грамотной перестройки топлива.
-
-📩 Получи кеторацион на 3 дня — это вкусно, легко и даст тебе сразу ощущение "я снова в ресурсе"."""
-    },
-    (231, 500): {
-        "percentage": 100,
-        "title": "У тебя отличные шансы на результаты с женским кето",
-        "description": """Всё, что ты прошла, даёт тебе опыт.
-А кето может стать твоей новой точкой опоры — не диетой, а стилем жизни, где:
-✅ тело сжигает жир эффективно
-✅ гормоны работают в балансе
-✅ настроение, энергия и либидо восстанавливаются
-
-Твоя система уже готова к переменам — важно просто дать ей поддержку, а не стресс.
-
-📩 Получи 3-дневный рацион, чтобы попробовать этот путь грамотно и бережно к себе."""
-    }
-}
-
 
 class TelegramBot:
     def __init__(self):
         self.application = None
-        self.user_states = {}  # Хранение состояний пользователей
-        
+        self.state_store = create_state_store()  # Хранение состояний пользователей
+        self.media_cache = MediaCache(media_cache_collection)
+        self.subscription_cache = SubscriptionCache()
+        # Тексты и тест загружаются из content/quiz.json (или MongoDB) и обновляются на лету
+        self.content = ContentRegistry(create_content_source(), CHANNEL_URL, on_change=self.on_content_change)
+        self.rate_limiter = PriorityRateLimiter()
+        self.pdf_renderer = PdfRenderer()
+        self.funnel = FunnelEmitter()
+        # Действие из callback_data -> обработчик
+        self.callback_handlers = {
+            callbacks.ACTION_CHECK_SUBSCRIPTION: self.check_subscription,
+            callbacks.ACTION_START_TEST: self.start_test,
+            callbacks.ACTION_ANSWER: self.handle_answer,
+            callbacks.ACTION_GET_DIET: self.send_diet,
+        }
+        self._prewarm_task = None
+        self.broadcast_runner = None
+        self._loop_monitor = None
+        # Для состояния бота в /api/bot/status
+        self.last_update_at = None
+        self.last_polling_error = None
+        self.last_polling_error_at = None
+        
+    def track_step(self, step: str, user_id, quiz_id: str = None):
+        """Шаг воронки: счетчик Prometheus и событие в funnel_events (без ожидания записи)"""
+        funnel_step(step)
+        self.funnel.emit(step, user_id, quiz_id)
+
+    @instrument_handler("start_command")
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /start"""
         user_id = update.effective_user.id
         username = update.effective_user.username or update.effective_user.first_name
+        content = self.content.current
+        # Тест выбирается по параметру ссылки t.me/<bot>?start=<payload>
+        quiz = content.quiz_for_payload(context.args[0] if context.args else None)
         
         # Сохраняем пользователя в БД
         user_data = {
@@ -183,62 +111,87 @@ class TelegramBot:
             "first_name": update.effective_user.first_name,
             "last_name": update.effective_user.last_name,
             "created_at": datetime.utcnow(),
-            "test_completed": False
+            "test_completed": False,
+            "quiz_id": quiz.quiz_id
         }
         
-        users_collection.update_one(
-            {"user_id": str(user_id)},
-            {"$set": user_data},
-            upsert=True
-        )
+        await database.upsert_user(user_data)
+        self.track_step(metrics.STEP_START, user_id, quiz.quiz_id)
         
         # Приветственное сообщение
-        welcome_text = """Привет! 
-Ты попала в мой бот
-
-Меня зовут Анна Герц
-Я - натуропат , помогаю тысячам женщин становиться здоровыми и стройными и влюбляться в свое тело вновь , и вновь. 
-
-В этом боте будет много полезных гайдов и уроков 😍 
-Присоединяйся ✨"""
+        welcome_text = quiz.messages["welcome"]
         
         # Отправляем приветственное сообщение с фото Анны Герц
-        photo_path = "/root/app/telegram_bot_images/anna_photo.jpg"
-        
         try:
-            with open(photo_path, 'rb') as photo_file:
-                await update.message.reply_photo(
-                    photo=photo_file,
-                    caption=welcome_text
-                )
+            if content.welcome_photo is None:
+                raise FileNotFoundError("Фото приветствия не задано в контенте")
+            await self.media_cache.send(
+                content.welcome_photo,
+                MEDIA_PHOTO,
+                lambda photo: update.message.reply_photo(photo=photo, caption=welcome_text)
+            )
         except Exception as e:
             logger.error(f"Ошибка при отправке фото: {e}")
             # Если фото не загрузилось, отправляем текст
             await update.message.reply_text(welcome_text)
         
-        # Ждем 5 секунд перед отправкой второго сообщения
-        await asyncio.sleep(5)
-        await self.send_subscription_check(update, context)
-        
-    async def send_subscription_check(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Отправка сообщения о проверке подписки"""
-        subscription_text = """Для начала  тебе нужно подписаться на мой телеграм-канал, в котором я делюсь очень полезной информацией о чистоте питания, тела и сознания. Показываю реальную жизнь без перекосов, категоричности и вылизанной картинки идеальной жизни !
+        # Второе сообщение отправится через 5 секунд из очереди задач,
+        # обработчик при этом сразу освобождается
+        await self.schedule_subscription_check(update.effective_chat.id, context, quiz.quiz_id)
+
+    async def schedule_subscription_check(self, chat_id: int, context: ContextTypes.DEFAULT_TYPE, quiz_id: str):
+        """Планирование сообщения о проверке подписки"""
+        run_at = datetime.utcnow() + timedelta(seconds=SUBSCRIPTION_CHECK_DELAY)
+        job_id = await database.schedule_job(JOB_SUBSCRIPTION_CHECK, chat_id, run_at, {"quiz_id": quiz_id})
+        context.job_queue.run_once(
+            self.run_scheduled_job,
+            when=SUBSCRIPTION_CHECK_DELAY,
+            data={"job_id": job_id, "kind": JOB_SUBSCRIPTION_CHECK, "quiz_id": quiz_id},
+            chat_id=chat_id,
+            name=job_id
+        )
 
-Где и ты, и я имеем право на ошибки в питании, в спорте, в мыслях, в отношениях - но в этой не идеальности и есть жизнь👍
+    async def restore_scheduled_jobs(self):
+        """Восстановление отложенных задач после перезапуска бота"""
+        jobs = await database.pending_jobs()
+        now = datetime.utcnow()
+        for job in jobs:
+            delay = max((job["run_at"] - now).total_seconds(), 0)
+            self.application.job_queue.run_once(
+                self.run_scheduled_job,
+                when=delay,
+                data={
+                    "job_id": str(job["_id"]),
+                    "kind": job["kind"],
+                    "quiz_id": job.get("payload", {}).get("quiz_id")
+                },
+                chat_id=job["chat_id"],
+                name=str(job["_id"])
+            )
+        if jobs:
+            logger.info(f"Восстановлено отложенных задач: {len(jobs)}")
+
+    async def run_scheduled_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Выполнение отложенной задачи из очереди"""
+        job = context.job
+        # Задача могла быть уже выполнена до перезапуска
+        if not await database.claim_job(job.data["job_id"]):
+            return
 
-А также ты найдешь там полезные посты и подкасты про питание и не только  — материал, который не знает гугл, так как это мой опыт и опыт 1000 женщин, прошедших путь очищения со мной . 
+        if job.data["kind"] == JOB_SUBSCRIPTION_CHECK:
+            await self.send_subscription_check(context.bot, job.chat_id, job.data.get("quiz_id"))
 
-Подписывайся и жми кнопку ниже ⬇️"""
-        
-        keyboard = [
-            [InlineKeyboardButton("Подписаться на канал", url=CHANNEL_URL)],
-            [InlineKeyboardButton("Проверка подписки", callback_data="check_subscription")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_text(subscription_text, reply_markup=reply_markup)
+    async def send_subscription_check(self, bot, chat_id: int, quiz_id: str = None):
+        """Отправка сообщения о проверке подписки"""
+        quiz = self.content.current.quiz(quiz_id)
+        await bot.send_message(
+            chat_id=chat_id,
+            text=quiz.messages["subscription_prompt"],
+            reply_markup=quiz.subscription_markup
+        )
         
-    async def check_subscription(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    @instrument_handler("check_subscription")
+    async def check_subscription(self, update: Update, context: ContextTypes.DEFAULT_TYPE, data: CallbackData):
         """Проверка подписки на канал"""
         query = update.callback_query
         await query.answer()
@@ -246,55 +199,45 @@ class TelegramBot:
         user_id = query.from_user.id
         username = query.from_user.username or query.from_user.first_name
         
-        try:
+        async def fetch_status():
             # Проверяем подписку пользователя на канал
             member = await context.bot.get_chat_member(chat_id=CHANNEL_USERNAME, user_id=user_id)
-            
-            # Проверяем статус участника
             if member.status in ['member', 'administrator', 'creator']:
-                logger.info(f"Пользователь {username} (ID: {user_id}) подписан на канал")
-                await query.edit_message_text("Вижу подписку 💗")
-                await self.send_test_invitation(query, context)
-            else:
-                logger.info(f"Пользователь {username} (ID: {user_id}) НЕ подписан на канал")
-                await query.edit_message_text(
-                    "Кажется, ты еще не подписалась на канал 🤔\n\n"
-                    "Подпишись на канал и нажми кнопку еще раз ⬇️",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("Подписаться на канал", url=CHANNEL_URL)],
-                        [InlineKeyboardButton("Проверка подписки", callback_data="check_subscription")]
-                    ])
-                )
-                
-        except Exception as e:
-            logger.error(f"Ошибка при проверке подписки для пользователя {username} (ID: {user_id}): {e}")
+                return SUBSCRIBED
+            return NOT_SUBSCRIBED
+
+        # Результат берется из кэша, повторные нажатия не обращаются к Bot API
+        status = await self.subscription_cache.get_status(user_id, fetch_status)
+        quiz = self.content.current.quiz(data.quiz_id)
+        self.track_step(metrics.STEP_SUBSCRIPTION_CHECK, user_id, quiz.quiz_id)
+        messages = quiz.messages
+
+        if status == SUBSCRIBED:
+            logger.info(f"Пользователь {username} (ID: {user_id}) подписан на канал")
+            self.track_step(metrics.STEP_SUBSCRIBED, user_id, quiz.quiz_id)
+            await query.edit_message_text(messages["subscription_confirmed"])
+            await self.send_test_invitation(query, context, quiz)
+        elif status == NOT_SUBSCRIBED:
+            logger.info(f"Пользователь {username} (ID: {user_id}) НЕ подписан на канал")
+            await self.edit_subscription_prompt(query, messages["subscription_missing"], quiz)
+        else:
             # В случае ошибки (например, бот не администратор канала) - считаем что подписки нет
             logger.info(f"Пользователь {username} (ID: {user_id}) - подписка не найдена (ошибка проверки)")
-            await query.edit_message_text(
-                "Не увидел подписку на канал 🤔\n\n"
-                "Подпишись на канал и попробуй еще раз ⬇️",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("Подписаться на канал", url=CHANNEL_URL)],
-                    [InlineKeyboardButton("Проверка подписки", callback_data="check_subscription")]
-                ])
-            )
+            await self.edit_subscription_prompt(query, messages["subscription_check_failed"], quiz)
+
+    async def edit_subscription_prompt(self, query, text: str, quiz):
+        """Повторный показ кнопок подписки"""
+        try:
+            await query.edit_message_text(text, reply_markup=quiz.subscription_markup)
+        except BadRequest as e:
+            # Закэшированный ответ совпадает с уже показанным текстом
+            if "not modified" not in str(e).lower():
+                raise
             
-    async def send_test_invitation(self, query_or_update, context: ContextTypes.DEFAULT_TYPE):
+    async def send_test_invitation(self, query_or_update, context: ContextTypes.DEFAULT_TYPE, quiz):
         """Отправка приглашения к тесту"""
-        test_invitation = """Если тебе 30+, а вес стоит, цикл скачет, отеки, лицо "плывёт".
-
-Это может быть следствием 
-недостаточного потребления белка, отсутствием полезных жиров , застоем лимфы, признаками состояния непроходящего стресса и высокого уровня кортизола, невниманием к себе и своему телу, и  пр.
-
-Я сделала короткий тест (5 вопросов) чтобы показать:
-🌟как сейчас работают твои гормоны
-🌟подойдёт ли тебе кето
-🌟и что будет, если ты попробуешь вычистить свое тело 👍
-
-После теста , я выдам тебе результат и рацион , адаптированный под твою ситуацию"""
-        
-        keyboard = [[InlineKeyboardButton("Пройти тест →", callback_data="start_test")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        test_invitation = quiz.messages["test_invitation"]
+        reply_markup = quiz.invitation_markup
         
         if hasattr(query_or_update, 'message'):
             # Это callback query
@@ -303,7 +246,7 @@ class TelegramBot:
             # Это обычное update
             await query_or_update.message.reply_text(test_invitation, reply_markup=reply_markup)
             
-    async def start_test(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def start_test(self, update: Update, context: ContextTypes.DEFAULT_TYPE, data: CallbackData):
         """Начало теста"""
         query = update.callback_query
         await query.answer()
@@ -311,202 +254,368 @@ class TelegramBot:
         user_id = str(query.from_user.id)
         
         # Инициализируем тест для пользователя
-        self.user_states[user_id] = {
-            "test_active": True,
-            "current_question": 0,
-            "answers": [],
-            "total_score": 0
-        }
+        # Тест проходится до конца по той версии контента, с которой начат
+        content = self.content.current
+        quiz = content.quiz(data.quiz_id)
+        await self.state_store.set(user_id, new_test_state(content.version, quiz.quiz_id))
+        self.track_step(metrics.STEP_TEST_STARTED, user_id, quiz.quiz_id)
         
-        await self.send_question(query, context, 0)
+        await self.send_question(query, context, content, quiz, 0)
         
-    async def send_question(self, query, context: ContextTypes.DEFAULT_TYPE, question_index: int):
+    async def send_question(self, query, context: ContextTypes.DEFAULT_TYPE, content, quiz, question_index: int):
         """Отправка вопроса теста"""
-        if question_index >= len(TEST_QUESTIONS):
+        if question_index >= quiz.engine.question_count:
             # Тест завершен
-            await self.finish_test(query, context)
+            await self.finish_test(query, context, content, quiz)
             return
             
-        question_data = TEST_QUESTIONS[question_index]
-        
-        # Заголовок теста
-        if question_index == 0:
-            header = "Ответь на 5 вопросов — и я пришлю твой результат + адаптированный рацион на 3 дня\n\n"
-        else:
-            header = ""
-            
-        question_text = f"{header}Вопрос {question_index + 1}: {question_data['question']}"
+        # Текст вопроса и кнопки ответов собраны заранее
+        question = quiz.engine.questions[question_index]
+        await query.edit_message_text(question.text, reply_markup=question.reply_markup)
         
-        # Создаем кнопки для ответов
-        keyboard = []
-        for i, (option_text, score) in enumerate(question_data['options']):
-            callback_data = f"answer_{question_index}_{i}"
-            keyboard.append([InlineKeyboardButton(option_text, callback_data=callback_data)])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(question_text, reply_markup=reply_markup)
-        
-    async def handle_answer(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    @instrument_handler("handle_answer")
+    async def handle_answer(self, update: Update, context: ContextTypes.DEFAULT_TYPE, data: CallbackData):
         """Обработка ответа на вопрос теста"""
         query = update.callback_query
         await query.answer()
         
         user_id = str(query.from_user.id)
         
-        if user_id not in self.user_states or not self.user_states[user_id].get("test_active"):
-            await query.edit_message_text("Тест не найден. Начните заново с команды /start")
+        user_state = await self.state_store.get(user_id)
+        if not user_state or not user_state.get("test_active"):
+            await query.edit_message_text(self.content.current.messages["test_not_found"])
+            return
+        content = await self.content.get(user_state.get("quiz_version"))
+        quiz = content.quiz(user_state.get("quiz_id"))
+        question_index, answer_index = data.question, data.option
+
+        # Кнопка другого теста или версии, несуществующий вариант или не тот вопрос
+        # (повтор старой кнопки) отбрасываются до записи в хранилище
+        if data.version is not None and (data.version != content.version or data.quiz_id != quiz.quiz_id):
+            metrics.CALLBACK_REJECTED.labels(reason="stale").inc()
+            return
+        if not quiz.engine.has_option(question_index, answer_index):
+            metrics.CALLBACK_REJECTED.labels(reason="range").inc()
+            return
+        if question_index != user_state.get("current_question"):
+            metrics.CALLBACK_REJECTED.labels(reason="order").inc()
             return
-            
-        # Парсим ответ
-        callback_data = query.data
-        parts = callback_data.split('_')
-        question_index = int(parts[1])
-        answer_index = int(parts[2])
         
         # Получаем баллы за ответ
-        question_data = TEST_QUESTIONS[question_index]
-        option_text, score = question_data['options'][answer_index]
+        option_text, score = quiz.engine.option(question_index, answer_index)
         
-        # Сохраняем ответ
-        user_state = self.user_states[user_id]
-        user_state['answers'].append({
+        # Сохраняем ответ; повторное нажатие на уже отвеченный вопрос игнорируется
+        user_state = await self.state_store.record_answer(user_id, question_index, {
             'question_index': question_index,
             'answer_index': answer_index,
             'answer_text': option_text,
             'score': score
         })
-        user_state['total_score'] += score
-        user_state['current_question'] = question_index + 1
+        if user_state is None:
+            return
+        self.track_step(f"answer_{question_index}", user_id, quiz.quiz_id)
         
         # Переходим к следующему вопросу
-        await self.send_question(query, context, question_index + 1)
+        await self.send_question(query, context, content, quiz, question_index + 1)
         
-    async def finish_test(self, query, context: ContextTypes.DEFAULT_TYPE):
+    @instrument_handler("finish_test")
+    async def finish_test(self, query, context: ContextTypes.DEFAULT_TYPE, content, quiz):
         """Завершение теста и показ результата"""
         user_id = str(query.from_user.id)
-        user_state = self.user_states[user_id]
+        user_state = await self.state_store.get(user_id)
         total_score = user_state['total_score']
         
         # Определяем результат
-        result = None
-        for score_range, result_data in TEST_RESULTS.items():
-            if score_range[0] <= total_score <= score_range[1]:
-                result = result_data
-                break
-                
-        if not result:
-            result = TEST_RESULTS[(231, 500)]  # По умолчанию максимальный результат
+        result = quiz.engine.result_for(total_score)
             
+        # Индексы выбранных вариантов по порядку вопросов; тексты ответов
+        # восстанавливаются по quiz_version (см. retention.expand_answers)
+        answers = [answer["answer_index"] for answer in user_state["answers"]]
+
         # Сохраняем результат в БД
         test_result = {
             "user_id": user_id,
             "test_id": str(uuid.uuid4()),
-            "answers": user_state['answers'],
+            "answers": answers,
             "total_score": total_score,
-            "result_percentage": result['percentage'],
-            "result_title": result['title'],
+            "result_percentage": result.percentage,
+            "result_title": result.title,
+            "quiz_id": quiz.quiz_id,
+            "quiz_version": content.version,
             "completed_at": datetime.utcnow()
         }
         
-        test_results_collection.insert_one(test_result)
+        await database.save_test_result(test_result)
+        await stats.record_result(test_result)
+        self.track_step(metrics.STEP_TEST_FINISHED, user_id, quiz.quiz_id)
         
         # Обновляем статус пользователя
-        users_collection.update_one(
-            {"user_id": user_id},
-            {"$set": {"test_completed": True, "last_test_score": total_score}}
-        )
+        await database.mark_test_completed(user_id, total_score, quiz.quiz_id)
         
-        # Формируем сообщение с результатом
-        result_text = f"{result['percentage']}% — {result['title']}\n\n{result['description']}"
-        
-        # Добавляем кнопку для получения рациона
-        keyboard = [[InlineKeyboardButton("Получить рацион", callback_data="get_diet")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(result_text, reply_markup=reply_markup)
+        # Сообщение с результатом и кнопкой для получения рациона
+        await query.edit_message_text(result.text, reply_markup=quiz.engine.diet_reply_markup)
         
         # Сохраняем состояние пользователя для использования в send_diet
-        self.user_states[user_id] = {
+        await self.state_store.set(user_id, {
+            "test_active": False,
             "total_score": total_score,
-            "result": result
-        }
+            # Индексы ответов для персонального PDF
+            "answers": answers,
+            "quiz_id": quiz.quiz_id,
+            "quiz_version": content.version
+        })
             
-    async def send_diet(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    @instrument_handler("send_diet")
+    async def send_diet(self, update: Update, context: ContextTypes.DEFAULT_TYPE, data: CallbackData):
         """Отправка PDF рациона"""
         query = update.callback_query
         await query.answer()
         
         user_id = str(query.from_user.id)
-        user_state = self.user_states.get(user_id, {})
-        total_score = user_state.get('total_score', 0)
+        user_state = await self.state_store.get(user_id)
+        if user_state and not user_state.get("test_active"):
+            total_score = user_state.get('total_score', 0)
+            answers = user_state.get("answers")
+            content = await self.content.get(user_state.get("quiz_version"))
+            quiz = content.quiz(user_state.get("quiz_id"))
+        else:
+            # Состояние уже удалено (повторное нажатие) - берем результат из профиля,
+            # тест и версию контента - из кнопки
+            answers = None
+            total_score, quiz_id = await database.get_last_test(user_id)
+            total_score = total_score or 0
+            content = await self.content.get(data.version)
+            quiz = content.quiz(data.quiz_id or quiz_id)
         
         # Определяем результат для отображения без кнопки
-        result = None
-        for score_range, result_data in TEST_RESULTS.items():
-            if score_range[0] <= total_score <= score_range[1]:
-                result = result_data
-                break
-                
-        if not result:
-            result = TEST_RESULTS[(231, 500)]  # По умолчанию максимальный результат
-        
-        # Формируем сообщение с результатом БЕЗ кнопки
-        result_text = f"{result['percentage']}% — {result['title']}\n\n{result['description']}"
+        result = quiz.engine.result_for(total_score)
         
         # Убираем кнопку, оставляя только результат теста
-        await query.edit_message_text(result_text)
-        
-        # Отправляем PDF файл
-        pdf_path = "/root/app/telegram_bot_pdfs/Кето Анна Герц.pdf"
+        await query.edit_message_text(result.text)
         
+        # Файлы для диапазона баллов пользователя; file_id уже в кэше
         try:
-            with open(pdf_path, 'rb') as pdf_file:
-                await context.bot.send_document(
-                    chat_id=query.message.chat_id,
-                    document=pdf_file,
-                    filename="Кето-Начало_рацион.pdf",
-                    caption="Кето-Начало: лёгкий вход в мир низких углеводов"
-                )
+            for item in await self.diet_media(quiz, result, answers):
+                # Персональный PDF не вытесняется из кэша, пока загружается в Telegram
+                with self.pdf_renderer.hold(item.path):
+                    await self.send_media(context.bot, query.message.chat_id, item)
+            self.track_step(metrics.STEP_DIET_SENT, user_id, quiz.quiz_id)
+            # Тест полностью завершен - состояние больше не нужно
+            await self.state_store.delete(user_id)
         except Exception as e:
             logger.error(f"Ошибка при отправке PDF: {e}")
-            await query.message.reply_text("Извини, произошла ошибка при отправке файла. Попробуй позже.")
+            await query.message.reply_text(quiz.messages["diet_error"])
+
+    async def diet_media(self, quiz, result, answers):
+        """Персональный PDF, если он настроен в тесте, иначе файлы диапазона баллов"""
+        spec = quiz.pdf_spec(result, answers) if answers else None
+        if spec is None:
+            return quiz.media_for(result)
+        try:
+            path = await self.pdf_renderer.render(spec)
+        except Exception as e:
+            logger.error(f"Не удалось подготовить персональный PDF, отправляется общий: {e!r}")
+            return quiz.media_for(result)
+        return (MediaItem(MEDIA_DOCUMENT, path, quiz.diet_pdf["caption"], quiz.diet_pdf["filename"]),)
+
+    async def prewarm_pdfs(self, content):
+        """Рендеринг всех вариантов персональных PDF в кэш"""
+        specs = [spec for quiz in content.quizzes.values() for spec in quiz.pdf_specs()]
+        if not specs:
+            return
+        started = datetime.utcnow()
+        ready = await self.pdf_renderer.prewarm(specs)
+        logger.info(f"Кэш PDF прогрет: {ready} из {len(specs)} за {(datetime.utcnow() - started).total_seconds():.1f} с")
+
+    def start_prewarm(self, content):
+        """Фоновый прогрев кэша PDF, если включен PDF_PREWARM"""
+        if not PDF_PREWARM:
+            return
+        if self._prewarm_task is not None:
+            self._prewarm_task.cancel()
+        self._prewarm_task = asyncio.get_running_loop().create_task(self.prewarm_pdfs(content))
+
+    def media_sender(self, bot, chat_id, item, **kwargs):
+        """Функция отправки файла контента для MediaCache.send (file_id или открытый файл)"""
+        if item.media_type == MEDIA_PHOTO:
+            return lambda media: bot.send_photo(chat_id=chat_id, photo=media, caption=item.caption, **kwargs)
+        return lambda media: bot.send_document(
+            chat_id=chat_id, document=media, filename=item.filename, caption=item.caption, **kwargs
+        )
+
+    async def send_media(self, bot, chat_id, item):
+        """Отправка файла контента через кэш file_id"""
+        return await self.media_cache.send(item.path, item.media_type, self.media_sender(bot, chat_id, item))
+
+    async def preload_media(self, content):
+        """Регистрация файлов контента в кэше file_id до первых запросов.
+
+        Если задан MEDIA_CACHE_CHAT_ID, файлы без file_id сразу загружаются
+        в этот служебный чат, и пользователи получают уже готовый file_id.
+        """
+        for item in content.media_items():
+            upload = None
+            if MEDIA_CACHE_CHAT_ID:
+                upload = self.media_sender(
+                    self.application.bot, MEDIA_CACHE_CHAT_ID, item,
+                    disable_notification=True, rate_limit_args=BULK
+                )
+            try:
+                await self.media_cache.preload(
+                    item.path, item.media_type, upload, content_hash=assets.content_hash(item.path)
+                )
+            except Exception as e:
+                logger.error(f"Не удалось подготовить файл {item.path}: {e}")
+
+    async def on_content_change(self, content):
+        """Новая версия контента: файлы регистрируются, если бот уже запущен"""
+        if self.application is not None and self.application.running:
+            await self.preload_media(content)
+            self.start_prewarm(content)
             
     async def callback_query_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обработчик всех callback запросов"""
+        """Обработчик всех callback запросов: разбор callback_data и вызов обработчика действия"""
         query = update.callback_query
-        
-        if query.data == "check_subscription":
-            await self.check_subscription(update, context)
-        elif query.data == "start_test":
-            await self.start_test(update, context)
-        elif query.data.startswith("answer_"):
-            await self.handle_answer(update, context)
-        elif query.data == "get_diet":
-            await self.send_diet(update, context)
+        try:
+            data = callbacks.decode(query.data or "")
+        except CallbackRejected as e:
+            # Поддельная или поврежденная кнопка - только снимаем "часики" у клиента
+            metrics.CALLBACK_REJECTED.labels(reason=e.reason).inc()
+            await query.answer()
+            return
+        handler = self.callback_handlers.get(data.action)
+        if handler is None:
+            metrics.CALLBACK_REJECTED.labels(reason="action").inc()
+            await query.answer()
+            return
+        await handler(update, context, data)
             
+    async def track_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Время последнего полученного обновления"""
+        self.last_update_at = datetime.utcnow()
+
+    def on_polling_error(self, error: TelegramError):
+        """Ошибка getUpdates; Updater сам повторяет запрос"""
+        self.last_polling_error = f"{type(error).__name__}: {error}"
+        self.last_polling_error_at = datetime.utcnow()
+        logger.warning(f"Ошибка получения обновлений: {error}")
+
     def setup_handlers(self):
         """Настройка обработчиков"""
+        # Группа -1 выполняется раньше остальных и не мешает им
+        self.application.add_handler(TypeHandler(Update, self.track_update), group=-1)
         self.application.add_handler(CommandHandler("start", self.start_command))
         self.application.add_handler(CallbackQueryHandler(self.callback_query_handler))
         
+    def build_application(self, polling: bool = True) -> Application:
+        """Создание приложения python-telegram-bot"""
+        builder = (
+            Application.builder()
+            .token(TELEGRAM_BOT_TOKEN)
+            .base_url(f"{TELEGRAM_API_BASE_URL}/bot")
+            .base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+            # Разные пользователи - параллельно, один пользователь - по очереди и без дублей
+            .concurrent_updates(UserLaneProcessor(BOT_CONCURRENT_UPDATES))
+            # Замер задержки и ошибок каждого вызова Bot API
+            .request(InstrumentedRequest(connection_pool_size=BOT_CONCURRENT_UPDATES))
+            # Лимиты Telegram на отправку; ответы пользователям идут раньше рассылок
+            .rate_limiter(self.rate_limiter)
+        )
+        if not polling:
+            # Обновления приходят через вебхук, Updater не нужен
+            builder = builder.updater(None)
+        return builder.build()
+
+    async def start(self, polling: bool = True):
+        """Инициализация и запуск приложения без блокировки"""
+        # Создаем приложение
+        self.application = self.build_application(polling)
+        
+        # Настраиваем обработчики
+        self.setup_handlers()
+        await self.media_cache.ensure_indexes()
+        await database.ensure_indexes()
+        await self.state_store.ensure_indexes()
+        await funnel.ensure_collection()
+        # Манифест собранных файлов читается один раз, до компиляции контента
+        assets.load_manifest()
+        await self.content.load()
+        self.content.start_watching()
+        self.funnel.start()
+        # Операции, не записанные буфером в прошлом запуске
+        await write_buffer.replay_dead_letters()
+        database.start_write_behind()
+        
+        # Запускаем бота
+        logger.info("Запуск Telegram бота...")
+        await self.application.initialize()
+        await self.application.start()
+        await self.preload_media(self.content.current)
+        self.start_prewarm(self.content.current)
+        if polling:
+            await self.application.updater.start_polling(
+                drop_pending_updates=True,
+                error_callback=self.on_polling_error
+            )
+            # У потока бота свой event loop - меряем его задержку отдельно
+            self._loop_monitor = metrics.start_loop_monitor("bot")
+        await self.restore_scheduled_jobs()
+        self.broadcast_runner = BroadcastRunner(self.application.bot, self.media_cache, MEDIA_CACHE_CHAT_ID)
+        self.broadcast_runner.start()
+
+    async def start_webhook(self, webhook_url: str, secret_token: str):
+        """Запуск бота в режиме вебхука"""
+        await self.start(polling=False)
+        await self.application.bot.set_webhook(
+            url=webhook_url,
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True
+        )
+        logger.info(f"Вебхук установлен: {webhook_url}")
+
+    async def process_update_json(self, data: Dict[str, Any], wait: bool = False):
+        """Передача обновления из вебхука в приложение.
+
+        По умолчанию обновление ставится в очередь приложения. С wait=True
+        оно обрабатывается сразу и метод возвращается после завершения
+        обработки - так диспетчер шардов сохраняет порядок обновлений
+        одного пользователя.
+        """
+        update = Update.de_json(data, self.application.bot)
+        if wait:
+            await self.application.update_processor.process_update(
+                update, self.application.process_update(update)
+            )
+        else:
+            await self.application.update_queue.put(update)
+
+    async def stop(self):
+        """Остановка приложения"""
+        if self.application is None:
+            return
+        if self._loop_monitor is not None:
+            self._loop_monitor.cancel()
+        if self.broadcast_runner is not None:
+            await self.broadcast_runner.stop()
+        self.content.stop_watching()
+        if self._prewarm_task is not None:
+            self._prewarm_task.cancel()
+        if self.application.updater and self.application.updater.running:
+            await self.application.updater.stop()
+        if self.application.running:
+            await self.application.stop()
+        await self.application.shutdown()
+        self.pdf_renderer.close()
+        await self.funnel.stop()
+        await database.stop_write_behind()
+
     async def run(self):
         """Запуск бота"""
         try:
-            # Создаем приложение
-            self.application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-            
-            # Настраиваем обработчики
-            self.setup_handlers()
-            
-            # Запускаем бота
-            logger.info("Запуск Telegram бота...")
-            await self.application.initialize()
-            await self.application.start()
-            await self.application.updater.start_polling(drop_pending_updates=True)
+            await self.start(polling=True)
             
             # Бесконечный цикл
-            import asyncio
             while True:
                 await asyncio.sleep(1)
                 
@@ -0,0 +1,172 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Dict, List, Optional, Tuple
+
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import BaseUpdateProcessor
+
+import callbacks
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних update_id помнить для отсева повторной доставки
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", "10000"))
+# Сколько пользователей с недавними ответами помнить
+UPDATE_DEDUP_USERS = int(os.getenv("UPDATE_DEDUP_USERS", "10000"))
+# Повторное нажатие ответа на тот же вопрос в течение этого времени - дубль (секунды);
+# после него нажатие проходит, чтобы пользователь мог повторить неудавшийся ответ
+ANSWER_DEDUP_SECONDS = float(os.getenv("ANSWER_DEDUP_SECONDS", "10"))
+
+# Причины отсева (метка метрики)
+DUPLICATE_UPDATE = "update_id"
+DUPLICATE_ANSWER = "answer"
+
+
+class IdempotencyFilter:
+    """Отсев дублей: повторно доставленных update_id и повторных нажатий ответа.
+
+    Обе таблицы ограничены по размеру и вытесняют самые старые записи.
+    Ответ определяется по пользователю, тесту, версии контента и вопросу;
+    начало нового теста сбрасывает ответы пользователя.
+    """
+
+    def __init__(
+        self,
+        window: int = UPDATE_DEDUP_WINDOW,
+        max_users: int = UPDATE_DEDUP_USERS,
+        answer_ttl: float = ANSWER_DEDUP_SECONDS
+    ):
+        self.window = window
+        self.max_users = max_users
+        self.answer_ttl = answer_ttl
+        self._update_ids: "OrderedDict[int, None]" = OrderedDict()
+        # user_id -> {(quiz_id, version, question): время нажатия}
+        self._answers: "OrderedDict[int, Dict[Tuple, float]]" = OrderedDict()
+
+    def seen_update(self, update_id: int) -> bool:
+        """True, если update_id уже был; иначе запоминает его"""
+        if update_id in self._update_ids:
+            return True
+        self._update_ids[update_id] = None
+        if len(self._update_ids) > self.window:
+            self._update_ids.popitem(last=False)
+        return False
+
+    def check_answer(self, user_id: int, data: callbacks.CallbackData) -> bool:
+        """True, если это повтор недавнего ответа; иначе запоминает нажатие"""
+        if data.action == callbacks.ACTION_START_TEST:
+            self._answers.pop(user_id, None)
+            return False
+        if data.action != callbacks.ACTION_ANSWER:
+            return False
+
+        now = time.monotonic()
+        key = (data.quiz_id, data.version, data.question)
+        answers = self._answers.get(user_id)
+        if answers is None:
+            answers = self._answers[user_id] = {}
+            if len(self._answers) > self.max_users:
+                self._answers.popitem(last=False)
+        else:
+            self._answers.move_to_end(user_id)
+        tapped_at = answers.get(key)
+        if tapped_at is not None and now - tapped_at < self.answer_ttl:
+            return True
+        answers[key] = now
+        return False
+
+
+class UserLaneProcessor(BaseUpdateProcessor):
+    """Обработка обновлений: параллельно для разных пользователей, по очереди для одного.
+
+    Обновления одного пользователя выполняются в порядке поступления
+    (asyncio.Lock отдает блокировку по очереди), поэтому нажатия одного
+    пользователя не гоняются за его состоянием. Дубли отсеиваются
+    IdempotencyFilter до запуска обработчиков, то есть до обращений к
+    MongoDB и Bot API. Общий слот занимается только после очереди
+    пользователя. Очередь пользователя удаляется, когда пустеет.
+    """
+
+    def __init__(self, max_concurrent_updates: int, idempotency: Optional[IdempotencyFilter] = None):
+        super().__init__(max_concurrent_updates)
+        self.idempotency = idempotency or IdempotencyFilter()
+        # user_id -> [блокировка, число ожидающих и выполняемых обновлений]
+        self._lanes: Dict[int, List[Any]] = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _drop(self, coroutine: Awaitable[Any], reason: str):
+        # Корутина обработки уже создана - закрываем, чтобы не было предупреждения
+        coroutine.close()
+        metrics.DUPLICATE_UPDATES.labels(reason=reason).inc()
+
+    async def _answer_quietly(self, update: Update):
+        # Повторное нажатие - отдельный callback_query: без ответа у кнопки крутится индикатор загрузки
+        try:
+            await update.callback_query.answer()
+        except TelegramError as e:
+            logger.debug(f"Не удалось ответить на повторное нажатие: {e}")
+
+    def _duplicate_answer(self, update: Update, user_id: int) -> bool:
+        query = update.callback_query
+        if query is None or not query.data:
+            return False
+        try:
+            data = callbacks.decode(query.data)
+        except callbacks.CallbackRejected:
+            # Отклонит обработчик кнопок
+            return False
+        return self.idempotency.check_answer(user_id, data)
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]):
+        """Сначала очередь пользователя, затем общий слот BOT_CONCURRENT_UPDATES.
+
+        Обновления, ждущие своей очереди, не занимают слоты: серия нажатий
+        одного пользователя держит не больше одного слота и не задерживает
+        остальных пользователей.
+        """
+        # Повторная доставка того же update_id: на callback_query отвечает обработка первой копии
+        if isinstance(update, Update) and self.idempotency.seen_update(update.update_id):
+            self._drop(coroutine, DUPLICATE_UPDATE)
+            return
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+            return
+
+        lane = self._lanes.get(user.id)
+        if lane is None:
+            lane = self._lanes[user.id] = [asyncio.Lock(), 0]
+        lane[1] += 1
+        try:
+            async with lane[0]:
+                async with self._semaphore:
+                    await self.do_process_update(update, coroutine)
+        finally:
+            lane[1] -= 1
+            if lane[1] == 0:
+                del self._lanes[user.id]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]):
+        # Вызывается в очереди пользователя: дубль дожидается обработки первого нажатия и отсеивается
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is not None and self._duplicate_answer(update, user.id):
+            self._drop(coroutine, DUPLICATE_ANSWER)
+            await self._answer_quietly(update)
+            return
+        await coroutine
+
+    @property
+    def active_lanes(self) -> int:
+        """Пользователей с обновлениями в обработке или в очереди"""
+        return len(self._lanes)
@@ -0,0 +1,329 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+from bson import json_util
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+import database
+import metrics
+from database import run_sync
+
+logger = logging.getLogger(__name__)
+
+# Настройки буфера отложенной записи
+WRITE_BUFFER_MAX_QUEUE = int(os.getenv("WRITE_BUFFER_MAX_QUEUE", "10000"))
+WRITE_BUFFER_BATCH_SIZE = int(os.getenv("WRITE_BUFFER_BATCH_SIZE", "500"))
+WRITE_BUFFER_FLUSH_INTERVAL = float(os.getenv("WRITE_BUFFER_FLUSH_INTERVAL", "1.0"))
+WRITE_BUFFER_MAX_RETRIES = int(os.getenv("WRITE_BUFFER_MAX_RETRIES", "3"))
+
+# Операции, не записанные после всех повторов (NDJSON); повторяются при следующем старте
+WRITE_BUFFER_DEAD_LETTERS = os.getenv(
+    "WRITE_BUFFER_DEAD_LETTERS",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "write_buffer_dead_letters.ndjson")
+)
+
+DUPLICATE_KEY = 11000
+
+# Один файл на процесс пишут и буфер, и повтор при старте
+_dead_letters_lock = threading.Lock()
+
+
+def _operation(record: Dict[str, Any]):
+    """Операция bulk_write из записи очереди"""
+    if record["op"] == "insert":
+        return InsertOne(record["document"])
+    return UpdateOne(record["filter"], record["update"], upsert=record["upsert"])
+
+
+def _write_dead_letters(collection_name: str, records: List[Dict[str, Any]], path: str):
+    # Canonical Extended JSON сохраняет типы BSON (ObjectId, datetime)
+    with _dead_letters_lock, open(path, "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json_util.dumps(
+                {"collection": collection_name, **record}, json_options=json_util.CANONICAL_JSON_OPTIONS
+            ) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _take_dead_letters(path: str) -> List[Dict[str, Any]]:
+    """Забрать отложенные операции: файл переименовывается, чтобы его не взял другой процесс"""
+    taken = f"{path}.{os.getpid()}.replay"
+    try:
+        os.replace(path, taken)
+    except FileNotFoundError:
+        return []
+    with open(taken, encoding="utf-8") as f:
+        records = [json_util.loads(line) for line in f if line.strip()]
+    os.remove(taken)
+    return records
+
+
+async def replay_dead_letters(path: str = WRITE_BUFFER_DEAD_LETTERS) -> int:
+    """Повтор операций, не записанных в прошлых запусках; снова неудачные возвращаются в файл"""
+    records = await asyncio.to_thread(_take_dead_letters, path)
+    if not records:
+        return 0
+    grouped: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+    for record in records:
+        grouped.setdefault(record.pop("collection"), []).append(record)
+    buffer = WriteBehindBuffer(dead_letters=path)
+    for name, collection_records in grouped.items():
+        entries = [(_operation(record), None, record) for record in collection_records]
+        await buffer._write(database.db[name], entries)
+    logger.info(
+        f"Повтор отложенных операций: записано {buffer._metrics['flushed_ops']}, "
+        f"снова отложено {buffer._metrics['failed_ops']}"
+    )
+    return buffer._metrics["flushed_ops"]
+
+
+class WriteBehindBuffer:
+    """Буфер отложенной записи в MongoDB.
+
+    Операции складываются в ограниченную очередь и сбрасываются пачками
+    через bulk_write, когда набирается batch_size операций или проходит
+    flush_interval секунд. Если очередь заполнена, запись ждет места
+    (backpressure). Буфер привязан к event loop, в котором запущен.
+    Операции, не записанные после max_retries повторов, дописываются в
+    файл dead_letters и повторяются при следующем старте
+    (replay_dead_letters).
+    """
+
+    def __init__(
+        self,
+        max_queue: int = WRITE_BUFFER_MAX_QUEUE,
+        batch_size: int = WRITE_BUFFER_BATCH_SIZE,
+        flush_interval: float = WRITE_BUFFER_FLUSH_INTERVAL,
+        max_retries: int = WRITE_BUFFER_MAX_RETRIES,
+        dead_letters: str = WRITE_BUFFER_DEAD_LETTERS
+    ):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.dead_letters = dead_letters
+        self._queue: Optional[asyncio.Queue] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self._metrics = {
+            "enqueued": 0,
+            "flushed_ops": 0,
+            "failed_ops": 0,
+            "flushes": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+            "backpressure_waits": 0,
+        }
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """Запуск фонового сброса в текущем event loop"""
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._closing = False
+        self._task = self._loop.create_task(self._run())
+        metrics.WRITE_BUFFER_QUEUE_DEPTH.set_function(self._queue.qsize)
+        logger.info(
+            f"Буфер отложенной записи запущен (batch={self.batch_size}, "
+            f"interval={self.flush_interval}s, queue={self.max_queue})"
+        )
+
+    async def insert(self, collection, document: Dict[str, Any]):
+        """Отложенная вставка документа"""
+        await self._put(collection, {"op": "insert", "document": document})
+
+    async def update(
+        self,
+        collection,
+        filter: Dict[str, Any],
+        update: Dict[str, Any],
+        upsert: bool = False,
+        on_upsert: Optional[Callable[[], None]] = None
+    ):
+        """Отложенное обновление документа; on_upsert вызывается после записи, если документ создан"""
+        await self._put(
+            collection, {"op": "update", "filter": filter, "update": update, "upsert": upsert}, on_upsert
+        )
+
+    async def _put(self, collection, record: Dict[str, Any], on_upsert: Optional[Callable[[], None]] = None):
+        if self._closing:
+            raise RuntimeError("Буфер отложенной записи остановлен")
+        if self._queue.full():
+            self._metrics["backpressure_waits"] += 1
+        # Запись нужна, чтобы отложить операцию в файл, если MongoDB ее так и не примет
+        await self._queue.put((collection, (_operation(record), on_upsert, record)))
+        self._metrics["enqueued"] += 1
+
+    async def _run(self):
+        while True:
+            batch = await self._collect_batch()
+            if batch:
+                await self._flush(batch)
+            elif self._closing:
+                return
+
+    async def _collect_batch(self) -> List[tuple]:
+        """Ожидание операций до batch_size или flush_interval"""
+        batch = []
+        try:
+            batch.append(await asyncio.wait_for(self._queue.get(), timeout=self.flush_interval))
+        except asyncio.TimeoutError:
+            return batch
+
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if self._queue.empty() and self._closing:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _flush(self, batch: List[tuple]):
+        """Запись пачки: один bulk_write на коллекцию, порядок операций сохраняется"""
+        grouped: "OrderedDict[str, tuple]" = OrderedDict()
+        for collection, entry in batch:
+            grouped.setdefault(collection.name, (collection, []))[1].append(entry)
+
+        started = time.perf_counter()
+        for collection, entries in grouped.values():
+            await self._write(collection, entries)
+
+        metrics.WRITE_BUFFER_FLUSH_DURATION.observe(time.perf_counter() - started)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self._metrics["flushes"] += 1
+        self._metrics["last_flush_ms"] = round(elapsed_ms, 2)
+        self._metrics["max_flush_ms"] = round(max(self._metrics["max_flush_ms"], elapsed_ms), 2)
+        self._metrics["total_flush_ms"] += elapsed_ms
+
+    async def _write(self, collection, entries: List[tuple]):
+        """bulk_write с повторами только неприменившегося хвоста.
+
+        entries - (операция, on_upsert, запись очереди). Ordered bulk_write
+        останавливается на первой ошибке: операции до нее уже применены,
+        поэтому повторяется только хвост - иначе $inc посчитался бы дважды.
+        Дубль ключа на InsertOne значит, что вставка прошла в прошлой
+        попытке (_id документа сохраняется). Для созданных upsert документов
+        вызываются их on_upsert.
+        """
+        attempt = 0
+        while entries:
+            operations = [operation for operation, _, _ in entries]
+            callbacks = [on_upsert for _, on_upsert, _ in entries]
+            try:
+                result = await run_sync(collection.bulk_write, operations, ordered=True)
+                self._metrics["flushed_ops"] += len(operations)
+                self._notify_upserted(callbacks, result.upserted_ids)
+                return
+            except BulkWriteError as e:
+                upserted = {item["index"]: item["_id"] for item in e.details.get("upserted", [])}
+                self._notify_upserted(callbacks, upserted)
+                write_errors = e.details.get("writeErrors") or []
+                if not write_errors:
+                    # Только ошибка write concern: операции применены на primary
+                    logger.warning(f"Пачка в {collection.name} записана без подтверждения write concern: {e}")
+                    self._metrics["flushed_ops"] += len(operations)
+                    return
+                error = write_errors[0]
+                index = error["index"]
+                self._metrics["flushed_ops"] += index
+                if error.get("code") == DUPLICATE_KEY and isinstance(operations[index], InsertOne):
+                    self._metrics["flushed_ops"] += 1
+                    entries = entries[index + 1:]
+                    continue
+                entries = entries[index:]
+                reason = error.get("errmsg")
+            except Exception as e:
+                reason = e
+            if attempt == self.max_retries:
+                await self._dead_letter(collection, entries, reason)
+                return
+            logger.warning(f"Ошибка записи пачки в {collection.name}, повтор {len(entries)} операций: {reason}")
+            await asyncio.sleep(0.5 * (2 ** attempt))
+            attempt += 1
+
+    async def _dead_letter(self, collection, entries: List[tuple], reason):
+        """Неудавшиеся после всех повторов операции - в файл для повтора при старте"""
+        self._metrics["failed_ops"] += len(entries)
+        metrics.WRITE_BUFFER_DEAD_LETTERS.inc(len(entries))
+        try:
+            await asyncio.to_thread(
+                _write_dead_letters, collection.name, [record for _, _, record in entries], self.dead_letters
+            )
+        except OSError as e:
+            logger.error(
+                f"Потеряны {len(entries)} операций в {collection.name}: {reason}; "
+                f"не удалось записать их в {self.dead_letters}: {e}"
+            )
+            return
+        logger.error(
+            f"Не удалось записать {len(entries)} операций в {collection.name}: {reason}; "
+            f"они отложены в {self.dead_letters} до следующего старта"
+        )
+
+    @staticmethod
+    def _notify_upserted(callbacks: List[Optional[Callable[[], None]]], upserted_ids: Dict[int, Any]):
+        for index in upserted_ids or {}:
+            callback = callbacks[index]
+            if callback is not None:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error(f"Ошибка обработчика созданного документа: {e}")
+
+    async def close(self):
+        """Сброс всех накопленных операций и остановка"""
+        if not self.running:
+            return
+        self._closing = True
+        await self._task
+        logger.info(f"Буфер отложенной записи остановлен, записано операций: {self._metrics['flushed_ops']}")
+
+    async def close_from_any_loop(self):
+        """Остановка буфера из другого event loop (например, из потока FastAPI)"""
+        if self._loop is None or self._loop.is_closed():
+            return
+        try:
+            current_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            current_loop = None
+        if current_loop is self._loop:
+            await self.close()
+            return
+        future = asyncio.run_coroutine_threadsafe(self.close(), self._loop)
+        await asyncio.wrap_future(future)
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики очереди и сброса"""
+        flushes = self._metrics["flushes"]
+        return {
+            "running": self.running,
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "max_queue": self.max_queue,
+            "batch_size": self.batch_size,
+            "flush_interval": self.flush_interval,
+            "enqueued": self._metrics["enqueued"],
+            "flushed_ops": self._metrics["flushed_ops"],
+            "failed_ops": self._metrics["failed_ops"],
+            "flushes": flushes,
+            "backpressure_waits": self._metrics["backpressure_waits"],
+            "last_flush_ms": self._metrics["last_flush_ms"],
+            "max_flush_ms": self._metrics["max_flush_ms"],
+            "avg_flush_ms": round(self._metrics["total_flush_ms"] / flushes, 2) if flushes else 0.0,
+        }